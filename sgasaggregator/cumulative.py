@@ -0,0 +1,228 @@
+"""
+Cumulative (running) totals of the aggregates of the SGAS cache.
+
+For every aggregate of a series (the key values and resolution) the
+corresponding 'cum_<table>' table holds the totals of all aggregates of the
+series up to (and including) its t_epoch. The total of an interval is then
+the difference of two rows, found by two point lookups (see
+helpers.get_total()), instead of summing up all buckets of the interval.
+
+When aggregates of a series change, the running totals of that series are
+recomputed from the oldest changed bucket on, starting from the last running
+totals before it. Series without changes are left alone. The aggregator
+refreshes the changed series after each cycle, within the transaction of the
+cycle's session. If there are no running totals yet, all of them are computed
+once, reading the aggregates chunk by chunk and writing them in batches.
+
+The running totals are not purged by the retention policy. As purged time
+ranges can't be recomputed, refreshing starts at the retention horizon at
+the earliest.
+"""
+
+import logging
+
+from sqlalchemy import and_ as AND
+from sqlalchemy import or_ as OR
+from sqlalchemy import select, func
+
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import session as sgascache_session
+
+SERIES_CHUNK = 100  # number of series refreshed per query
+CHUNK_BUCKETS = 28  # number of buckets read at once when computing all running totals
+
+
+class CumulativeTotals(object):
+    """ Maintains the running totals of the aggregate tables. """
+
+    def __init__(self, writer):
+        """
+        writer: BulkWriter, used to write and delete the running totals
+        """
+        self.log = logging.getLogger(__name__)
+        self.writer = writer
+
+    def key_columns(self, table):
+        """ returns names of the key columns of the aggregate table """
+        return [c.name for c in table.columns if c.name not in ag_schema.VALUE_COLUMNS \
+            and c.name not in ('resolution', 't_epoch')]
+
+    def _series_filter(self, t, keys, series, before=False):
+        """ returns filter on the rows of t (aggregate or running totals
+            table) of the series (list of (key values, t_epoch)), from their
+            t_epoch on (or before it, if 'before' is set).
+        """
+        clauses = list()
+        for key, t_epoch in series:
+            if before:
+                clause = [t.c.t_epoch < t_epoch]
+            else:
+                clause = [t.c.t_epoch >= t_epoch]
+            clause.extend([t.c[k] == v for k, v in zip(keys, key)])
+            clauses.append(AND(*clause))
+        return OR(*clauses)
+
+    def _base(self, session, cum, keys, resolution, where):
+        """ returns the last running totals (selected by 'where') per series
+            (dictionary {key values: [totals]})
+        """
+        latest = select([cum.c[k] for k in keys] + [func.max(cum.c.t_epoch).label('t_epoch')],
+            AND(cum.c.resolution == resolution, where),
+            group_by=[cum.c[k] for k in keys]).alias('latest')
+        join = cum.join(latest, AND(cum.c.resolution == resolution,
+            cum.c.t_epoch == latest.c.t_epoch, *[cum.c[k] == latest.c[k] for k in keys]))
+
+        base = dict()
+        for row in session.execute(select([cum.c[k] for k in keys] + \
+                [cum.c[v] for v in ag_schema.VALUE_COLUMNS], from_obj=[join])):
+            base[tuple(row[:len(keys)])] = [int(v or 0) for v in row[len(keys):]]
+        return base
+
+    def _write_totals(self, session, cum, keys, resolution, base, result):
+        """ writes the running totals of the aggregates of result (ordered by
+            t_epoch), starting from the base totals (which are updated), in
+            batches. returns number of written running totals.
+        """
+        n = 0
+        rows = list()
+        for row in result:
+            series = tuple(row[:len(keys)])
+            totals = base.setdefault(series, [0] * len(ag_schema.VALUE_COLUMNS))
+            for i, v in enumerate(row[len(keys) + 1:]):
+                totals[i] += int(v or 0)
+            values = dict(zip(keys, series))
+            values.update(dict(zip(ag_schema.VALUE_COLUMNS, totals)))
+            values['resolution'] = resolution
+            values['t_epoch'] = row[len(keys)]
+            rows.append(values)
+            if len(rows) >= self.writer.batch_size:
+                n += self.writer.write(session, cum, rows)
+                rows = list()
+        return n + self.writer.write(session, cum, rows)
+
+    def _columns(self, table, keys):
+        return [table.c[k] for k in keys] + [table.c.t_epoch] + \
+            [table.c[v] for v in ag_schema.VALUE_COLUMNS]
+
+    def changed_series(self, session, table, resolution, ranges):
+        """ returns the series of table (dictionary {key values: t_epoch of
+            the oldest bucket}), which have aggregates or running totals of
+            resolution within the time ranges [(t_start_epoch, t_end_epoch)]
+            (t_end_epoch excluded, None: no upper limit).
+        """
+        cum = ag_schema.CUMULATIVE_TABLES[table.name]
+        keys = self.key_columns(table)
+
+        series = dict()
+        for t in (table, cum):
+            clauses = list()
+            for t_start_epoch, t_end_epoch in ranges:
+                clause = t.c.t_epoch >= t_start_epoch
+                if t_end_epoch:
+                    clause = AND(clause, t.c.t_epoch < t_end_epoch)
+                clauses.append(clause)
+
+            for row in session.execute(select([t.c[k] for k in keys] + [func.min(t.c.t_epoch)],
+                    AND(t.c.resolution == resolution, OR(*clauses)),
+                    group_by=[t.c[k] for k in keys])):
+                key = tuple(row[:len(keys)])
+                t_epoch = row[len(keys)]
+                if not series.has_key(key) or t_epoch < series[key]:
+                    series[key] = t_epoch
+        return series
+
+    def refresh(self, session, table, resolution, t_start_epoch, series=None):
+        """ recomputes the running totals of the aggregates of resolution in
+            table (within the transaction of session).
+            series: the series to refresh (dictionary {key values (ordered as
+                key_columns()): t_epoch}), each from its t_epoch on. If not set,
+                all series are recomputed from t_start_epoch on.
+            returns number of written running totals.
+        """
+        cum = ag_schema.CUMULATIVE_TABLES[table.name]
+        keys = self.key_columns(table)
+
+        if series is not None:
+            if not series:
+                return 0
+            t_start_epoch = min(series.values())
+
+        if session.execute(select([cum.c.t_epoch], cum.c.resolution == resolution).\
+                limit(1)).scalar() is None and \
+                session.execute(select([table.c.t_epoch], AND(table.c.resolution == resolution,
+                    table.c.t_epoch < t_start_epoch)).limit(1)).scalar() is not None:
+            self.log.info("No running totals of %s (resolution %d) yet, computing all" % \
+                (table.name, resolution))
+            series = None
+            t_start_epoch = 0
+
+        if series is None:
+            n = self._refresh_range(session, table, cum, keys, resolution, t_start_epoch)
+        else:
+            n = 0
+            items = series.items()
+            for i in range(0, len(items), SERIES_CHUNK):
+                n += self._refresh_series(session, table, cum, keys, resolution,
+                    items[i:i + SERIES_CHUNK])
+
+        self.log.debug("Refreshed %d running totals of %s (resolution %d)" % \
+            (n, table.name, resolution))
+        return n
+
+    def _refresh_series(self, session, table, cum, keys, resolution, series):
+        """ recomputes the running totals of the series (list of (key values,
+            t_epoch)), each from its t_epoch on.
+        """
+        base = self._base(session, cum, keys, resolution,
+            self._series_filter(cum, keys, series, before=True))
+
+        session.execute(cum.delete(AND(cum.c.resolution == resolution,
+            self._series_filter(cum, keys, series))))
+
+        return self._write_totals(session, cum, keys, resolution, base,
+            session.execute(select(self._columns(table, keys),
+                AND(table.c.resolution == resolution,
+                    self._series_filter(table, keys, series))).order_by(table.c.t_epoch)))
+
+    def _refresh_range(self, session, table, cum, keys, resolution, t_start_epoch):
+        """ recomputes the running totals of all series from t_start_epoch on.
+            The aggregates are read by chunks of CHUNK_BUCKETS buckets.
+        """
+        base = self._base(session, cum, keys, resolution, cum.c.t_epoch < t_start_epoch)
+        self.writer.delete_range(session, cum, resolution, t_start_epoch)
+
+        t_min, t_max = session.execute(select([func.min(table.c.t_epoch),
+            func.max(table.c.t_epoch)], AND(table.c.resolution == resolution,
+                table.c.t_epoch >= t_start_epoch))).fetchone()
+        if t_min is None:
+            return 0
+
+        n = 0
+        t = t_min
+        chunk = CHUNK_BUCKETS * resolution
+        while t <= t_max:
+            n += self._write_totals(session, cum, keys, resolution, base,
+                session.execute(select(self._columns(table, keys),
+                    AND(table.c.resolution == resolution, table.c.t_epoch >= t,
+                        table.c.t_epoch < t + chunk)).order_by(table.c.t_epoch)))
+            t += chunk
+        return n
+
+    def refresh_all(self, resolution, ranges, series=None):
+        """ refreshes the running totals of resolution of all aggregate tables,
+            whose aggregates changed within the time ranges [(t_start_epoch,
+            t_end_epoch)] (see changed_series()), without committing.
+            series: optional, {table name: series (see refresh())}, if the
+                changed series are known already
+        """
+        session = sgascache_session.Session()
+        t_start_epoch = min([t_start for t_start, t_end in ranges])
+
+        n = 0
+        for table in ag_schema.AGGREGATE_TABLES:
+            if series is None:
+                table_series = self.changed_series(session, table, resolution, ranges)
+            else:
+                table_series = series.get(table.name, dict())
+            n += self.refresh(session, table, resolution, t_start_epoch, table_series)
+        self.log.info("Refreshed %d running totals (resolution %d)" % (n, resolution))
@@ -0,0 +1,85 @@
+"""
+Pipeline, which overlaps reading with processing (e.g. writing).
+
+The items (e.g. time windows of SGAS records) are read by a reader thread,
+which runs ahead of the consumer by at most 'depth' items. Hence, while the
+results of an item are written to the SGAS cache, the next item is already
+fetched from the SGAS database. The results are consumed in item order by the
+calling thread.
+
+The reader thread uses its own (thread-local) database sessions, which are
+released by the 'cleanup' callable once the reader is done. If reading fails,
+the error is raised again in the calling thread. If consuming fails, the
+reader is stopped.
+"""
+
+import logging
+import threading
+import Queue
+
+DEPTH = 2  # default number of items read ahead
+
+_DONE = object()  # end of items marker
+
+
+class Pipeline(object):
+    """ Reads items in a reader thread, while the caller consumes them. """
+
+    def __init__(self, depth=DEPTH):
+        """
+        depth: max. number of items read ahead
+        """
+        self.log = logging.getLogger(__name__)
+        self.depth = max(1, depth)
+
+    def run(self, read, items, consume, cleanup=None):
+        """ runs read(item) for all items in the reader thread and
+            consume(item, result) in the calling thread (in item order).
+            cleanup: optional, called by the reader thread when done
+            returns number of consumed items.
+        """
+        queue = Queue.Queue(self.depth)
+        stop = threading.Event()
+
+        def put(entry):
+            """ puts entry onto the queue, unless the consumer stopped """
+            while not stop.isSet():
+                try:
+                    queue.put(entry, True, 0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def reader():
+            try:
+                try:
+                    for item in items:
+                        if not put((item, read(item), None)):
+                            return
+                    put((None, _DONE, None))
+                except Exception, e:
+                    self.log.exception(e)
+                    put((None, None, e))
+            finally:
+                if cleanup:
+                    cleanup()
+
+        thread = threading.Thread(target=reader)
+        thread.setDaemon(True)
+        thread.start()
+
+        n = 0
+        try:
+            while True:
+                item, result, error = queue.get()
+                if error:
+                    raise error
+                if result is _DONE:
+                    break
+                consume(item, result)
+                n += 1
+        finally:
+            stop.set()
+            thread.join()
+        return n
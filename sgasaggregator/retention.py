@@ -0,0 +1,209 @@
+"""
+Retention policy for the aggregates of the SGAS cache.
+
+The policy defines per resolution (and optionally per aggregate table) how
+many days back the aggregates are kept. It is read from the [retention]
+section of the configuration, e.g.:
+
+    [retention]
+    86400 = 365                          (all tables)
+    user_vo_machine_status.86400 = 180   (single table, takes precedence)
+
+Before aggregates older than the horizon get purged, it is verified that
+they are covered by the aggregates of the coarsest resolution, i.e. that the
+corresponding coarse buckets exist and their sums are not smaller. (Equal
+sums are expected, except for fine buckets re-created after their time range
+has been purged already.) Aggregates are only purged for complete buckets of
+the coarsest resolution. The coarsest resolution itself is never purged.
+Partitions, which end before the horizon (see sgascache.partitions), are
+truncated as a whole. The remaining aggregates are purged in bounded time
+chunks, each in its own transaction.
+
+As the finer aggregates older than the horizon may be missing, the
+aggregator computes the coarser aggregates of such time ranges from the
+SGAS records (see purged_before()).
+"""
+
+import time
+import logging
+from datetime import datetime
+
+from sqlalchemy import and_ as AND
+from sqlalchemy import select, func
+
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import session as sgascache_session
+from sgasaggregator.utils import cache
+
+CHUNK_DAYS = 28  # default time chunk [days], which gets purged at once
+
+
+def parse_policy(options):
+    """ returns policy {(table name or None, resolution): days} of the options
+        (dictionary) of the [retention] section. Invalid entries are ignored.
+    """
+    log = logging.getLogger(__name__)
+    tables = [t.name for t in ag_schema.AGGREGATE_TABLES]
+
+    policy = dict()
+    for option, value in options.items():
+        table = None
+        resolution = option
+        if '.' in option:
+            table, resolution = option.rsplit('.', 1)
+        if (table and table not in tables) or not resolution.isdigit() or not value.isdigit():
+            log.warn("Ignoring invalid retention setting '%s = %s'" % (option, value))
+            continue
+        policy[(table, int(resolution))] = int(value)
+    return policy
+
+
+class RetentionPolicy(object):
+    """ Purges aggregates older than the retention horizon of their resolution. """
+
+    def __init__(self, policy, writer, chunk_days=CHUNK_DAYS):
+        """
+        policy: {(table name or None, resolution): days}
+        writer: BulkWriter, used for the range deletes
+        chunk_days: max. time range [days] purged at once
+        """
+        self.log = logging.getLogger(__name__)
+        self.policy = policy
+        self.writer = writer
+        self.chunk_days = chunk_days
+
+    def days(self, table, resolution):
+        """ returns retention days of resolution in table, None if kept forever """
+        if self.policy.has_key((table.name, resolution)):
+            return self.policy[(table.name, resolution)]
+        return self.policy.get((None, resolution))
+
+    def purged_before(self, resolution):
+        """ returns epoch before which aggregates of resolution may have been
+            purged (in any table), None if they are kept forever.
+        """
+        days = [d for (t, r), d in self.policy.items() if r == resolution]
+        if not days:
+            return None
+        return int(time.time()) - min(days) * 86400
+
+    def _sums(self, table, resolution, coarse_resolution, t_start_epoch, t_end_epoch):
+        """ returns sums of the aggregated values of resolution within
+            [t_start_epoch, t_end_epoch) per bucket of coarse_resolution
+            (dictionary {t_epoch of coarse bucket: [sums]}). Missing values
+            (NULL) count as 0.
+        """
+        sums = dict()
+        for row in sgascache_session.Session.execute(select([table.c.t_epoch] +
+                [func.sum(func.coalesce(table.c[k], 0)) for k in ag_schema.VALUE_COLUMNS],
+                AND(table.c.resolution == resolution,
+                    table.c.t_epoch >= t_start_epoch,
+                    table.c.t_epoch < t_end_epoch),
+                group_by=[table.c.t_epoch])):
+            t_epoch = row[0] - (row[0] % coarse_resolution) + coarse_resolution - 1
+            values = sums.setdefault(t_epoch, [0] * len(ag_schema.VALUE_COLUMNS))
+            for i, v in enumerate(row[1:]):
+                values[i] += int(v or 0)
+        return sums
+
+    def covered(self, table, resolution, coarse_resolution, t_start_epoch, t_end_epoch):
+        """ returns True if the aggregates of resolution within
+            [t_start_epoch, t_end_epoch) are covered by coarse_resolution
+        """
+        coarse = self._sums(table, coarse_resolution, coarse_resolution, t_start_epoch,
+            t_end_epoch)
+        for t_epoch, values in self._sums(table, resolution, coarse_resolution,
+                t_start_epoch, t_end_epoch).items():
+            if not coarse.has_key(t_epoch):
+                return False
+            for v, cv in zip(values, coarse[t_epoch]):
+                if v > cv:
+                    return False
+        return True
+
+    def _truncate_expired(self, table, resolution, coarse_resolution, horizon):
+        """ truncates the partitions of table, which hold only aggregates of
+            resolution before horizon, as long as they are covered by
+            coarse_resolution. returns number of purged aggregates.
+        """
+        partitions = self.writer.partitions
+        if partitions is None:
+            return 0
+
+        n = 0
+        for name, t_start, t_end in partitions.expired(table, resolution, horizon):
+            # partitions don't need to match the coarse buckets
+            if not self.covered(table, resolution, coarse_resolution,
+                    t_start - t_start % coarse_resolution,
+                    t_end + (-t_end) % coarse_resolution):
+                sgascache_session.Session.rollback()
+                break  # not purged by the time chunks either
+
+            session = sgascache_session.Session()
+            n += session.execute(select([func.count()], AND(table.c.resolution == resolution,
+                table.c.t_epoch >= t_start, table.c.t_epoch < t_end))).scalar()
+            self.writer.delete_range(session, table, resolution, t_start, t_end, truncate=True)
+            session.commit()
+        return n
+
+    def purge_table(self, table, resolution, coarse_resolution, days):
+        """ purges the aggregates of resolution older than days from table.
+            returns number of purged aggregates.
+        """
+        horizon = int(time.time()) - days * 86400
+        horizon -= horizon % coarse_resolution  # complete coarse buckets only
+
+        n = self._truncate_expired(table, resolution, coarse_resolution, horizon)
+
+        t_start_epoch = sgascache_session.Session.execute(select([func.min(table.c.t_epoch)],
+            AND(table.c.resolution == resolution, table.c.t_epoch < horizon))).scalar()
+        if t_start_epoch is None:
+            t_start_epoch = horizon  # nothing left
+        t_start_epoch -= t_start_epoch % coarse_resolution
+
+        chunk = max(1, self.chunk_days * 86400 / coarse_resolution) * coarse_resolution
+
+        t = t_start_epoch
+        while t < horizon:
+            t_end = min(t + chunk, horizon)
+            if not self.covered(table, resolution, coarse_resolution, t, t_end):
+                self.log.warn("Aggregates of %s (resolution %d) from %s on are not covered by "
+                    "resolution %d, not purging them." % (table.name, resolution,
+                    datetime.utcfromtimestamp(t), coarse_resolution))
+                sgascache_session.Session.rollback()
+                break
+
+            session = sgascache_session.Session()
+            n += self.writer.delete_range(session, table, resolution, t, t_end)
+            session.commit()
+            t = t_end
+
+        if n:
+            self.log.info("Purged %d aggregates of %s (resolution %d) older than %s" % \
+                (n, table.name, resolution, datetime.utcfromtimestamp(horizon)))
+        return n
+
+    def purge(self, resolution, factors):
+        """ applies the retention policy to all aggregate tables.
+            resolution: base resolution
+            factors: factors of the further resolutions
+        """
+        resolutions = sorted([resolution] + [f * resolution for f in factors])
+        coarse_resolution = resolutions[-1]
+
+        n = 0
+        for table in ag_schema.AGGREGATE_TABLES:
+            for res in resolutions:
+                days = self.days(table, res)
+                if days is None:
+                    continue
+                if res == coarse_resolution:
+                    self.log.warn("No coarser resolution than %d, not purging %s." % \
+                        (res, table.name))
+                    continue
+                n += self.purge_table(table, res, coarse_resolution, days)
+
+        if n:  # invalidates the cached query results
+            session = sgascache_session.Session()
+            cache.bump_generation(session)
+            session.commit()
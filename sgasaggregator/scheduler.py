@@ -0,0 +1,93 @@
+"""
+Scheduler, which runs the tasks of a DAG (directed acyclic graph) concurrently.
+
+The tasks are the edges (parent, child) of the graph, e.g. the aggregation of
+a parent key into a child key (see uraggregator.KEY_LATTICE). A task is queued
+as soon as the task producing its parent has finished, and it is run by the
+next free worker thread. Hence independent branches run concurrently.
+
+If a task fails, the tasks depending on its child are skipped. Once all tasks
+are done (or skipped), the first failure is raised again.
+"""
+
+import logging
+import threading
+import Queue
+
+
+class DagScheduler(object):
+    """ Runs the tasks (edges) of a DAG with a pool of worker threads. """
+
+    def __init__(self, edges, workers=4):
+        """
+        edges: list of (parent, child) tuples
+        workers: number of worker threads
+        """
+        self.log = logging.getLogger(__name__)
+        self.workers = max(1, workers)
+        self.children = dict()  # node -> list of edges starting at node
+        for parent, child in edges:
+            self.children.setdefault(parent, []).append((parent, child))
+
+    def _edges_below(self, node):
+        """ returns all edges reachable from node """
+        edges = list()
+        for edge in self.children.get(node, []):
+            edges.append(edge)
+            edges += self._edges_below(edge[1])
+        return edges
+
+    def run(self, task, root):
+        """ runs task(parent, child) for every edge reachable from root
+            (which is considered as done already).
+        """
+        queue = Queue.Queue()
+        lock = threading.Lock()
+        state = dict(remaining=len(self._edges_below(root)), errors=[])
+
+        if not state['remaining']:
+            return
+
+        def finished(n):
+            """ accounts n finished (or skipped) tasks """
+            lock.acquire()
+            try:
+                state['remaining'] -= n
+                if state['remaining'] == 0:
+                    for i in range(self.workers):
+                        queue.put(None)  # stops the workers
+            finally:
+                lock.release()
+
+        def worker():
+            while True:
+                edge = queue.get()
+                if edge is None:
+                    break
+                try:
+                    task(*edge)
+                except Exception, e:
+                    self.log.exception(e)
+                    skipped = self._edges_below(edge[1])
+                    if skipped:
+                        self.log.error("Skipping %d tasks depending on %s" % (len(skipped), edge[1]))
+                    lock.acquire()
+                    state['errors'].append(e)
+                    lock.release()
+                    finished(1 + len(skipped))
+                else:
+                    for child_edge in self.children.get(edge[1], []):
+                        queue.put(child_edge)
+                    finished(1)
+
+        for edge in self.children.get(root, []):
+            queue.put(edge)
+
+        threads = [threading.Thread(target=worker) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if state['errors']:
+            raise state['errors'][0]
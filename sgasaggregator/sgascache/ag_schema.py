@@ -37,6 +37,24 @@ key_0411: machine_name
 Each of this keys will have its own table where the aggregated values are stored. The tables may hold
 aggregates at different resolutions.
 
+Besides the aggregates, the 'ingest_watermark' table keeps track of the last SGAS
+record (per source) that has been aggregated.
+
+The dimension tables (dim_user, dim_vo, dim_machine and dim_status) are the
+catalog of the distinct user, VO, machine and status values of the
+aggregates, with the time range (first_seen, last_seen) of their aggregates
+(see sgascache.dimensions).
+
+The 'work_queue' table holds the aggregation tasks, which are shared by
+cooperating aggregator daemons (see workqueue).
+
+The 'cum_<table>' tables hold running totals of the aggregate tables, which
+answer interval totals by two lookups (see cumulative).
+
+The 'cache_generation' table holds a single counter, which the aggregator
+increments whenever aggregates have changed. It invalidates the results
+cached by the query helpers (see utils.cache).
+
 We have avoided using a table schema that requires 'joins'. Each table keeps therefore its own copy of
 the variables that get aggregated.
 
@@ -276,6 +294,118 @@ t_machine = sa.Table("machine", sgascache_session.metadata,
     sa.Column('major_page_faults', sa.types.BIGINT, default = 0)
 )
 
+# all aggregate tables (key_0 ... key_0411)
+AGGREGATE_TABLES = [t_user_vo_machine_status,
+    t_user_vo_machine, t_user_vo_status, t_vo_machine_status, t_user_machine_status,
+    t_user_vo, t_user_machine, t_user_status, t_vo_status, t_vo_machine, t_machine_status,
+    t_user, t_status, t_vo, t_machine]
+
+# time-leading indexes for the maintenance statements, which select the
+# aggregates by (resolution, t_epoch) only. The lookups of the helpers
+# (key columns, resolution, t_epoch) are covered by the primary keys.
+TIME_INDEXES = [sa.Index('ix_%s_res_t' % t.name, t.c.resolution, t.c.t_epoch) \
+    for t in AGGREGATE_TABLES]
+
+# names of the aggregated values (columns of all aggregate tables)
+VALUE_COLUMNS = ['n_jobs', 'cpu_duration', 'wall_duration', 'user_time', 'kernel_time',
+    'major_page_faults']
+
+
+def _cumulative_table(table):
+    """ returns the cumulative table of the aggregate table: same keys, but
+        the values are running totals per series (key values + resolution)
+        up to (and including) t_epoch (see cumulative).
+    """
+    columns = list()
+    for c in table.columns:
+        if c.name in VALUE_COLUMNS:
+            columns.append(sa.Column(c.name, sa.types.BIGINT, default = 0))
+        else:
+            columns.append(sa.Column(c.name, c.type, autoincrement = False, primary_key = True))
+    cum = sa.Table("cum_" + table.name, sgascache_session.metadata, *columns)
+    sa.Index('ix_cum_%s_res_t' % table.name, cum.c.resolution, cum.c.t_epoch)
+    return cum
+
+# aggregate table name -> cumulative table
+CUMULATIVE_TABLES = dict([(t.name, _cumulative_table(t)) for t in AGGREGATE_TABLES])
+
+# ingest watermark, i.e. last aggregated SGAS record (by insert_time, record_id) per source
+t_ingest_watermark = sa.Table("ingest_watermark", sgascache_session.metadata,
+    sa.Column('source',             sa.types.VARCHAR(50), primary_key = True),
+    sa.Column('insert_time',        sa.types.DateTime),
+    sa.Column('record_id',          sa.types.VARCHAR(1000))
+)
+
+# dimension tables, i.e. catalog of the distinct key values
+t_dim_user = sa.Table("dim_user", sgascache_session.metadata,
+    sa.Column('id',                 sa.types.INTEGER, primary_key = True),
+    sa.Column('name',               sa.types.VARCHAR(200), nullable = False, unique = True),
+    sa.Column('first_seen',         sa.types.INTEGER),
+    sa.Column('last_seen',          sa.types.INTEGER)
+)
+
+t_dim_vo = sa.Table("dim_vo", sgascache_session.metadata,
+    sa.Column('id',                 sa.types.INTEGER, primary_key = True),
+    sa.Column('name',               sa.types.VARCHAR(50), nullable = False, unique = True),
+    sa.Column('first_seen',         sa.types.INTEGER),
+    sa.Column('last_seen',          sa.types.INTEGER)
+)
+
+t_dim_machine = sa.Table("dim_machine", sgascache_session.metadata,
+    sa.Column('id',                 sa.types.INTEGER, primary_key = True),
+    sa.Column('name',               sa.types.VARCHAR(50), nullable = False, unique = True),
+    sa.Column('first_seen',         sa.types.INTEGER),
+    sa.Column('last_seen',          sa.types.INTEGER)
+)
+
+t_dim_status = sa.Table("dim_status", sgascache_session.metadata,
+    sa.Column('id',                 sa.types.INTEGER, primary_key = True),
+    sa.Column('name',               sa.types.VARCHAR(50), nullable = False, unique = True),
+    sa.Column('first_seen',         sa.types.INTEGER),
+    sa.Column('last_seen',          sa.types.INTEGER)
+)
+
+# versions of the applied schema migrations (see sgascache.migrations)
+t_schema_version = sa.Table("schema_version", sgascache_session.metadata,
+    sa.Column('version',            sa.types.INTEGER, autoincrement = False, primary_key = True),
+    sa.Column('description',        sa.types.VARCHAR(200)),
+    sa.Column('applied',            sa.types.DateTime)
+)
+
+# aggregation tasks shared by several aggregator daemons (see workqueue)
+t_work_queue = sa.Table("work_queue", sgascache_session.metadata,
+    sa.Column('id',                 sa.types.INTEGER, primary_key = True),
+    sa.Column('batch',              sa.types.INTEGER, nullable = False),
+    sa.Column('step',               sa.types.INTEGER, nullable = False),
+    sa.Column('stage',              sa.types.VARCHAR(20), nullable = False),
+    sa.Column('key_name',           sa.types.VARCHAR(20)),
+    sa.Column('resolution',         sa.types.INTEGER, nullable = False),
+    sa.Column('factor',             sa.types.INTEGER),
+    sa.Column('t_start',            sa.types.INTEGER, nullable = False),
+    sa.Column('t_end',              sa.types.INTEGER, nullable = False),
+    sa.Column('state',              sa.types.VARCHAR(20), nullable = False),
+    sa.Column('owner',              sa.types.VARCHAR(100)),
+    sa.Column('lease_until',        sa.types.INTEGER),
+    sa.Column('attempts',           sa.types.INTEGER, default = 0),
+    sa.Column('message',            sa.types.VARCHAR(1000)),
+    sa.Column('updated',            sa.types.INTEGER)
+)
+sa.Index('ix_work_queue_state', t_work_queue.c.state, t_work_queue.c.batch, t_work_queue.c.step)
+
+t_cache_generation = sa.Table("cache_generation", sgascache_session.metadata,
+    sa.Column('id',                 sa.types.INTEGER, autoincrement = False, primary_key = True),
+    sa.Column('generation',         sa.types.INTEGER, nullable = False),
+    sa.Column('updated',            sa.types.DateTime)
+)
+
+# key column -> dimension table
+DIMENSION_TABLES = {
+    'global_user_name': t_dim_user,
+    'vo_name': t_dim_vo,
+    'machine_name': t_dim_machine,
+    'status': t_dim_status
+}
+
 
 RES_DEFAULT = 86400  # seconds per day
 
@@ -497,6 +627,39 @@ class Machine(object): #key0411
 
 
 
+class IngestWatermark(object):
+
+    def __init__(self, source, insert_time=None, record_id=None):
+
+        self.source = source
+        self.insert_time = insert_time
+        self.record_id = record_id
+
+
+
+class Dimension(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class DimUser(Dimension):
+    pass
+
+
+class DimVo(Dimension):
+    pass
+
+
+class DimMachine(Dimension):
+    pass
+
+
+class DimStatus(Dimension):
+    pass
+
+
+
 mapper(UserVoMachineStatus, t_user_vo_machine_status) # key_0
 
 mapper(UserVoMachine, t_user_vo_machine) # key_01
@@ -522,3 +685,9 @@ mapper(Vo, t_vo) # key_0321
 
 mapper(Machine, t_machine) # key_0411
 
+mapper(IngestWatermark, t_ingest_watermark)
+
+mapper(DimUser, t_dim_user)
+mapper(DimVo, t_dim_vo)
+mapper(DimMachine, t_dim_machine)
+mapper(DimStatus, t_dim_status)
@@ -0,0 +1,186 @@
+"""
+In-process cache of the dimension tables of the SGAS cache.
+
+The dimension tables hold every distinct value of the key columns
+(global_user_name, vo_name, machine_name and status) of the aggregates, i.e.
+they are a catalog of the known values (see utils.helpers.get_active_names()).
+The aggregate tables are keyed by the values themselves. A DimensionCache
+loads the catalog once and keeps it in memory, so only unknown values cost
+a database round trip when aggregates get registered.
+
+The dimension tables are written within the session of the caller, i.e.
+they get committed (or rolled back) together with the aggregates. After it
+wrote, a DimensionCache reloads the catalog (in the session of the next
+caller), so rolled back changes never stay cached.
+
+first_seen and last_seen hold the time range (epoch) covered by the buckets
+of the key_0 aggregates of a value, at the base resolution
+('seen_resolution'). The ranges are extended when aggregates get registered;
+they never shrink.
+
+Values of aggregates written before the dimension tables existed are added
+once by a schema migration (see backfill()).
+"""
+
+import logging
+import threading
+
+from sqlalchemy import select, case, func, bindparam, text
+from sqlalchemy import and_ as AND
+from sqlalchemy import or_ as OR
+
+from sgasaggregator.sgascache import ag_schema
+
+INSERT_CHUNK_SIZE = 500  # max. number of names added per statement
+
+log = logging.getLogger(__name__)
+
+
+class DimensionCache(object):
+    """ Caches the known values of the dimension tables. """
+
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.RLock()
+        self.seen = dict()   # column -> {name: [first_seen, last_seen]}
+        self.seen_resolution = None  # resolution of the tracked ranges (None: any)
+
+    def _load(self, session, column):
+        """ (re)loads the known values of the dimension of column """
+        table = ag_schema.DIMENSION_TABLES[column]
+        seen = dict()
+        for row in session.execute(select([table.c.name, table.c.first_seen,
+                table.c.last_seen])):
+            seen[row.name] = [row.first_seen, row.last_seen]
+        self.seen[column] = seen
+        self.log.debug("Loaded %d %s dimension values" % (len(seen), column))
+
+    def reset(self):
+        """ drops all cached values """
+        self.lock.acquire()
+        try:
+            self.seen = dict()
+        finally:
+            self.lock.release()
+
+    def _insert_statement(self, session, table):
+        """ returns an INSERT statement for table, which skips already
+            existing names (e.g. added concurrently by another process).
+            Plain INSERT, if the database can't skip them (PostgreSQL < 9.5,
+            sqlite < 3.24).
+        """
+        dialect = session.bind.dialect
+        preparer = dialect.identifier_preparer
+        sql = 'INSERT INTO %s (%s) VALUES (:name)' % (preparer.format_table(table),
+            preparer.format_column(table.c.name))
+        if dialect.name == 'mysql':
+            sql = sql.replace('INSERT', 'INSERT IGNORE', 1)
+        elif (dialect.name == 'postgresql' and dialect.server_version_info >= (9, 5)) or \
+                (dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 24)):
+            sql += ' ON CONFLICT (%s) DO NOTHING' % preparer.format_column(table.c.name)
+        return text(sql)
+
+    def register(self, session, rows):
+        """ adds the key values of the rows (list of dictionaries, column name
+            -> value) to the dimension tables, within session (i.e. without
+            committing). If the rows are aggregates (with resolution and
+            t_epoch), the seen ranges get extended.
+        """
+        if not rows:
+            return
+        track = rows[0].has_key('t_epoch') and rows[0].has_key('resolution')
+        for column in ag_schema.DIMENSION_TABLES.keys():
+            if not rows[0].has_key(column):
+                continue
+            self._register(session, column, rows, track)
+
+    def _ranges(self, column, rows):
+        """ returns dictionary name -> [first, last] of the time range
+            covered by the buckets of the aggregates (rows)
+        """
+        ranges = dict()
+        for row in rows:
+            name = row[column]
+            if name is None:
+                continue
+            if self.seen_resolution and row['resolution'] != self.seen_resolution:
+                continue
+            first = row['t_epoch'] - row['resolution'] + 1
+            r = ranges.get(name)
+            if not r:
+                ranges[name] = [first, row['t_epoch']]
+            else:
+                r[0] = min(r[0], first)
+                r[1] = max(r[1], row['t_epoch'])
+        return ranges
+
+    def _register(self, session, column, rows, track):
+        """ adds the unknown values of column and extends the seen ranges
+            (if track) of the rows within session
+        """
+        names = set([row[column] for row in rows if row[column] is not None])
+        ranges = track and self._ranges(column, rows) or dict()
+
+        self.lock.acquire()
+        try:
+            if not self.seen.has_key(column):
+                self._load(session, column)
+            seen = self.seen[column]
+            missing = [name for name in names if not seen.has_key(name)]
+            updates = list()
+            for name, (first, last) in ranges.items():
+                cached = seen.get(name) or [None, None]
+                if cached[0] is not None and cached[1] is not None and \
+                        cached[0] <= first and last <= cached[1]:
+                    continue  # within known range
+                updates.append(dict(b_name=name, b_first=first, b_last=last))
+            if not missing and not updates:
+                return
+
+            table = ag_schema.DIMENSION_TABLES[column]
+            if missing:
+                stmt = self._insert_statement(session, table)
+                for i in range(0, len(missing), INSERT_CHUNK_SIZE):
+                    session.execute(stmt, [dict(name=name) for name in \
+                        missing[i:i + INSERT_CHUNK_SIZE]])
+                self.log.info("Added %d new values to %s" % (len(missing), table.name))
+            if updates:
+                b_first = bindparam('b_first')
+                b_last = bindparam('b_last')
+                stmt = table.update(table.c.name == bindparam('b_name')).values(
+                    first_seen=case([(OR(table.c.first_seen == None,
+                        table.c.first_seen > b_first), b_first)], else_=table.c.first_seen),
+                    last_seen=case([(OR(table.c.last_seen == None,
+                        table.c.last_seen < b_last), b_last)], else_=table.c.last_seen))
+                session.execute(stmt, updates)
+                self.log.debug("Extended seen ranges of %d %s values" % (len(updates), column))
+            # not committed yet, reloaded by the next caller
+            del self.seen[column]
+        finally:
+            self.lock.release()
+
+
+def backfill(conn, table):
+    """ adds the distinct key values of the (key_0) aggregates of table, which
+        are missing in the dimension tables, including their seen ranges at
+        the finest resolution of table. Used once to migrate caches, which
+        got populated before the dimension tables existed (see migrations).
+    """
+    resolution = conn.execute(select([func.min(table.c.resolution)])).scalar()
+    if resolution is None:  # no aggregates
+        return
+
+    for column, dim in ag_schema.DIMENSION_TABLES.items():
+        known = set([row[0] for row in conn.execute(select([dim.c.name]))])
+        names = [row[0] for row in conn.execute(select([table.c[column]], distinct=True))
+            if row[0] is not None and row[0] not in known]
+        for i in range(0, len(names), INSERT_CHUNK_SIZE):
+            conn.execute(dim.insert(), [dict(name=name) for name in names[i:i + INSERT_CHUNK_SIZE]])
+
+        where = AND(table.c[column] == dim.c.name, table.c.resolution == resolution)
+        n = conn.execute(dim.update(dim.c.first_seen == None).values(
+            first_seen=select([func.min(table.c.t_epoch - table.c.resolution + 1)],
+                where).as_scalar(),
+            last_seen=select([func.max(table.c.t_epoch)], where).as_scalar())).rowcount
+        log.info("Added %d %s values, filled seen ranges of %d values" % \
+            (len(names), column, n))
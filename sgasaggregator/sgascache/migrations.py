@@ -0,0 +1,127 @@
+"""
+Schema management of the SGAS cache database.
+
+Tables (and the indexes of new tables) are created by dbinit.init_model().
+Changes to the schema of existing deployments are applied as versioned
+migrations. The 'schema_version' table keeps track of the migrations that
+have already been applied. Migrations must be idempotent, as they also run
+against freshly created databases (where create_all() already created
+everything).
+
+Usage:
+    migrate(engine)  applies all pending migrations
+    verify(engine)   returns the names of expected but missing indexes
+"""
+
+import logging
+from datetime import datetime
+
+from sqlalchemy import select, func
+from sqlalchemy.engine import reflection
+
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import dimensions
+
+log = logging.getLogger(__name__)
+
+
+def _index_names(conn, table):
+    """ returns names of the existing indexes of table """
+    insp = reflection.Inspector.from_engine(conn)
+    return [ix['name'] for ix in insp.get_indexes(table.name)]
+
+
+def _create_indexes(conn, indexes):
+    """ creates the indexes, which do not exist yet """
+    for index in indexes:
+        if index.name in _index_names(conn, index.table):
+            log.debug("Index %s exists already" % index.name)
+            continue
+        log.info("Creating index %s on %s" % (index.name, index.table.name))
+        index.create(bind=conn)
+
+
+def _add_columns(conn, table, names):
+    """ adds the columns (names) of table, which do not exist yet """
+    insp = reflection.Inspector.from_engine(conn)
+    existing = [c['name'] for c in insp.get_columns(table.name)]
+    preparer = conn.dialect.identifier_preparer
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        log.info("Adding column %s to %s" % (name, table.name))
+        conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (preparer.format_table(table),
+            preparer.format_column(column), column.type.compile(dialect=conn.dialect)))
+
+
+def _time_indexes(conn):
+    _create_indexes(conn, ag_schema.TIME_INDEXES)
+
+
+def _dimension_seen(conn):
+    for table in ag_schema.DIMENSION_TABLES.values():
+        _add_columns(conn, table, ['first_seen', 'last_seen'])
+
+
+def _dimension_backfill(conn):
+    dimensions.backfill(conn, ag_schema.t_user_vo_machine_status)
+
+
+# (version, description, migration function(connection)), in ascending version order
+MIGRATIONS = [
+    (1, 'time-leading (resolution, t_epoch) indexes of aggregate tables', _time_indexes),
+    (2, 'first_seen/last_seen of dimension tables', _dimension_seen),
+    (3, 'dimension values of existing key_0 aggregates', _dimension_backfill),
+]
+
+
+def current_version(conn):
+    """ returns version of the most recent applied migration (0 if none) """
+    ag_schema.t_schema_version.create(bind=conn, checkfirst=True)
+    version = conn.execute(select([func.max(ag_schema.t_schema_version.c.version)])).scalar()
+    return version or 0
+
+
+def migrate(engine):
+    """ applies all pending migrations. returns list of the applied versions """
+    applied = list()
+    conn = engine.connect()
+    try:
+        version = current_version(conn)
+        for v, description, migration in MIGRATIONS:
+            if v <= version:
+                continue
+            log.info("Applying schema migration %d: %s" % (v, description))
+            trans = conn.begin()
+            try:
+                migration(conn)
+                conn.execute(ag_schema.t_schema_version.insert(), version=v,
+                    description=description, applied=datetime.utcnow())
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+            applied.append(v)
+    finally:
+        conn.close()
+
+    if applied:
+        log.info("Schema of SGAS cache migrated to version %d" % applied[-1])
+    return applied
+
+
+def verify(engine):
+    """ returns names of the expected indexes, which are missing """
+    missing = list()
+    conn = engine.connect()
+    try:
+        for index in ag_schema.TIME_INDEXES:
+            if index.name not in _index_names(conn, index.table):
+                missing.append(index.name)
+    finally:
+        conn.close()
+
+    for name in missing:
+        log.warn("Index %s is missing" % name)
+    return missing
@@ -0,0 +1,206 @@
+"""
+Time partitioning of the aggregate tables of the SGAS cache (MySQL only).
+
+The aggregate tables are partitioned by RANGE COLUMNS(resolution, t_epoch),
+with one partition per resolution and month:
+
+    p<resolution>_<YYYYMM>  VALUES LESS THAN (<resolution>, <start of next month>)
+    ...
+    p<resolution>_max       VALUES LESS THAN (<resolution>, MAXVALUE)
+    ...
+    pmax                    VALUES LESS THAN (MAXVALUE, MAXVALUE)
+
+The 'p<resolution>_max' partitions catch everything beyond the last month of a
+resolution. Upcoming months are split off them in advance by maintain().
+
+Whole partitions within a time range, which gets deleted, can be truncated
+instead of deleting their rows one by one (see covered() and expired()).
+Beware, MySQL commits implicitly on TRUNCATE PARTITION. Hence, partitions
+are only truncated by the purging of old aggregates (see
+BulkWriter.delete_range()), which doesn't rely on the transaction. Rebuilds
+(i.e. all ingests) delete the rows.
+
+Other databases are not supported (e.g. PostgreSQL would require recreating
+the tables as partitioned tables), the aggregates are kept unpartitioned.
+"""
+
+import time
+import calendar
+import logging
+from datetime import datetime
+
+from sqlalchemy import select, func, text
+
+from sgasaggregator.sgascache import ag_schema
+
+MAXVALUE = 'MAXVALUE'
+
+
+def next_month(t_epoch):
+    """ returns epoch of the start of the month (UTC) after the one of t_epoch """
+    t = datetime.utcfromtimestamp(t_epoch)
+    if t.month == 12:
+        return calendar.timegm((t.year + 1, 1, 1, 0, 0, 0))
+    return calendar.timegm((t.year, t.month + 1, 1, 0, 0, 0))
+
+
+class PartitionManager(object):
+    """ Creates and maintains the monthly partitions of the aggregate tables. """
+
+    def __init__(self, engine, months_ahead=2):
+        self.log = logging.getLogger(__name__)
+        self.engine = engine
+        self.months_ahead = months_ahead
+        self.bounds = dict()  # table name -> list of (partition, resolution, bound)
+
+        self.supported = engine.dialect.name == 'mysql'
+        if not self.supported:
+            self.log.warn("Partitioning of '%s' databases is not supported" % engine.dialect.name)
+
+    def _partition_name(self, resolution, bound):
+        """ name of the partition of the month before bound """
+        t = datetime.utcfromtimestamp(bound - 1)
+        return 'p%d_%04d%02d' % (resolution, t.year, t.month)
+
+    def _definition(self, name, resolution, bound):
+        return 'PARTITION %s VALUES LESS THAN (%s, %s)' % (name, resolution, bound)
+
+    def _month_partitions(self, resolution, t_from, t_to):
+        """ returns definitions of the monthly partitions of resolution from
+            the month of t_from up to (and including) the month of t_to
+        """
+        definitions = list()
+        bound = next_month(t_from)
+        while bound <= next_month(t_to):
+            definitions.append(self._definition(self._partition_name(resolution, bound),
+                resolution, bound))
+            bound = next_month(bound)
+        return definitions
+
+    def _table_name(self, table):
+        return self.engine.dialect.identifier_preparer.format_table(table)
+
+    def partitions(self, conn, table):
+        """ returns list of (partition, resolution, bound) of table, ordered as
+            defined. MAXVALUE bounds are returned as None. The list is empty
+            if the table is not partitioned.
+        """
+        parts = list()
+        for row in conn.execute(text("SELECT PARTITION_NAME, PARTITION_DESCRIPTION "
+                "FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() "
+                "AND TABLE_NAME = :table ORDER BY PARTITION_ORDINAL_POSITION"),
+                table=table.name):
+            if not row[0]:  # not partitioned
+                continue
+            values = [v.strip() for v in row[1].split(',')]
+            resolution, bound = [v != MAXVALUE and int(v) or None for v in values]
+            parts.append((row[0], resolution, bound))
+        self.bounds[table.name] = parts
+        return parts
+
+    def partition_table(self, conn, table, resolutions):
+        """ partitions the (not yet partitioned) table by resolutions and months """
+        now = int(time.time())
+        t_to = now + self.months_ahead * 31 * 86400
+
+        definitions = list()
+        for resolution in sorted(resolutions):
+            t_from = conn.execute(select([func.min(table.c.t_epoch)],
+                table.c.resolution == resolution)).scalar() or now
+            definitions += self._month_partitions(resolution, t_from, t_to)
+            definitions.append('PARTITION p%d_max VALUES LESS THAN (%d, MAXVALUE)' % \
+                (resolution, resolution))
+        definitions.append('PARTITION pmax VALUES LESS THAN (MAXVALUE, MAXVALUE)')
+
+        self.log.info("Partitioning %s into %d partitions" % (table.name, len(definitions)))
+        conn.execute('ALTER TABLE %s PARTITION BY RANGE COLUMNS(resolution, t_epoch) (%s)' % \
+            (self._table_name(table), ', '.join(definitions)))
+
+    def add_partitions(self, conn, table, resolutions, parts):
+        """ adds the partitions of the upcoming months (and of new resolutions) """
+        t_to = int(time.time()) + self.months_ahead * 31 * 86400
+
+        for resolution in sorted(resolutions):
+            bounds = [b for p, r, b in parts if r == resolution and b]
+            if bounds:
+                if next_month(t_to) <= bounds[-1]:
+                    continue  # upcoming months exist already
+                split = 'p%d_max' % resolution
+                definitions = self._month_partitions(resolution, bounds[-1], t_to)
+                definitions.append('PARTITION %s VALUES LESS THAN (%d, MAXVALUE)' % \
+                    (split, resolution))
+            else:  # new resolution, split off the partition following it
+                split, r, b = [(p, r, b) for p, r, b in parts if r is None or r > resolution][0]
+                definitions = self._month_partitions(resolution, int(time.time()), t_to)
+                definitions.append('PARTITION p%d_max VALUES LESS THAN (%d, MAXVALUE)' % \
+                    (resolution, resolution))
+                definitions.append('PARTITION %s VALUES LESS THAN (%s, %s)' % (split,
+                    r or MAXVALUE, b or MAXVALUE))
+
+            self.log.info("Reorganizing partition %s of %s into %d partitions" % \
+                (split, table.name, len(definitions)))
+            conn.execute('ALTER TABLE %s REORGANIZE PARTITION %s INTO (%s)' % \
+                (self._table_name(table), split, ', '.join(definitions)))
+            parts = self.partitions(conn, table)
+
+    def maintain(self, resolutions):
+        """ partitions the aggregate tables (if not yet done) and adds the
+            partitions of upcoming months.
+        """
+        if not self.supported:
+            return
+
+        conn = self.engine.connect()
+        try:
+            for table in ag_schema.AGGREGATE_TABLES:
+                parts = self.partitions(conn, table)
+                if not parts:
+                    self.partition_table(conn, table, resolutions)
+                else:
+                    self.add_partitions(conn, table, resolutions, parts)
+                self.partitions(conn, table)
+        finally:
+            conn.close()
+
+    def covered(self, table, resolution, t_start_epoch, t_end_epoch=None):
+        """ returns names of the partitions of table, which hold only aggregates
+            of resolution with a t_epoch within [t_start_epoch, t_end_epoch)
+            (t_end_epoch None means open end).
+        """
+        names = list()
+        lower = None  # lower bound of partition (if of same resolution)
+        for name, r, bound in self.bounds.get(table.name, []):
+            if r != resolution:
+                lower = None
+                continue
+            if lower is not None and lower >= t_start_epoch:
+                if bound is None and t_end_epoch is None:
+                    names.append(name)
+                elif bound is not None and (t_end_epoch is None or bound <= t_end_epoch):
+                    names.append(name)
+            lower = bound
+        return names
+
+    def expired(self, table, resolution, t_epoch):
+        """ returns list of (partition, lower bound, bound) of the partitions
+            of table, which hold only aggregates of resolution with a t_epoch
+            before t_epoch, ordered by time.
+        """
+        parts = list()
+        lower = None  # lower bound of partition (if of same resolution)
+        for name, r, bound in self.bounds.get(table.name, []):
+            if r != resolution:
+                lower = None
+                continue
+            if bound is None or bound > t_epoch:
+                break
+            if lower is not None:
+                parts.append((name, lower, bound))
+            lower = bound
+        return parts
+
+    def truncate(self, session, table, names):
+        """ truncates the partitions (names) of table. Implicitly commits. """
+        session.execute('ALTER TABLE %s TRUNCATE PARTITION %s' % \
+            (self._table_name(table), ', '.join(names)))
+        self.log.debug("Truncated partitions %s of %s" % (', '.join(names), table.name))
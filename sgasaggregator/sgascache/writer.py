@@ -0,0 +1,169 @@
+"""
+Bulk writer for the aggregates of the SGAS cache.
+
+Instead of adding every aggregate as object to the session (which results in
+one INSERT statement per object and in the tracking of every object by the
+session), the aggregates are passed as dictionaries (column name -> value)
+and written in batches. Supported write methods are:
+
+executemany: one INSERT statement, executed with a batch of parameter sets
+multirow:    one INSERT statement with multiple VALUES rows per batch
+native:      bulk loading of the database, i.e. COPY FROM STDIN (PostgreSQL)
+             or LOAD DATA LOCAL INFILE (MySQL, requires 'local_infile=1' in
+             the database URL). Falls back to 'executemany' for other
+             databases.
+
+Time ranges of aggregates get replaced by a plain DELETE statement followed
+by the bulk write (see replace_range()). The rows are deleted and written
+within the transaction of the session, i.e. they still need to be committed.
+
+Deleting a time range may truncate whole partitions instead (see
+sgascache.partitions), but only if the caller asks for it ('truncate').
+MySQL commits implicitly on TRUNCATE PARTITION, hence this is only done by
+callers, which don't replace the range within a single transaction anyway
+(e.g. purging of old aggregates).
+"""
+
+import os, logging, tempfile
+from cStringIO import StringIO
+
+from sqlalchemy import and_, text
+
+WRITE_METHODS = ['executemany', 'multirow', 'native']
+
+BATCH_SIZE = 1000  # default number of rows per batch
+
+
+def _copy_value(value):
+    """ returns value in the (tab delimited) text format of COPY and
+        LOAD DATA INFILE
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class BulkWriter(object):
+    """ Writes aggregates in batches, using the configured write method. """
+
+    def __init__(self, method='executemany', batch_size=BATCH_SIZE):
+        self.log = logging.getLogger(__name__)
+
+        if method not in WRITE_METHODS:
+            self.log.warn("Unknown write method '%s', using 'executemany'" % method)
+            method = 'executemany'
+        self.method = method
+        self.batch_size = batch_size
+        self.partitions = None  # PartitionManager, if tables are partitioned
+
+    def write(self, session, table, rows):
+        """ writes the rows (list of dictionaries) into table, within the
+            transaction of session. returns number of written rows.
+        """
+        if not rows:
+            return 0
+
+        method = self.method
+        dialect = session.bind.dialect
+        if method == 'native' and dialect.name not in ('postgresql', 'mysql'):
+            method = 'executemany'
+
+        for i in range(0, len(rows), self.batch_size):
+            batch = rows[i:i + self.batch_size]
+            if method == 'multirow':
+                self._write_multirow(session, table, batch)
+            elif method == 'native' and dialect.name == 'postgresql':
+                self._write_copy(session, table, batch)
+            elif method == 'native':
+                self._write_infile(session, table, batch)
+            else:
+                session.execute(table.insert(), batch)
+
+        self.log.debug("Wrote %d rows into %s (%s)." % (len(rows), table.name, method))
+        return len(rows)
+
+    def delete_range(self, session, table, resolution, t_start_epoch, t_end_epoch=None,
+            truncate=False):
+        """ deletes the rows of table with given resolution and a t_epoch
+            within [t_start_epoch, t_end_epoch) by a single DELETE statement,
+            i.e. the keys of the deleted rows are not fetched first. If
+            t_end_epoch is not set, all rows from t_start_epoch on are deleted.
+            If truncate is set, partitions, which lie completely within the
+            range, get truncated (which implicitly commits the transaction
+            of session). returns number of deleted rows.
+        """
+        if truncate and self.partitions is not None:
+            names = self.partitions.covered(table, resolution, t_start_epoch, t_end_epoch)
+            if names:
+                self.partitions.truncate(session, table, names)
+
+        where = and_(table.c.resolution == resolution, table.c.t_epoch >= t_start_epoch)
+        if t_end_epoch:
+            where = and_(where, table.c.t_epoch < t_end_epoch)
+        return session.execute(table.delete(where)).rowcount
+
+    def replace_range(self, session, table, resolution, t_start_epoch, t_end_epoch, rows):
+        """ replaces the rows of table within the range (see delete_range())
+            by the new rows, within the transaction of session (i.e.
+            partitions are never truncated). returns number of deleted rows.
+        """
+        n = self.delete_range(session, table, resolution, t_start_epoch, t_end_epoch)
+        self.write(session, table, rows)
+        return n
+
+    def _names(self, session, table):
+        """ returns quoted table name and list of quoted column names """
+        preparer = session.bind.dialect.identifier_preparer
+        return preparer.format_table(table), [preparer.format_column(c) for c in table.columns]
+
+    def _write_multirow(self, session, table, batch):
+        name, columns = self._names(session, table)
+
+        params = dict()
+        values = list()
+        for i, row in enumerate(batch):
+            names = list()
+            for c in table.columns:
+                params['%s_%d' % (c.name, i)] = row.get(c.name)
+                names.append(':%s_%d' % (c.name, i))
+            values.append('(%s)' % ', '.join(names))
+
+        session.execute(text('INSERT INTO %s (%s) VALUES %s' % \
+            (name, ', '.join(columns), ', '.join(values))), params)
+
+    def _copy_data(self, table, batch):
+        data = StringIO()
+        for row in batch:
+            data.write('\t'.join([_copy_value(row.get(c.name)) for c in table.columns]))
+            data.write('\n')
+        data.seek(0)
+        return data
+
+    def _write_copy(self, session, table, batch):
+        name, columns = self._names(session, table)
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.copy_expert('COPY %s (%s) FROM STDIN' % (name, ', '.join(columns)),
+                self._copy_data(table, batch))
+        finally:
+            cursor.close()
+
+    def _write_infile(self, session, table, batch):
+        name, columns = self._names(session, table)
+
+        fd, path = tempfile.mkstemp(prefix='sgas_aggregator_')
+        try:
+            os.write(fd, self._copy_data(table, batch).getvalue())
+            os.close(fd)
+            cursor = session.connection().connection.cursor()
+            try:
+                cursor.execute("LOAD DATA LOCAL INFILE %%s INTO TABLE %s (%s)" % \
+                    (name, ', '.join(columns)), (path,))
+            finally:
+                cursor.close()
+        finally:
+            os.remove(path)
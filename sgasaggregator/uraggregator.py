@@ -5,14 +5,29 @@ Module for aggregation of SGAS Usage records
 # last modification: bug-fix 12.12.11 PF
 
 import time, logging, calendar
+import traceback
+import multiprocessing
 from datetime import datetime
 
 from sqlalchemy import and_ as AND
+from sqlalchemy import or_ as OR
+from sqlalchemy import select, case, extract, func, text
+from sqlalchemy import create_engine
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.exc import IntegrityError
 
 from sgasaggregator.sgas import sgas_schema
 from sgasaggregator.sgas import session as sgas_session
 from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import writer
+from sgasaggregator.sgascache import dimensions
+from sgasaggregator.sgascache import partitions
 from sgasaggregator.sgascache import session as sgascache_session
+from sgasaggregator.utils import vectorized
+from sgasaggregator.utils import cache
+from sgasaggregator import scheduler
+from sgasaggregator import pipeline
+from sgasaggregator import dbinit
 
 
 
@@ -56,6 +71,33 @@ KEY2ORM_MAP = {
     'key_0411' : 'Machine'
 }
 
+# parent to child aggregation of the keys, in processing order
+KEY_LATTICE = [
+    ('key_0',   'key_01'),
+    ('key_0',   'key_02'),
+    ('key_0',   'key_03'),
+    ('key_0',   'key_04'),
+    ('key_01',  'key_011'),
+    ('key_01',  'key_012'),
+    ('key_02',  'key_021'),
+    ('key_03',  'key_031'),
+    ('key_03',  'key_032'),
+    ('key_04',  'key_041'),
+    ('key_021', 'key_0211'),
+    ('key_031', 'key_0311'),
+    ('key_032', 'key_0321'),
+    ('key_041', 'key_0411')
+]
+
+# all keys in processing order
+KEY_ORDER = ['key_0'] + [key_out for key_in, key_out in KEY_LATTICE]
+
+# parent and depth (within the lattice) of the keys
+KEY_PARENT = dict([(key_out, key_in) for key_in, key_out in KEY_LATTICE])
+KEY_DEPTH = {'key_0': 0}
+for key_in, key_out in KEY_LATTICE:
+    KEY_DEPTH[key_out] = KEY_DEPTH[key_in] + 1
+
 # the values we aggregate within key_0 - key_0411 databases
 AGGREGATE_VALUES = {
     'n_jobs'            : 0,
@@ -66,6 +108,75 @@ AGGREGATE_VALUES = {
     'major_page_faults' : 0
 }
 
+# name of the SGAS source in the ingest watermark table
+WATERMARK_SOURCE = 'sgas'
+
+# the ingest watermark only moves up to records inserted at least SAFETY_LAG
+# [secs] ago, as records of transactions still open may commit later with an
+# older insert_time (and NTP time drifts)
+SAFETY_LAG = 300
+
+# columns of the SGAS usage records, which are needed for the aggregation
+RAW_COLUMNS = [ 'global_user_name', 'vo_type', 'vo_name', 'machine_name', 'status',
+    'cpu_duration', 'wall_duration', 'user_time', 'kernel_time', 'major_page_faults']
+
+# order of the aggregated values within in-memory rows
+AGGREGATE_KEYS = sorted(AGGREGATE_VALUES.keys())
+
+# number of raw SGAS records read at once (default and hard upper limit),
+# which bounds the memory used for the raw records of a resolution window
+RAW_BATCH_SIZE = 5000
+RAW_BATCH_SIZE_MAX = 50000
+
+# number of time shards per ingest worker process
+SHARDS_PER_WORKER = 4
+
+# time window [secs] of SGAS records read at once by the pipelined ingest
+PIPELINE_WINDOW = 7 * 86400
+
+# aggregator of an ingest worker process (see _init_ingest_worker())
+_ingest_worker = None
+
+
+def upsert_supported(engine):
+    """ returns True if the database of engine supports the upserts of the
+        incremental aggregation mode (MySQL, PostgreSQL >= 9.5, sqlite >= 3.24)
+    """
+    dialect = engine.dialect
+    if dialect.name == 'mysql':
+        return True
+    if dialect.name == 'postgresql':
+        if dialect.server_version_info is None:  # set on first connect
+            engine.connect().close()
+        return dialect.server_version_info >= (9, 5)
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 24)
+    return False
+
+
+def _init_ingest_worker(sgas_url, ingest_mode, raw_batch_size):
+    """ initializes an ingest worker process, with its own engine to the
+        SGAS database.
+    """
+    global _ingest_worker
+    dbinit.init_model(sgas_session, create_engine(sgas_url))
+    _ingest_worker = UrAggregator(0, ingest_mode, raw_batch_size)
+
+
+def _ingest_shard(shard):
+    """ returns in-memory key_0 rows of the time shard (t_start_epoch,
+        t_end_epoch, resolution), run by the ingest worker processes.
+    """
+    t_start_epoch, t_end_epoch, resolution = shard
+    try:
+        try:
+            return _ingest_worker._key0_rows(t_start_epoch, t_end_epoch, resolution)
+        except Exception:
+            # exceptions of the database drivers can't be passed back always
+            raise RuntimeError(traceback.format_exc())
+    finally:
+        sgas_session.Session.remove()
+
 
 class UrAggregator(object):
 
@@ -77,15 +188,62 @@ class UrAggregator(object):
     records.
     """
 
-    def __init__(self, refresh_days_back):
+    def __init__(self, refresh_days_back, ingest_mode='orm', raw_batch_size=RAW_BATCH_SIZE,
+            source=WATERMARK_SOURCE, aggregation_mode='rebuild', reconcile_interval=0,
+            reconcile_days_back=28, lattice_engine='db', aggregation_backend='python',
+            write_method='executemany', write_batch_size=writer.BATCH_SIZE,
+            partitioning=False, partitions_ahead=2, lattice_workers=1, ingest_workers=1,
+            pipeline_depth=0, safety_lag=SAFETY_LAG):
         self.log = logging.getLogger( __name__)
 
         now_epoch = int(time.time())
         secs_back = 86400 * refresh_days_back
 
+        # only used if there is no ingest watermark yet (very first run)
         self.last_aggregation_time_epoch = now_epoch - (now_epoch % 86400) - secs_back
 
         self.refresh_days_back = refresh_days_back
+        self.source = source
+        self.safety_lag = safety_lag
+
+        self.aggregation_mode = aggregation_mode
+        self.reconcile_interval = reconcile_interval
+        self.reconcile_days_back = reconcile_days_back
+        self.last_reconcile_time_epoch = now_epoch
+
+        self.lattice_engine = lattice_engine
+        self.lattice_workers = lattice_workers
+
+        if aggregation_backend == 'numpy' and not vectorized.available():
+            self.log.warn("NumPy is not available, using 'python' aggregation backend")
+            aggregation_backend = 'python'
+        if aggregation_backend == 'numpy' and lattice_engine != 'memory':
+            # only the in-memory lattice rollup uses the vectorized kernel
+            self.log.warn("The 'numpy' aggregation backend requires lattice_engine 'memory', " \
+                "using 'python' aggregation backend")
+            aggregation_backend = 'python'
+        self.aggregation_backend = aggregation_backend
+        self.ingest_mode = ingest_mode
+        self.ingest_workers = ingest_workers
+        self.pipeline_depth = pipeline_depth  # windows read ahead, 0 disables pipelining
+
+        if raw_batch_size > RAW_BATCH_SIZE_MAX:
+            self.log.warn("Raw batch size %d exceeds limit, setting it to %d" % \
+                (raw_batch_size, RAW_BATCH_SIZE_MAX))
+            raw_batch_size = RAW_BATCH_SIZE_MAX
+        self.raw_batch_size = raw_batch_size
+
+        self.writer = writer.BulkWriter(write_method, write_batch_size)
+        self.dimensions = dimensions.DimensionCache()
+
+        self.retention = None  # RetentionPolicy, if aggregates get purged
+        self.work_queue = None  # WorkQueue, if shared with other daemons
+        self.cumulative = None  # CumulativeTotals, if running totals are maintained
+
+        self.partitions = None
+        if partitioning:
+            self.partitions = partitions.PartitionManager(sgascache_session.engine, partitions_ahead)
+            self.writer.partitions = self.partitions
 
     
     def _get_vo_name(self, vo_type, vo_string):
@@ -105,9 +263,149 @@ class UrAggregator(object):
             return ''
 
 
-            
+    def _get_vo_name_expr(self):
+        """ SQL counterpart of _get_vo_name(), i.e. the VO name gets
+            evaluated by the SGAS database (as a CASE expression).
+        """
+        ur = sgas_schema.t_usagerecords.c
+
+        return case([
+            (OR(ur.vo_name == None, ur.vo_name == ''), ''),
+            (ur.vo_type.in_(['voms','grid-vo-map/vomss']), ur.vo_name),
+            (func.strpos(ur.vo_name, '.') > 0, func.split_part(ur.vo_name, '.', 1))],
+            else_ = '')
+
+
+    def _bucket_expr(self, t_start_utc, resolution):
+        """ SQL expression of the (0-based) index of the resolution bucket,
+            into which a SGAS record falls by its end_time. Buckets are
+            counted from t_start_utc on.
+        """
+        ur = sgas_schema.t_usagerecords.c
+        return func.floor(extract('epoch', ur.end_time - t_start_utc) / resolution)
+
+
+    def _dirty_buckets(self, new_recs, resolution):
+        """ returns the sorted start times (epoch) of the resolution buckets,
+            which hold any of the records selected by new_recs.
+        """
+        bucket = self._bucket_expr(datetime.utcfromtimestamp(0), resolution)
+
+        buckets = list()
+        for row in sgas_session.Session.query(bucket.label('bucket')).filter(new_recs).distinct():
+            if row.bucket is not None:
+                buckets.append(int(row.bucket) * resolution)
+        buckets.sort()
+        return buckets
+
+
+    def _bucket_runs(self, buckets, resolution):
+        """ merges sorted bucket start times into runs of adjacent buckets.
+            returns list of (t_start_epoch, t_end_epoch), t_end_epoch excluded.
+        """
+        runs = list()
+        for t in buckets:
+            if runs and runs[-1][1] == t:
+                runs[-1][1] = t + resolution
+            else:
+                runs.append([t, t + resolution])
+        return [(t_start, t_end) for t_start, t_end in runs]
 
-    def raw2key0_aggregate(self, t_start_epoch, resolution):
+
+    def _load_watermark(self):
+        """ returns the persisted ingest watermark of our source, or a new
+            (not yet persisted) one if there is none yet.
+        """
+        wm = sgascache_session.Session.query(ag_schema.IngestWatermark).get(self.source)
+        if not wm:
+            wm = ag_schema.IngestWatermark(self.source)
+        return wm
+
+
+    def _store_watermark(self, wm, insert_time, record_id):
+        """ moves ingest watermark to (insert_time, record_id) and commits it """
+        wm.insert_time = insert_time
+        wm.record_id = record_id
+
+        session = sgascache_session.Session()
+        session.add(wm)
+        session.commit()
+
+
+    def _new_records_filter(self, wm):
+        """ returns filter for the SGAS records inserted after the watermark.
+            Without watermark the records inserted since the last
+            'refresh_days_back' days are considered as new.
+        """
+        UR = sgas_schema.UsageRecords
+
+        if wm.insert_time is None:
+            return UR.insert_time >= datetime.utcfromtimestamp(self.last_aggregation_time_epoch)
+
+        return OR(UR.insert_time > wm.insert_time,
+                AND(UR.insert_time == wm.insert_time, UR.record_id > wm.record_id))
+
+
+    def _last_record(self, new_recs):
+        """ returns (insert_time, record_id) of the newest of the SGAS records
+            selected by new_recs, which got inserted at least 'safety_lag'
+            secs ago, or None if there is none. Younger records are left for
+            the next run.
+        """
+        UR = sgas_schema.UsageRecords
+        t_safe_utc = datetime.utcfromtimestamp(int(time.time()) - self.safety_lag)
+
+        return sgas_session.Session.query(UR.insert_time, UR.record_id).filter(AND(new_recs,
+                UR.insert_time < t_safe_utc)).\
+            order_by(UR.insert_time.desc(), UR.record_id.desc()).first()
+
+
+    def _upto_filter(self, insert_time, record_id):
+        """ returns filter for the SGAS records inserted up to (and including)
+            the record (insert_time, record_id), i.e. up to a watermark.
+        """
+        UR = sgas_schema.UsageRecords
+
+        return OR(UR.insert_time < insert_time,
+                AND(UR.insert_time == insert_time, UR.record_id <= record_id))
+
+
+    def _iter_raw_batches(self, t_start_utc, t_end_utc, where=None):
+        """ Generator over the SGAS usage records with an end_time within
+            [t_start_utc, t_end_utc]. The records are yielded in batches of at
+            most raw_batch_size records, which are read by keyset pagination
+            on (end_time, record_id). Hence, the memory needed does not grow
+            with the number of records of the time interval.
+            Only the RAW_COLUMNS (plus end_time and record_id) are selected,
+            the records are plain (named) tuples and not UsageRecords objects.
+            where: optional, further filter on the records
+        """
+        UR = sgas_schema.UsageRecords
+        columns = [getattr(UR, c) for c in RAW_COLUMNS] + [UR.end_time, UR.record_id]
+        last = None
+
+        while True:
+            query = sgas_session.Session.query(*columns).filter(AND(
+                        UR.end_time >= t_start_utc,
+                        UR.end_time <= t_end_utc))
+            if where is not None:
+                query = query.filter(where)
+            if last:
+                query = query.filter(OR(UR.end_time > last[0],
+                        AND(UR.end_time == last[0], UR.record_id > last[1])))
+
+            batch = query.order_by(UR.end_time, UR.record_id).limit(self.raw_batch_size).all()
+            if not batch:
+                break
+
+            last = (batch[-1].end_time, batch[-1].record_id)
+            yield batch
+
+            if len(batch) < self.raw_batch_size:
+                break
+
+
+    def raw2key0_aggregate(self, t_start_epoch, resolution, t_end_epoch=None, where=None):
         """
         creates the very first aggregate, which will be used afterwards to
         create the subsequent onces. The input is the SGAS usagedata table.
@@ -116,20 +414,23 @@ class UrAggregator(object):
 
         start_t_epoch : starting time in epoch for database records, which will be read
         resolution    : resolution of the aggregate.
+        t_end_epoch   : end time (excluded) in epoch, must match sampling resolution
+                        as well. If not set, records are aggregated up to now.
+        where         : optional, further filter on the SGAS records
         """
+        if not t_end_epoch:
+            t_end_epoch = int(time.time())
+            t_end_epoch += (t_start_epoch - t_end_epoch) % resolution
 
         # just to make sure (in case of time shifts)
-        n = sgascache_session.Session.query(ag_schema.UserVoMachineStatus).filter(AND(
-            ag_schema.UserVoMachineStatus.t_epoch >= t_start_epoch,
-            ag_schema.UserVoMachineStatus.resolution == resolution)) \
-                .delete(synchronize_session='fetch')
+        n = self.writer.delete_range(sgascache_session.Session(), self._table('key_0'),
+            resolution, t_start_epoch, t_end_epoch)
 
         self.log.info('Removed %d old records from UserVomachineStatus before repopulation.' % n)
             
         t = t_start_epoch
-        now_epoch = int(time.time())
 
-        while t < now_epoch:
+        while t < t_end_epoch:
             t_start_utc = datetime.utcfromtimestamp(t)
             t += resolution
             t_end_utc = datetime.utcfromtimestamp(t-1)
@@ -138,38 +439,34 @@ class UrAggregator(object):
             self.log.debug("Raw records aggregation from %s --  %s" % (t_start_utc, t_end_utc))
 
             ag_recs = dict()
-            # XXX maybe we still need to prevent to read too many records at once
-            # (e.g. with a loop over some LIMIT query)
-            for rec in sgas_session.Session.query(sgas_schema.UsageRecords).filter(AND(
-                        sgas_schema.UsageRecords.end_time >= t_start_utc,
-                        sgas_schema.UsageRecords.end_time <= t_end_utc)).all():
-
-                n_raw += 1 
-                gun = rec.global_user_name
-                von = self._get_vo_name(rec.vo_type, rec.vo_name)
-                if not von:
-                    von = ''
-                mn  = rec.machine_name
-                status = rec.status
-
-                key = "%s-%s-%s-%s-%f" % (gun, von, mn, status, t-1)
-
-                if not ag_recs.has_key(key):  # t -1 is the real end time of aggregate
-                    aggr = ag_schema.UserVoMachineStatus(gun, von, mn, status, resolution, t-1)
-                    for k, v in AGGREGATE_VALUES.items():
-                        exec('aggr.%s = %d' % (k, v))
-                    ag_recs[key] = aggr
-                else:
-                    aggr = ag_recs[key]
-
-                for k in AGGREGATE_VALUES.keys(): # aggregation of values
-                    if k == 'n_jobs':
-                        aggr.n_jobs += 1
+            for batch in self._iter_raw_batches(t_start_utc, t_end_utc, where):
+                for rec in batch:
+                    n_raw += 1 
+                    gun = rec.global_user_name
+                    von = self._get_vo_name(rec.vo_type, rec.vo_name)
+                    if not von:
+                        von = ''
+                    mn  = rec.machine_name
+                    status = rec.status
+
+                    key = "%s-%s-%s-%s-%f" % (gun, von, mn, status, t-1)
+
+                    if not ag_recs.has_key(key):  # t -1 is the real end time of aggregate
+                        aggr = ag_schema.UserVoMachineStatus(gun, von, mn, status, resolution, t-1)
+                        for k, v in AGGREGATE_VALUES.items():
+                            exec('aggr.%s = %d' % (k, v))
+                        ag_recs[key] = aggr
                     else:
-                        val = eval('rec.%s' % k)
-                        if not val:
-                            val = 0
-                        exec('aggr.%s +=  val' % (k))
+                        aggr = ag_recs[key]
+
+                    for k in AGGREGATE_VALUES.keys(): # aggregation of values
+                        if k == 'n_jobs':
+                            aggr.n_jobs += 1
+                        else:
+                            val = eval('rec.%s' % k)
+                            if not val:
+                                val = 0
+                            exec('aggr.%s +=  val' % (k))
 
             
             self.log.debug("Got %d raw records" % n_raw)
@@ -178,14 +475,101 @@ class UrAggregator(object):
 
             if ag_recs:  # writing to database
                 session  = sgascache_session.Session()
-                for nrec in ag_recs.values():
-                    session.add(nrec)
+                self._write_objects(session, 'key_0', ag_recs.values())
                 session.commit()
 
             self.log.debug("Commited them successfully to UserVoMachineStatus db")
 
 
-    def res_aggregation(self, key_in, t_start_epoch, from_resolution, factor):
+    def _grouped_raw_query(self, where, t_start_utc, resolution):
+        """ returns query, which groups the SGAS records selected by 'where'
+            by key_0 and resolution bucket (counted from t_start_utc on).
+            The rows hold the key_0 columns, the 'bucket' index and the
+            AGGREGATE_VALUES.
+        """
+        ur = sgas_schema.t_usagerecords.c
+        bucket = self._bucket_expr(t_start_utc, resolution)
+
+        columns = [ur.global_user_name, self._get_vo_name_expr().label('vo_name'),
+                ur.machine_name, ur.status, bucket.label('bucket')]
+        for k in AGGREGATE_VALUES.keys():
+            if k != 'n_jobs':
+                columns.append(ur[k])
+
+        raw = select(columns, where).alias('raw')
+
+        columns = [raw.c.global_user_name, raw.c.vo_name, raw.c.machine_name,
+                raw.c.status, raw.c.bucket]
+        for k in AGGREGATE_VALUES.keys():
+            if k == 'n_jobs':
+                columns.append(func.count().label(k))
+            else:
+                columns.append(func.coalesce(func.sum(raw.c[k]), 0).label(k))
+
+        return select(columns, group_by = [raw.c.global_user_name, raw.c.vo_name,
+                raw.c.machine_name, raw.c.status, raw.c.bucket])
+
+
+    def raw2key0_aggregate_grouped(self, t_start_epoch, resolution, t_end_epoch=None, where=None):
+        """
+        same as raw2key0_aggregate(), but the summing up of the usage records
+        is pushed down to the SGAS database. A single GROUP BY query is issued
+        for the whole time range, the records are put into their resolution
+        bucket by end_time arithmetic. Hence, only the aggregated rows (and
+        not the usage records) are passed over the wire.
+        Warning: t_start_epoch time MUST match sampling resolution. We don't
+                 fix the time in this method, if it's shifted.
+
+        start_t_epoch : starting time in epoch for database records, which will be read
+        resolution    : resolution of the aggregate.
+        t_end_epoch   : end time (excluded) in epoch, must match sampling resolution
+                        as well. If not set, records are aggregated up to now.
+        where         : optional, further filter on the SGAS records
+        """
+        if not t_end_epoch:
+            t_end_epoch = int(time.time())
+            t_end_epoch += (t_start_epoch - t_end_epoch) % resolution
+
+        # just to make sure (in case of time shifts)
+        n = self.writer.delete_range(sgascache_session.Session(), self._table('key_0'),
+            resolution, t_start_epoch, t_end_epoch)
+
+        self.log.info('Removed %d old records from UserVomachineStatus before repopulation.' % n)
+
+        t_start_utc = datetime.utcfromtimestamp(t_start_epoch)
+        t_end_utc = datetime.utcfromtimestamp(t_end_epoch)
+
+        self.log.debug("Grouped raw records aggregation from %s --  %s" % (t_start_utc, t_end_utc))
+
+        ur = sgas_schema.t_usagerecords.c
+        t_filter = AND(ur.end_time >= t_start_utc, ur.end_time < t_end_utc)
+        if where is not None:
+            t_filter = AND(t_filter, where)
+        query = self._grouped_raw_query(t_filter, t_start_utc, resolution)
+
+        ag_recs = list()
+        n_raw = 0
+        for row in sgas_session.Session.execute(query):
+            t_epoch = t_start_epoch + (int(row.bucket) + 1) * resolution - 1
+            aggr = ag_schema.UserVoMachineStatus(row.global_user_name, row.vo_name,
+                    row.machine_name, row.status, resolution, t_epoch)
+            for k in AGGREGATE_VALUES.keys():
+                setattr(aggr, k, int(row[k]))
+            n_raw += aggr.n_jobs
+            ag_recs.append(aggr)
+
+        self.log.debug("Got %d raw records" % n_raw)
+        self.log.debug("Got %d new aggregates (resolution = %d)" % (len(ag_recs), resolution))
+
+        if ag_recs:  # writing to database
+            session  = sgascache_session.Session()
+            self._write_objects(session, 'key_0', ag_recs)
+            session.commit()
+
+        self.log.debug("Commited them successfully to UserVoMachineStatus db")
+
+
+    def res_aggregation(self, key_in, t_start_epoch, from_resolution, factor, t_end_epoch=None):
         """ Aggregates existing aggregate by specified factor.
 
             Warning: t_start_epoch time MUST match sampling resolution. We don't
@@ -195,6 +579,7 @@ class UrAggregator(object):
             t_start_epoch: starting time (epoch)
             from_resolution: init resolution
             factor: factor of output  resolution. Must be > 1
+            t_end_epoch: end time (excluded), if not set till now
         """
 
         db_obj = eval( 'ag_schema.' + KEY2ORM_MAP[key_in])
@@ -212,9 +597,12 @@ class UrAggregator(object):
 
         # remove exiting records from new resolution
         # which are younger then start_
-        n = sgascache_session.Session.query(db_obj).filter(AND(
-            db_t_epoch >= t_start_epoch,
-            db_resolution == resolution)).delete(synchronize_session='fetch')
+        t_filter = db_t_epoch >= t_start_epoch
+        if t_end_epoch:
+            t_filter = AND(t_filter, db_t_epoch < t_end_epoch)
+
+        n = self.writer.delete_range(sgascache_session.Session(), self._table(key_in),
+            resolution, t_start_epoch, t_end_epoch)
 
         self.log.info( 'Removed %d records from %s db before repopulation.' % \
             (n, KEY2ORM_MAP[key_in]))
@@ -222,7 +610,7 @@ class UrAggregator(object):
         ag_recs = dict()
 
         for rec in sgascache_session.Session.query(db_obj).filter( AND (
-                    db_t_epoch >= t_start_epoch,
+                    t_filter,
                     db_resolution ==  from_resolution)).all(): # no chunking as in raw2key_aggregate(...)
 
             ag_t_end_epoch = t_start_epoch + int(rec.t_epoch - t_start_epoch) / \
@@ -250,14 +638,13 @@ class UrAggregator(object):
 
         if ag_recs:  # writing to database
             session  = sgascache_session.Session()
-            for nrec in ag_recs.values():
-                session.add(nrec)
+            self._write_objects(session, key_in, ag_recs.values())
             session.commit()
             self.log.info( 'Commited  %d records to %s (resolution: %d).' % \
              (len(ag_recs.keys()), KEY2ORM_MAP[key_in], resolution))
 
 
-    def key_aggregation(self, key_in, key_out, t_start_epoch, resolution):
+    def key_aggregation(self, key_in, key_out, t_start_epoch, resolution, t_end_epoch=None):
         """
         Aggregation from parent aggregate (key_in) to child (key_out). 
         Warning: t_start_epoch time MUST match sampling resolution. We don't
@@ -266,28 +653,28 @@ class UrAggregator(object):
             key_out: output key, will be mapped to corresponding db
             start_t_epoch: starting time from epoch
             resolution:  time steps/resolution of aggregates. must be an integer > 1
+            t_end_epoch: end time (excluded), if not set till now
         """
         db_obj_in = eval( 'ag_schema.' + KEY2ORM_MAP[key_in])
-        db_obj_out = eval( 'ag_schema.' + KEY2ORM_MAP[key_out])
 
         db_resolution_in = eval( 'ag_schema.' + KEY2ORM_MAP[key_in] + '.resolution')
-        db_resolution_out = eval( 'ag_schema.' + KEY2ORM_MAP[key_out] + '.resolution')
         db_t_epoch_in = eval( 'ag_schema.' + KEY2ORM_MAP[key_in] + '.t_epoch')
-        db_t_epoch_out = eval( 'ag_schema.' + KEY2ORM_MAP[key_out] + '.t_epoch')
 
         self.log.debug("Aggregation of %s to %s" % (KEY2ORM_MAP[key_in], KEY2ORM_MAP[key_out]))
         self.log.debug("Removing existing records from %s  aggregate from UTC time  %s on." %
                 (KEY2ORM_MAP[key_out], datetime.utcfromtimestamp(t_start_epoch)))
 
-        # remove exiting records from out-db (only such from start_t_epoch on
-        n = sgascache_session.Session.query(db_obj_out).filter(AND(
-            db_t_epoch_out >= t_start_epoch,
-            db_resolution_out == resolution)).delete(synchronize_session='fetch')
+        t_filter_in = db_t_epoch_in >= t_start_epoch
+        if t_end_epoch:
+            t_filter_in = AND(t_filter_in, db_t_epoch_in < t_end_epoch)
 
+        # remove exiting records from out-db (only such from start_t_epoch on
+        n = self.writer.delete_range(sgascache_session.Session(), self._table(key_out),
+            resolution, t_start_epoch, t_end_epoch)
 
         ag_recs = dict()
         for rec in sgascache_session.Session.query(db_obj_in).filter( AND (
-                    db_t_epoch_in >= t_start_epoch,
+                    t_filter_in,
                     db_resolution_in == resolution)).all(): # no chunking as in raw2key0_aggregate(...)
 
 
@@ -315,77 +702,825 @@ class UrAggregator(object):
 
         if ag_recs:  # writing to database
             session  = sgascache_session.Session()
-            for nrec in ag_recs.values():
-                session.add(nrec)
+            self._write_objects(session, key_out, ag_recs.values())
             session.commit()
             self.log.info( 'Commited  %d records to %s (resolution: %d).' % \
              (len(ag_recs.keys()), KEY2ORM_MAP[key_out], resolution))
 
 
+    def _table(self, key):
+        """ returns the (mapped) table of key """
+        return class_mapper(eval('ag_schema.' + KEY2ORM_MAP[key])).mapped_table
+
+
+    def _row_params(self, key, resolution, rows):
+        """ returns the in-memory rows of key (see _rollup()) as list of
+            dictionaries (column name -> value).
+        """
+        n = len(KEY_MAPS[key])
+
+        params = list()
+        for key_, values in rows.iteritems():
+            param = dict(zip(KEY_MAPS[key], key_[:n]))
+            param.update(dict(zip(AGGREGATE_KEYS, values)))
+            param['resolution'] = resolution
+            param['t_epoch'] = key_[n]
+            params.append(param)
+        return params
+
+
+    def _write_rows(self, session, key, resolution, rows):
+        """ writes the in-memory rows of key (see _rollup()) as new aggregates
+            with the bulk writer (i.e. without committing).
+        """
+        params = self._row_params(key, resolution, rows)
+        if key == 'key_0':
+            self.dimensions.register(session, params)
+        self.writer.write(session, self._table(key), params)
+
+
+    def _write_objects(self, session, key, objs):
+        """ writes the (not yet persisted) aggregate objects of key with the
+            bulk writer (i.e. without committing).
+        """
+        table = self._table(key)
+        columns = [c.name for c in table.columns]
+        params = [dict([(c, getattr(obj, c)) for c in columns]) for obj in objs]
+        if key == 'key_0':
+            self.dimensions.register(session, params)
+        self.writer.write(session, table, params)
+
+
+    def _rollup(self, rows, key_in, key_out, resolution=None):
+        """ Aggregates in-memory rows of key_in to rows of key_out (and to
+            resolution, if set). The rows are dictionaries, which map
+            (<KEY_MAPS[key] values>, t_epoch) to a list of the AGGREGATE_KEYS values.
+        """
+        idx = [KEY_MAPS[key_in].index(k) for k in KEY_MAPS[key_out]]
+        n = len(KEY_MAPS[key_in])
+
+        ag_rows = dict()
+        for key, values in rows.iteritems():
+            t_epoch = key[n]
+            if resolution:
+                t_epoch = t_epoch - (t_epoch % resolution) + resolution - 1
+            key_new = tuple([key[i] for i in idx]) + (t_epoch,)
+
+            if not ag_rows.has_key(key_new):
+                ag_rows[key_new] = list(values)
+            else:
+                aggr = ag_rows[key_new]
+                for i in range(len(values)):
+                    aggr[i] += values[i]
+        return ag_rows
+
+
+    def _rollup_lattice(self, key0_rows):
+        """ Derives the in-memory rows (see _rollup()) of all keys from the
+            key_0 rows, within a single pass over the key_0 rows.
+            returns dictionary {key: rows}
+        """
+        n = len(KEY_MAPS['key_0'])
+        idx = dict()
+        for key in KEY_ORDER[1:]:
+            idx[key] = [KEY_MAPS['key_0'].index(k) for k in KEY_MAPS[key]] + [n]
+
+        lattice = dict(key_0 = key0_rows)
+
+        if self.aggregation_backend == 'numpy':
+            encoded = vectorized.from_dict(key0_rows, n)
+            for key, key_idx in idx.iteritems():
+                lattice[key] = encoded.rollup(key_idx[:-1])
+            return lattice
+
+        for key in idx.keys():
+            lattice[key] = dict()
+
+        for key0, values in key0_rows.iteritems():
+            for key, key_idx in idx.iteritems():
+                key_new = tuple([key0[i] for i in key_idx])
+                ag_rows = lattice[key]
+                if not ag_rows.has_key(key_new):
+                    ag_rows[key_new] = list(values)
+                else:
+                    aggr = ag_rows[key_new]
+                    for i in range(len(values)):
+                        aggr[i] += values[i]
+        return lattice
+
+
+    def _key0_rows(self, t_start_epoch, t_end_epoch, resolution, where=None):
+        """ Aggregates the SGAS records with an end_time within
+            [t_start_epoch, t_end_epoch) into in-memory key_0 rows
+            (see _rollup()). Depending on the ingest_mode, the records are
+            grouped by the SGAS database or read in batches and summed up here.
+            where: optional, further filter on the SGAS records
+        """
+        ag_rows = dict()
+        t_start_utc = datetime.utcfromtimestamp(t_start_epoch)
+        t_end_utc = datetime.utcfromtimestamp(t_end_epoch)
+
+        if self.ingest_mode == 'grouped':
+            ur = sgas_schema.t_usagerecords.c
+            t_filter = AND(ur.end_time >= t_start_utc, ur.end_time < t_end_utc)
+            if where is not None:
+                t_filter = AND(t_filter, where)
+
+            for row in sgas_session.Session.execute(self._grouped_raw_query(t_filter,
+                    t_start_utc, resolution)):
+                t_epoch = t_start_epoch + (int(row.bucket) + 1) * resolution - 1
+                ag_rows[(row.global_user_name, row.vo_name, row.machine_name,
+                    row.status, t_epoch)] = [int(row[k]) for k in AGGREGATE_KEYS]
+            return ag_rows
+
+        # the raw reader includes records ending at t_end_utc
+        t_filter = sgas_schema.UsageRecords.end_time < t_end_utc
+        if where is not None:
+            t_filter = AND(t_filter, where)
+
+        for batch in self._iter_raw_batches(t_start_utc, t_end_utc, t_filter):
+            for rec in batch:
+                key, vals = self._raw_row(rec, t_start_epoch, resolution)
+                if not ag_rows.has_key(key):
+                    ag_rows[key] = list(vals)
+                else:
+                    aggr = ag_rows[key]
+                    for i in range(len(vals)):
+                        aggr[i] += vals[i]
+        return ag_rows
+
+
+    def _raw_row(self, rec, t_start_epoch, resolution):
+        """ returns (key, values) of a raw SGAS record as key_0 in-memory row
+            (see _rollup()), with the bucket counted from t_start_epoch on.
+        """
+        end_time = calendar.timegm(rec.end_time.timetuple())
+        t_epoch = end_time - ((end_time - t_start_epoch) % resolution) + resolution - 1
+        von = self._get_vo_name(rec.vo_type, rec.vo_name) or ''
+        key = (rec.global_user_name, von, rec.machine_name, rec.status, t_epoch)
+
+        values = list()
+        for k in AGGREGATE_KEYS:
+            if k == 'n_jobs':
+                values.append(1)
+            else:
+                values.append(getattr(rec, k) or 0)
+        return key, values
+
+
+    def lattice_aggregation(self, t_start_epoch, resolution, t_end_epoch, where=None):
+        """
+        Aggregates the SGAS records into all keys (in-memory engine). The key_0
+        aggregates are computed once in memory, all other keys are derived from
+        them in a single pass and everything is written within one transaction.
+        Hence, no aggregate table has to be read back.
+        Warning: t_start_epoch and t_end_epoch MUST match sampling resolution.
+
+        t_start_epoch: starting time (epoch)
+        resolution: resolution of the aggregates
+        t_end_epoch: end time (excluded)
+        where: optional, further filter on the SGAS records
+        """
+        if self._pipelined_ingest(t_start_epoch, resolution, t_end_epoch, where):
+            self.lattice_aggregation_pipelined(t_start_epoch, resolution, t_end_epoch, where)
+            return
+
+        if self._parallel_ingest(t_start_epoch, resolution, t_end_epoch, where):
+            key0_rows = dict()
+            pool = self._ingest_pool()
+            try:
+                for rows in self._iter_shard_rows(pool, t_start_epoch, resolution, t_end_epoch):
+                    key0_rows.update(rows)  # shards don't overlap
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            key0_rows = self._key0_rows(t_start_epoch, t_end_epoch, resolution, where)
+
+        lattice = self._rollup_lattice(key0_rows)
+
+        session = sgascache_session.Session()
+        for key in KEY_ORDER:
+            params = self._row_params(key, resolution, lattice[key])
+            if key == 'key_0':
+                self.dimensions.register(session, params)
+            n = self.writer.replace_range(session, self._table(key), resolution,
+                t_start_epoch, t_end_epoch, params)
+            self.log.debug('Replaced %d records of %s db by %d new ones.' % \
+                (n, KEY2ORM_MAP[key], len(lattice[key])))
+        session.commit()
+
+        self.log.info('Commited %d records to all keys (resolution: %d).' % \
+            (sum([len(rows) for rows in lattice.values()]), resolution))
+
+
+    def lattice_aggregation_pipelined(self, t_start_epoch, resolution, t_end_epoch, where=None):
+        """
+        same as lattice_aggregation(), but the SGAS records are read window by
+        window (see PIPELINE_WINDOW) by a reader thread, while the aggregates
+        of the previous window are derived and written. Everything is still
+        committed at once.
+        """
+        session = sgascache_session.Session()
+        counts = dict(n=0)
+
+        def write(window, key0_rows):
+            lattice = self._rollup_lattice(key0_rows)
+            for key in KEY_ORDER:
+                params = self._row_params(key, resolution, lattice[key])
+                if key == 'key_0':
+                    self.dimensions.register(session, params)
+                self.writer.replace_range(session, self._table(key), resolution,
+                    window[0], window[1], params)
+            counts['n'] += sum([len(rows) for rows in lattice.values()])
+
+        self._run_pipeline(t_start_epoch, resolution, t_end_epoch, where, write)
+        session.commit()
+
+        self.log.info('Commited %d records to all keys (resolution: %d).' % \
+            (counts['n'], resolution))
+
+
+    def _aggregate_range(self, t_start_epoch, resolution, t_end_epoch=None, where=None):
+        """ Aggregates the SGAS records with an end_time within
+            [t_start_epoch, t_end_epoch) into key_0 and all other keys,
+            either by the in-memory engine or key by key through the database.
+            If t_end_epoch is not set, records are aggregated up to now.
+        """
+        if not t_end_epoch:
+            t_end_epoch = int(time.time())
+            t_end_epoch += (t_start_epoch - t_end_epoch) % resolution
+
+        if self.lattice_engine == 'memory':
+            self.lattice_aggregation(t_start_epoch, resolution, t_end_epoch, where)
+            return
+
+        self._ingest_range(t_start_epoch, resolution, t_end_epoch, where)
+
+        if self.lattice_workers > 1:
+            def task(key_in, key_out):
+                try:
+                    self.key_aggregation(key_in, key_out, t_start_epoch, resolution, t_end_epoch)
+                finally:
+                    sgascache_session.Session.remove()  # session of worker thread
+
+            scheduler.DagScheduler(KEY_LATTICE, self.lattice_workers).run(task, 'key_0')
+            return
+
+        for key_in, key_out in KEY_LATTICE:
+            self.key_aggregation(key_in, key_out, t_start_epoch, resolution, t_end_epoch)
+
+
+    def _ingest_range(self, t_start_epoch, resolution, t_end_epoch, where=None):
+        """ Aggregates the SGAS records with an end_time within
+            [t_start_epoch, t_end_epoch) into key_0, depending on the
+            ingest mode and workers.
+        """
+        if self._parallel_ingest(t_start_epoch, resolution, t_end_epoch, where):
+            self.raw2key0_aggregate_parallel(t_start_epoch, resolution, t_end_epoch)
+        elif self._pipelined_ingest(t_start_epoch, resolution, t_end_epoch, where):
+            self.raw2key0_aggregate_pipelined(t_start_epoch, resolution, t_end_epoch, where)
+        elif self.ingest_mode == 'grouped':
+            self.raw2key0_aggregate_grouped(t_start_epoch, resolution, t_end_epoch, where)
+        else:
+            self.raw2key0_aggregate(t_start_epoch, resolution, t_end_epoch, where)
+
+
+    def _res_aggregate_range(self, t_start_epoch, resolution, factor, t_end_epoch=None, where=None):
+        """ Aggregates all keys from resolution by factor, from t_start_epoch
+            (aligned to the coarser resolution) up to t_end_epoch (excluded).
+            If the aggregates of resolution may have been purged already
+            (see RetentionPolicy), the SGAS records (selected by 'where')
+            are aggregated instead.
+        """
+        horizon = None
+        if self.retention:
+            horizon = self.retention.purged_before(resolution)
+
+        if horizon is not None and t_start_epoch < horizon:
+            self.log.debug("Aggregating SGAS records to resolution %d, as aggregates "
+                "of resolution %d before %s may be purged." % (factor * resolution,
+                resolution, datetime.utcfromtimestamp(horizon)))
+            self._aggregate_range(t_start_epoch, factor * resolution, t_end_epoch, where)
+            return
+
+        for key in KEY_ORDER:
+            self.res_aggregation(key, t_start_epoch, resolution, factor, t_end_epoch)
+
+
+    def _parallel_ingest(self, t_start_epoch, resolution, t_end_epoch, where):
+        """ returns True if the SGAS records of the time range get aggregated
+            by the ingest worker processes. Further filters on the records
+            ('where') are not passed to the workers, hence not supported.
+        """
+        return self.ingest_workers > 1 and where is None and \
+            t_end_epoch - t_start_epoch > resolution
+
+
+    def _ingest_pool(self):
+        """ returns a new pool of ingest_workers processes. The worker
+            processes must not inherit connections to the SGAS database nor
+            to the SGAS cache, hence it must be started before the
+            transaction of the caller in the SGAS cache (any open one,
+            which holds no changes, gets closed).
+        """
+        sgas_session.Session.remove()
+        sgas_session.engine.dispose()
+        sgascache_session.Session.close()
+        sgascache_session.engine.dispose()
+
+        return multiprocessing.Pool(self.ingest_workers, _init_ingest_worker,
+            (str(sgas_session.engine.url), self.ingest_mode, self.raw_batch_size))
+
+
+    def _iter_shard_rows(self, pool, t_start_epoch, resolution, t_end_epoch):
+        """ Splits [t_start_epoch, t_end_epoch) into time shards (aligned to
+            resolution), which are aggregated by the pool of ingest worker
+            processes (see _ingest_pool()). Yields the in-memory key_0 rows
+            (see _rollup()) of the shards in time order.
+        """
+        n_buckets = (t_end_epoch - t_start_epoch) / resolution
+        n_shards = self.ingest_workers * SHARDS_PER_WORKER
+        shard_size = max(1, (n_buckets + n_shards - 1) / n_shards) * resolution
+        shards = [(t, min(t + shard_size, t_end_epoch), resolution) \
+            for t in range(t_start_epoch, t_end_epoch, shard_size)]
+
+        self.log.debug("Aggregating %d time shards by %d processes" % \
+            (len(shards), self.ingest_workers))
+
+        for rows in pool.imap(_ingest_shard, shards):
+            yield rows
+
+
+    def raw2key0_aggregate_parallel(self, t_start_epoch, resolution, t_end_epoch):
+        """
+        same as raw2key0_aggregate(), but the time range is split into shards,
+        which are aggregated concurrently by the ingest worker processes
+        (each with its own engine). The aggregates are bulk written per shard
+        and committed at once.
+
+        start_t_epoch : starting time in epoch, must match sampling resolution
+        resolution    : resolution of the aggregate.
+        t_end_epoch   : end time (excluded) in epoch, must match sampling resolution
+        """
+        pool = self._ingest_pool()  # before our transaction starts
+        try:
+            session = sgascache_session.Session()
+            n = self.writer.delete_range(session, self._table('key_0'), resolution,
+                t_start_epoch, t_end_epoch)
+            self.log.info('Removed %d old records from UserVomachineStatus before repopulation.' % n)
+
+            n = 0
+            for rows in self._iter_shard_rows(pool, t_start_epoch, resolution, t_end_epoch):
+                self._write_rows(session, 'key_0', resolution, rows)
+                n += len(rows)
+            session.commit()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self.log.debug("Commited %d aggregates (resolution = %d) to UserVoMachineStatus db" % \
+            (n, resolution))
+
+
+    def _pipelined_ingest(self, t_start_epoch, resolution, t_end_epoch, where):
+        """ returns True if the SGAS records of the time range get read by
+            the pipeline (i.e. the range spans several windows).
+        """
+        return self.pipeline_depth > 0 and \
+            t_end_epoch - t_start_epoch > max(PIPELINE_WINDOW, resolution)
+
+
+    def _run_pipeline(self, t_start_epoch, resolution, t_end_epoch, where, write):
+        """ Splits [t_start_epoch, t_end_epoch) into windows (aligned to
+            resolution), whose SGAS records are aggregated into in-memory
+            key_0 rows (see _rollup()) by a reader thread, up to pipeline_depth
+            windows ahead. Meanwhile write(window, rows) is called for the
+            previous windows, in time order.
+        """
+        window = max(1, PIPELINE_WINDOW / resolution) * resolution
+        windows = [(t, min(t + window, t_end_epoch)) \
+            for t in range(t_start_epoch, t_end_epoch, window)]
+
+        self.log.debug("Aggregating %d time windows (%d read ahead)" % \
+            (len(windows), self.pipeline_depth))
+
+        def read(window):
+            return self._key0_rows(window[0], window[1], resolution, where)
+
+        # the reader thread has its own session (connection) to the SGAS db
+        pipeline.Pipeline(self.pipeline_depth).run(read, windows, write,
+            sgas_session.Session.remove)
+
+
+    def raw2key0_aggregate_pipelined(self, t_start_epoch, resolution, t_end_epoch, where=None):
+        """
+        same as raw2key0_aggregate(), but the SGAS records of the next time
+        window are read (by a reader thread) while the aggregates of the
+        previous window are written. The aggregates are committed at once.
+
+        start_t_epoch : starting time in epoch, must match sampling resolution
+        resolution    : resolution of the aggregate.
+        t_end_epoch   : end time (excluded) in epoch, must match sampling resolution
+        where         : optional, further filter on the SGAS records
+        """
+        session = sgascache_session.Session()
+        n = self.writer.delete_range(session, self._table('key_0'), resolution,
+            t_start_epoch, t_end_epoch)
+        self.log.info('Removed %d old records from UserVomachineStatus before repopulation.' % n)
+
+        counts = dict(n=0)
+
+        def write(window, rows):
+            self._write_rows(session, 'key_0', resolution, rows)
+            counts['n'] += len(rows)
+
+        self._run_pipeline(t_start_epoch, resolution, t_end_epoch, where, write)
+        session.commit()
+
+        self.log.debug("Commited %d aggregates (resolution = %d) to UserVoMachineStatus db" % \
+            (counts['n'], resolution))
+
+
+    def _upsert_statement(self, table):
+        """ returns an INSERT statement for table, which adds the values to
+            the aggregated values of an already existing row (MySQL and
+            PostgreSQL/sqlite dialects only, see upsert_supported()).
+        """
+        dialect = sgascache_session.engine.dialect
+        preparer = dialect.identifier_preparer
+        name = preparer.format_table(table)
+        columns = dict([(c.name, preparer.format_column(c)) for c in table.columns])
+
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (name,
+                ', '.join([columns[c.name] for c in table.columns]),
+                ', '.join([':%s' % c.name for c in table.columns]))
+
+        if dialect.name == 'mysql':
+            sql += ' ON DUPLICATE KEY UPDATE ' + ', '.join(['%s = %s + VALUES(%s)' % \
+                (columns[k], columns[k], columns[k]) for k in AGGREGATE_KEYS])
+        elif dialect.name in ('postgresql', 'sqlite'):
+            sql += ' ON CONFLICT (%s) DO UPDATE SET ' % \
+                ', '.join([columns[c.name] for c in table.primary_key.columns])
+            sql += ', '.join(['%s = %s.%s + EXCLUDED.%s' % \
+                (columns[k], name, columns[k], columns[k]) for k in AGGREGATE_KEYS])
+        else:
+            raise NotImplementedError("No upsert for '%s' databases" % dialect.name)
+
+        return text(sql)
+
+
+    def _upsert(self, key, resolution, rows):
+        """ adds in-memory rows of key (see _rollup()) to the aggregates
+            of the corresponding table. Changes are not committed.
+        """
+        if not rows:
+            return
+
+        params = self._row_params(key, resolution, rows)
+        if key == 'key_0':
+            self.dimensions.register(sgascache_session.Session(), params)
+        sgascache_session.Session.execute(self._upsert_statement(self._table(key)), params)
+        self.log.debug("Upserted %d records into %s (resolution: %d)." % \
+            (len(params), KEY2ORM_MAP[key], resolution))
+
+
+    def bucket_aggregation(self, new_recs, resolution, factors):
+        """
+        Rebuilds the aggregates (of all keys and resolutions) of the
+        resolution buckets, which hold any of the SGAS records selected by
+        new_recs (by their end_time).
+
+        new_recs: filter on the SGAS records
+        resolution: resolution of the aggregates
+        factors: factors of the further resolutions
+        """
+        buckets = self._dirty_buckets(new_recs, resolution)
+
+        if not buckets:
+            self.log.debug("No new accouting records with end_time to aggregate")
+            return
+
+        self.log.info("Aggregating accouting records of %d buckets, oldest from %s" % \
+            (len(buckets), datetime.utcfromtimestamp(buckets[0])))
+
+        for t_start_epoch, t_end_epoch in self._bucket_runs(buckets, resolution):
+            self._aggregate_range(t_start_epoch, resolution, t_end_epoch)
+
+        for factor in factors:
+            # buckets of the coarser resolution, which hold any of the
+            # dirty buckets (aligned to the coarser resolution)
+            f_resolution = factor * resolution
+            f_buckets = list(set([t - (t % f_resolution) for t in buckets]))
+            f_buckets.sort()
+            for t_start_epoch, t_end_epoch in self._bucket_runs(f_buckets, f_resolution):
+                self._res_aggregate_range(t_start_epoch, resolution, factor, t_end_epoch)
+
+        if self.cumulative:
+            self._refresh_cumulative(self._bucket_runs(buckets, resolution), resolution, factors)
+            sgascache_session.Session.commit()
+
+
+    def incremental_aggregation(self, new_recs, resolution, factors):
+        """
+        Applies the SGAS records selected by new_recs as increments to the
+        aggregates of all keys and resolutions. As all aggregated values are
+        sums, the new records are grouped by key_0 (by the SGAS database),
+        rolled up in memory to the other keys and resolutions, and added to
+        the existing aggregates by upserts. Changes are not committed, they
+        are committed together with the ingest watermark (see main()).
+
+        new_recs: filter on the SGAS records
+        resolution: resolution of the aggregates
+        factors: factors of the further resolutions
+        """
+        epoch_utc = datetime.utcfromtimestamp(0)
+
+        key0_rows = dict()
+        for row in sgas_session.Session.execute(self._grouped_raw_query(new_recs,
+                epoch_utc, resolution)):
+            if row.bucket is None:  # no end_time
+                continue
+            t_epoch = (int(row.bucket) + 1) * resolution - 1
+            key0_rows[(row.global_user_name, row.vo_name, row.machine_name,
+                row.status, t_epoch)] = [int(row[k]) for k in AGGREGATE_KEYS]
+
+        self.log.info("Got %d new key_0 increments (resolution = %d)" % \
+            (len(key0_rows), resolution))
+
+        rows = self._rollup_lattice(key0_rows)
+
+        series = dict()  # series of the increments, see _add_series()
+        for key in KEY_ORDER:
+            self._upsert(key, resolution, rows[key])
+            self._add_series(series, key, resolution, rows[key])
+            for factor in factors:
+                f_rows = self._rollup(rows[key], key, key, factor * resolution)
+                self._upsert(key, factor * resolution, f_rows)
+                self._add_series(series, key, factor * resolution, f_rows)
+
+        if self.cumulative and key0_rows:  # committed with the increments
+            t_start_epoch = min([key[-1] for key in key0_rows.keys()]) - resolution + 1
+            self._refresh_cumulative([(t_start_epoch, None)], resolution, factors, series)
+
+
+    def rebuild_aggregation(self, t_start_epoch, resolution, factors, where=None):
+        """ Rebuilds all aggregates (of all keys and resolutions) from
+            t_start_epoch on, e.g. to reconcile the incrementally
+            updated aggregates with the SGAS records.
+            where: optional, further filter on the SGAS records
+        """
+        t_start_epoch -= t_start_epoch % resolution
+        self.log.info("Rebuilding aggregates from %s on" % datetime.utcfromtimestamp(t_start_epoch))
+
+        self._aggregate_range(t_start_epoch, resolution, where=where)
+
+        for factor in factors:
+            f_start_epoch = t_start_epoch - (t_start_epoch % (factor * resolution))
+            self._res_aggregate_range(f_start_epoch, resolution, factor, where=where)
+
+        if self.cumulative:
+            self._refresh_cumulative([(t_start_epoch, None)], resolution, factors)
+            sgascache_session.Session.commit()
+
+
+    def _add_series(self, series, key, resolution, rows):
+        """ adds the series of the in-memory rows of key (see _rollup()) to
+            series, i.e. {resolution: {table name: {key values: oldest t_epoch}}}
+        """
+        table_series = series.setdefault(resolution, dict()).setdefault(
+            self._table(key).name, dict())
+        for key_ in rows.iterkeys():
+            t_epoch = key_[-1]
+            if t_epoch < table_series.get(key_[:-1], t_epoch + 1):
+                table_series[key_[:-1]] = t_epoch
+
+
+    def _refresh_cumulative(self, ranges, resolution, factors, series=None):
+        """ recomputes the running totals (see cumulative) of all keys and
+            resolutions of the series, whose aggregates changed within the
+            time ranges [(t_start_epoch, t_end_epoch)] (t_end_epoch None: up
+            to now), without committing. Each series is recomputed from its
+            oldest changed bucket on. Purged time ranges (see RetentionPolicy)
+            are skipped.
+            series: optional, the changed series (see _add_series()), if known
+        """
+        for res in [resolution] + [factor * resolution for factor in factors]:
+            horizon = None
+            if self.retention:
+                horizon = self.retention.purged_before(res)
+                if horizon is not None:
+                    horizon += -horizon % res
+
+            res_ranges = list()
+            for t_start, t_end in ranges:
+                t_start -= t_start % res
+                if t_end:
+                    t_end += -t_end % res
+                if horizon is not None and t_start < horizon:
+                    t_start = horizon
+                if not t_end or t_start < t_end:
+                    res_ranges.append((t_start, t_end))
+            if not res_ranges:
+                continue
+
+            res_series = None
+            if series is not None:
+                res_series = series.get(res, dict())
+                if horizon is not None:
+                    for table_series in res_series.values():
+                        for key, t_epoch in table_series.items():
+                            if t_epoch < horizon:
+                                table_series[key] = horizon
+            self.cumulative.refresh_all(res, res_ranges, res_series)
+
+
+    def reconcile(self, wm, resolution, factors):
+        """ Rebuilds the aggregates of the last 'reconcile_days_back' days
+            from the SGAS records up to the ingest watermark wm, if the
+            'reconcile_interval' has passed. Corrects any drift of the
+            incrementally updated aggregates. returns True if rebuilt.
+        """
+        now_epoch = int(time.time())
+        if not self.reconcile_interval or wm.insert_time is None or \
+                now_epoch - self.last_reconcile_time_epoch < self.reconcile_interval:
+            return False
+
+        self.rebuild_aggregation(now_epoch - 86400 * self.reconcile_days_back,
+            resolution, factors, self._upto_filter(wm.insert_time, wm.record_id))
+        self.last_reconcile_time_epoch = now_epoch
+        return True
+
+
+    def _lock_watermark(self, session):
+        """ returns the ingest watermark of our source, locked (SELECT ... FOR
+            UPDATE) until the transaction of session ends.
+        """
+        IW = ag_schema.IngestWatermark
+        if not session.query(IW).get(self.source):
+            session.add(IW(self.source))
+            try:
+                session.commit()
+            except IntegrityError:  # added by another daemon
+                session.rollback()
+
+        return session.query(IW).filter(IW.source == self.source).\
+            with_lockmode('update').populate_existing().one()
+
+
+    def _plan_tasks(self, buckets, resolution, factors):
+        """ returns the tasks (see workqueue), which rebuild the aggregates
+            of the dirty buckets (like bucket_aggregation()). Tasks are
+            ordered by steps: ingest (0), keys (by depth), resolutions, running
+            totals.
+        """
+        res_step = max(KEY_DEPTH.values()) + 1
+
+        tasks = list()
+        for t_start_epoch, t_end_epoch in self._bucket_runs(buckets, resolution):
+            tasks.append(dict(step=0, stage='ingest', key_name='key_0', resolution=resolution,
+                t_start=t_start_epoch, t_end=t_end_epoch))
+            if self.lattice_engine == 'memory':  # derives all keys at once
+                continue
+            for key_in, key_out in KEY_LATTICE:
+                tasks.append(dict(step=KEY_DEPTH[key_out], stage='key', key_name=key_out,
+                    resolution=resolution, t_start=t_start_epoch, t_end=t_end_epoch))
+
+        for factor in factors:
+            f_resolution = factor * resolution
+            f_buckets = list(set([t - (t % f_resolution) for t in buckets]))
+            f_buckets.sort()
+            for t_start_epoch, t_end_epoch in self._bucket_runs(f_buckets, f_resolution):
+                tasks.append(dict(step=res_step, stage='res', resolution=resolution,
+                    factor=factor, t_start=t_start_epoch, t_end=t_end_epoch))
+
+        if self.cumulative:  # running totals, once all aggregates are done
+            for res in [resolution] + [factor * resolution for factor in factors]:
+                tasks.append(dict(step=res_step + 1, stage='cum', resolution=res,
+                    t_start=buckets[0] - (buckets[0] % res), t_end=buckets[-1] + resolution))
+        return tasks
+
+
+    def plan(self, resolution, factors):
+        """
+        Plans the aggregation of the SGAS records inserted since the ingest
+        watermark as tasks of the work queue, and moves the watermark. As the
+        watermark is locked meanwhile, only one daemon plans at a time and
+        the records are planned exactly once.
+        """
+        session = sgascache_session.Session()
+        wm = self._lock_watermark(session)
+
+        new_recs = self._new_records_filter(wm)
+        last = self._last_record(new_recs)
+
+        if not last:
+            self.log.debug("No new accouting records to plan")
+            session.commit()
+            return
+
+        new_recs = AND(new_recs, self._upto_filter(last.insert_time, last.record_id))
+        buckets = self._dirty_buckets(new_recs, resolution)
+        if buckets:
+            self.work_queue.enqueue(session, self.work_queue.next_batch(session),
+                self._plan_tasks(buckets, resolution, factors))
+
+        wm.insert_time = last.insert_time
+        wm.record_id = last.record_id
+        session.commit()
+        self.log.debug("Moved ingest watermark to %s (record %s)" % \
+            (last.insert_time, last.record_id))
+
+
+    def run_task(self, task):
+        """ runs a task of the work queue (see _plan_tasks()) """
+        try:
+            if task['stage'] == 'ingest':
+                if self.lattice_engine == 'memory':
+                    self.lattice_aggregation(task['t_start'], task['resolution'], task['t_end'])
+                else:
+                    self._ingest_range(task['t_start'], task['resolution'], task['t_end'])
+            elif task['stage'] == 'key':
+                self.key_aggregation(KEY_PARENT[task['key_name']], task['key_name'],
+                    task['t_start'], task['resolution'], task['t_end'])
+            elif task['stage'] == 'res':
+                self._res_aggregate_range(task['t_start'], task['resolution'],
+                    task['factor'], task['t_end'])
+            elif task['stage'] == 'cum':
+                if not self.cumulative:
+                    raise ValueError("Running totals are not enabled")
+                self._refresh_cumulative([(task['t_start'], task['t_end'])],
+                    task['resolution'], [])
+                sgascache_session.Session.commit()
+            else:
+                raise ValueError("Unknown stage '%s'" % task['stage'])
+        finally:
+            sgascache_session.Session.remove()
+
+
+    def bump_generation(self):
+        """ increments the generation counter of the SGAS cache, which
+            invalidates the cached query results (see utils.cache)
+        """
+        session = sgascache_session.Session()
+        cache.bump_generation(session)
+        session.commit()
+
+
     def main(self, resolution, factors):
 
-        # 1.) fetch records inserted since the last aggregation time
-        #     and get record with oldest end_time
-        
-        last_aggregation_time = datetime.utcfromtimestamp(self.last_aggregation_time_epoch)
-        
-        self.last_aggregation_time_epoch = int(time.time()) - 300 # now -300 secs (robustness toNTP time drifts)
-        
-        self.log.debug("last aggreation time:%s" % last_aggregation_time)
+        # the dimension catalog tracks the time ranges at the base resolution
+        self.dimensions.seen_resolution = resolution
+
+        if self.partitions:  # no open transaction, which would block DDL
+            sgascache_session.Session.close()
+            self.partitions.maintain([resolution] + [resolution * f for f in factors])
+
+        if self.work_queue:  # shared with other daemons
+            self.plan(resolution, factors)
+            if self.work_queue.run(self.run_task):
+                self.bump_generation()
+            self.work_queue.purge_done()
+            return
+
+        # 1.) select records inserted since the ingest watermark
+        #     (up to the newest record older than the safety lag)
+        wm = self._load_watermark()
+        self.log.debug("Ingest watermark: %s (record %s)" % (wm.insert_time, wm.record_id))
 
+        new_recs = self._new_records_filter(wm)
 
-        rec = sgas_session.Session.query(sgas_schema.UsageRecords).order_by(sgas_schema.UsageRecords.end_time.asc()).\
-            filter(sgas_schema.UsageRecords.insert_time >= last_aggregation_time).first()
+        # records inserted from now on (or within the safety lag) are left
+        # for the next run
+        last = self._last_record(new_recs)
 
-        if not rec:
+        if not last:
             self.log.debug("No new accouting records to aggregate")
 
         else:
-            self.log.debug("Oldest non-aggregated record's end_time %s" % rec.end_time)
+            new_recs = AND(new_recs, self._upto_filter(last.insert_time, last.record_id))
 
-            #2.) aggregation of records starting from oldest end_time on
-            end_time_tuple = rec.end_time.timetuple()
-            start_t_epoch_ = calendar.timegm(end_time_tuple)
-        
-            start_t_epoch =  start_t_epoch_ - (start_t_epoch_ % resolution)
-            
-            self.log.info("Aggregating accouting records starting from %s" % \
-                datetime.utcfromtimestamp(start_t_epoch))
-
-            self.raw2key0_aggregate(start_t_epoch, resolution)
-            self.key_aggregation('key_0', 'key_01', start_t_epoch, resolution)
-            self.key_aggregation('key_0', 'key_02', start_t_epoch, resolution)
-            self.key_aggregation('key_0', 'key_03', start_t_epoch, resolution)
-            self.key_aggregation('key_0', 'key_04', start_t_epoch, resolution)
-            self.key_aggregation('key_01', 'key_011', start_t_epoch, resolution)
-            self.key_aggregation('key_01', 'key_012', start_t_epoch, resolution)
-            self.key_aggregation('key_02', 'key_021', start_t_epoch, resolution)
-            self.key_aggregation('key_03', 'key_031', start_t_epoch, resolution)
-            self.key_aggregation('key_03', 'key_032', start_t_epoch, resolution)
-            self.key_aggregation('key_04', 'key_041', start_t_epoch, resolution)
-            self.key_aggregation('key_021', 'key_0211', start_t_epoch, resolution)
-            self.key_aggregation('key_031', 'key_0311', start_t_epoch, resolution)
-            self.key_aggregation('key_032', 'key_0321', start_t_epoch, resolution)
-            self.key_aggregation('key_041', 'key_0411', start_t_epoch, resolution)
-            for factor in factors:
-                # callibrate  start_t_epoch time for each resolution, else time may 
-                # drift with each run (and start of daemon)
-                start_t_epoch = start_t_epoch_ - (start_t_epoch_ % (factor * resolution))
-                self.res_aggregation('key_0', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_01', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_02', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_03', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_04', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_011', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_012', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_021', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_031', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_032', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_041', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_0211', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_0311', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_0321', start_t_epoch, resolution, factor)
-                self.res_aggregation('key_0411', start_t_epoch, resolution, factor)
+            #2.) aggregation of the new records
+            if self.aggregation_mode == 'incremental':
+                # increments get committed together with the watermark
+                self.incremental_aggregation(new_recs, resolution, factors)
+            else:
+                self.bucket_aggregation(new_recs, resolution, factors)
+
+            self._store_watermark(wm, last.insert_time, last.record_id)
+            self.log.debug("Moved ingest watermark to %s (record %s)" % \
+                (last.insert_time, last.record_id))
+
+        #3.) reconciliation of incrementally updated aggregates
+        reconciled = False
+        if self.aggregation_mode == 'incremental':
+            reconciled = self.reconcile(wm, resolution, factors)
+
+        #4.) invalidation of cached query results
+        if last or reconciled:
+            self.bump_generation()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+"""
+Result cache of the query helpers (see helpers).
+
+The aggregates only change once per aggregation cycle. Hence, the results of
+the query helpers are cached in memory (least recently used entries are
+evicted first), keyed by the function and its arguments. The time arguments
+are replaced by their sampling interval, so queries falling into the same
+buckets share an entry.
+
+Entries expire after 'ttl' seconds. Besides, all entries are dropped as soon
+as the generation counter in the 'cache_generation' table of the SGAS cache
+changes, which the aggregator increments after each cycle that changed any
+aggregates (see bump_generation()). The counter is read at most every
+'check_interval' seconds, i.e. repeated queries do not hit the database
+in between.
+
+The memory used is bounded by the number of entries and the total number of
+cached records.
+"""
+
+import time
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import select
+
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import session as sgascache_session
+
+MAX_ENTRIES = 1000  # default max. number of cached results
+MAX_ROWS = 100000  # default max. number of cached records (all results)
+TTL = 300  # default time-to-live of cached results [secs]
+CHECK_INTERVAL = 10  # default interval of checking the generation [secs]
+
+GENERATION_ID = 1  # id of the (single) row of the cache_generation table
+
+
+def current_generation(bind):
+    """ returns the generation counter of the SGAS cache (0 if not set yet)
+        bind: engine, connection or session
+    """
+    t = ag_schema.t_cache_generation
+    generation = bind.execute(select([t.c.generation],
+        t.c.id == GENERATION_ID)).scalar()
+    return generation or 0
+
+
+def bump_generation(session):
+    """ increments the generation counter, within the transaction of session """
+    t = ag_schema.t_cache_generation
+    n = session.execute(t.update(t.c.id == GENERATION_ID).values(
+        generation=t.c.generation + 1, updated=datetime.utcnow())).rowcount
+    if not n:
+        session.execute(t.insert(), dict(id=GENERATION_ID, generation=1,
+            updated=datetime.utcnow()))
+
+
+class ResultCache(object):
+    """ LRU cache with time-to-live of query results, invalidated by the
+        generation counter of the SGAS cache.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_rows=MAX_ROWS, ttl=TTL,
+            check_interval=CHECK_INTERVAL):
+        """
+        max_entries: max. number of cached results
+        max_rows: max. number of cached records of all results
+        ttl: time-to-live of cached results [secs]
+        check_interval: interval of checking the generation counter [secs]
+        """
+        self.log = logging.getLogger(__name__)
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.check_interval = check_interval
+
+        self.lock = threading.RLock()
+        self.entries = dict()  # key -> [result, rows, expires, last use]
+        self.rows = 0
+        self.uses = 0  # counter of uses, orders the entries by recency
+        self.generation = None
+        self.checked = 0  # time of last generation check
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries = dict()
+            self.rows = 0
+        finally:
+            self.lock.release()
+
+    def _check_generation(self, now):
+        """ drops all entries if the generation counter has changed """
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        # not within the session of the caller, which may hold a transaction
+        generation = current_generation(sgascache_session.engine)
+        if generation != self.generation:
+            if self.generation is not None:
+                self.log.debug("Generation changed from %d to %d, dropping %d results" % \
+                    (self.generation, generation, len(self.entries)))
+            self.clear()
+            self.generation = generation
+
+    def _drop(self, key):
+        self.rows -= self.entries.pop(key)[1]
+
+    def _evict(self):
+        """ evicts the least recently used entries until the bounds are met """
+        while self.entries and (len(self.entries) > self.max_entries or \
+                self.rows > self.max_rows):
+            lru = min(self.entries.items(), key=lambda item: item[1][3])[0]
+            self._drop(lru)
+
+    def get(self, key):
+        """ returns (True, result) if key is cached, (False, None) otherwise """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self._check_generation(now)
+            entry = self.entries.get(key)
+            if entry and entry[2] < now:
+                self._drop(key)
+                entry = None
+            if not entry:
+                self.misses += 1
+                return False, None
+            self.uses += 1
+            entry[3] = self.uses
+            self.hits += 1
+            return True, entry[0]
+        finally:
+            self.lock.release()
+
+    def put(self, key, result, rows=1, generation=None):
+        """ caches result of key (holding 'rows' records). If generation (the
+            one before the result got queried) is set, the result is only
+            cached if the generation hasn't changed meanwhile.
+        """
+        if rows > self.max_rows:
+            return
+        self.lock.acquire()
+        try:
+            if generation is not None and generation != self.generation:
+                return
+            if self.entries.has_key(key):
+                self._drop(key)
+            self.uses += 1
+            self.entries[key] = [result, rows, time.time() + self.ttl, self.uses]
+            self.rows += rows
+            self._evict()
+        finally:
+            self.lock.release()
@@ -116,6 +116,21 @@ class ConfigReader:
             return None
         return gen    
 
+    def get_section(self, section):
+        """
+        Returns all options (and values) of 'section' as dictionary,
+        which is empty if the section does not exist.
+        """
+        options = {}
+        if not self.parser.has_section(section):
+            return options
+
+        for item in self.parser.options(section):
+            value = self.parser.get(section, item).strip()
+            if value:
+                options[item] = value
+        return options
+
 
 if __name__ == "__main__":
     try:        
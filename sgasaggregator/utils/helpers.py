@@ -35,16 +35,108 @@ we need to transfrom the continuous times to their coresponding discrete times:
 hence, t_1_new =  t_1 - (t_1 modulo resolution)
        t_2_new =  t_2 - (t_2 modulo resolution) + resolution
 
+
+Multi-resolution queries: if the aggregates are stored at several (nested)
+resolutions, e.g. 1, 7 and 28 days, the interior of a long interval is
+covered by the coarsest buckets fitting within it and only its edges by finer
+buckets (see plan_intervals()):
+
+             ---|-----------------------|-----------------------|----> 28 days
+             ---|-----|-----|-----|-----|-----|-----|-----|-----|----> 7 days
+             -|-|-|-|-|-|-|-|-|-|-|-|-|-|-|-|-|-|-|-|-|-|-|-|-|-|----> 1 day
+            ----|---------------------------------------------------->t_c
+                t_1                                             t_2
+                |<-7d->|<--------- 28 days ---------->|<-7d->|1d|
+
+The totals are exact, as every record is accounted in exactly one bucket.
+
+
+Results can be cached in memory (see utils.cache), which has to be enabled by
+enable_result_cache(). With the cache enabled, the query functions return
+lists of (detached) records instead of query objects.
+
 """
 
-from sqlalchemy import and_
+from sqlalchemy import and_, or_, func, select
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.types import Integer
+from array import array
 import logging
+import functools
 
 from sgasaggregator.sgascache import ag_schema
 from sgasaggregator.sgascache import session as sgascache_session
+from sgasaggregator.utils import cache
+from sgasaggregator.utils import vectorized
 
 log = logging.getLogger(__name__)
 
+# max. number of entities per IN (...) clause of the batched queries
+IN_CHUNK_SIZE = 500
+
+# cache of query results, None unless enabled
+result_cache = None
+
+# resolutions of the aggregates (as configured for the aggregator), None
+# unless set, then they are looked up in the SGAS cache
+configured_resolutions = None
+
+def set_resolutions(resolution, factors):
+    """ sets the resolutions of the aggregates (as configured for the 
+        aggregator), so they need not be looked up in the SGAS cache.
+        resolution: base resolution [secs]
+        factors: factors of the further resolutions
+    """
+    global configured_resolutions
+    configured_resolutions = sorted(set([resolution] + [f * resolution for f in factors]))
+
+def enable_result_cache(max_entries=cache.MAX_ENTRIES, max_rows=cache.MAX_ROWS,
+        ttl=cache.TTL, check_interval=cache.CHECK_INTERVAL):
+    """ enables caching of the query results (see utils.cache) """
+    global result_cache
+    result_cache = cache.ResultCache(max_entries, max_rows, ttl, check_interval)
+
+def disable_result_cache():
+    global result_cache
+    result_cache = None
+
+def _cached(records=True):
+    """ decorator, which caches the results of a query function (if the
+        result cache is enabled).
+        records: True if the function returns a query of aggregates and 
+                 takes (..., start_t_epoch, end_t_epoch, resolution) as last
+                 arguments. The times are keyed by their sampling interval.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if result_cache is None or kwargs:
+                return func(*args, **kwargs)
+
+            key = (func.__name__,) + args
+            if records and args[-1]:
+                s_start, s_end = get_sampling_interval(args[-3], args[-2], args[-1])
+                key = (func.__name__,) + args[:-3] + (s_start, s_end, args[-1])
+
+            hit, result = result_cache.get(key)
+            if hit:
+                return list(result)
+
+            generation = result_cache.generation
+            result = func(*args)
+            if result is None:
+                return None
+            result = list(result)
+            if records:  # shared by all threads, must not stay in a session
+                for rec in result:
+                    sgascache_session.Session.expunge(rec)
+            result_cache.put(key, result, len(result), generation)
+            return list(result)
+        return wrapper
+    return decorator
+
+
+@_cached()
 def get_user_acrecords(DN, start_t_epoch, end_t_epoch, resolution):
     """ returns a query object of the jobs or None, upon which 
         one can iterate.
@@ -66,6 +158,7 @@ def get_user_acrecords(DN, start_t_epoch, end_t_epoch, resolution):
         ag_schema.User.global_user_name == DN,
         ag_schema.User.resolution == resolution)).order_by(ag_schema.User.t_epoch)
 
+@_cached()
 def get_cluster_user_acrecords(hostname, DN, start_t_epoch, end_t_epoch, resolution):
     """ returns a query object of the jobs or None, upon which 
         one can iterate.
@@ -92,6 +185,7 @@ def get_cluster_user_acrecords(hostname, DN, start_t_epoch, end_t_epoch, resolut
         ag_schema.UserMachine.resolution == resolution))
 
 
+@_cached()
 def get_cluster_acrecords(hostname, start_t_epoch, end_t_epoch, resolution):
     """ returns a query object of the jobs or None, upon which 
         one can iterate.
@@ -115,16 +209,20 @@ def get_cluster_acrecords(hostname, start_t_epoch, end_t_epoch, resolution):
         ag_schema.Machine.machine_name == hostname,
         ag_schema.Machine.resolution == resolution))
 
-def get_cluster_names():
-    """ returns list of distinct clusters """
+@_cached(records=False)
+def get_cluster_names(start_t_epoch=None, end_t_epoch=None):
+    """ returns list of distinct clusters (from the dimension catalog). If
+        start_t_epoch and end_t_epoch are set, only the ones with jobs 
+        within [start_t_epoch, end_t_epoch] (see get_active_names()).
+    """
     clusters = []
-    for arec in sgascache_session.Session.query(ag_schema.Machine.machine_name).distinct():
-        cluster_name  = arec.machine_name
+    for cluster_name in get_active_names('machine_name', start_t_epoch, end_t_epoch):
         if not cluster_name:
             continue
         clusters.append(cluster_name)
     return clusters
 
+@_cached()
 def get_vo_acrecords(vo_name, start_t_epoch, end_t_epoch, resolution):
     """ returns a query object of the jobs or None, upon which 
         one can iterate.
@@ -146,6 +244,7 @@ def get_vo_acrecords(vo_name, start_t_epoch, end_t_epoch, resolution):
         ag_schema.Vo.vo_name == vo_name,
         ag_schema.Vo.resolution == resolution)).order_by(ag_schema.Vo.t_epoch)
 
+@_cached()
 def get_cluster_vo_acrecords(cluster_name, vo_name, start_t_epoch, end_t_epoch, resolution):
     """ returns a query object of the jobs or None, upon which 
         one can iterate.
@@ -169,18 +268,353 @@ def get_cluster_vo_acrecords(cluster_name, vo_name, start_t_epoch, end_t_epoch,
         ag_schema.VoMachine.resolution == resolution)).order_by(ag_schema.VoMachine.t_epoch)
 
 
-def get_vo_names():
-    """ returns list of distinct VOs """
-    vos = []
-    for arec in sgascache_session.Session.query(ag_schema.Vo.vo_name).distinct():
-        vo = arec.vo_name
-        vos.append(vo)   # i.e. vo can be  NULL/None
+@_cached(records=False)
+def get_vo_names(start_t_epoch=None, end_t_epoch=None):
+    """ returns list of distinct VOs (from the dimension catalog). If
+        start_t_epoch and end_t_epoch are set, only the ones with jobs
+        within [start_t_epoch, end_t_epoch] (see get_active_names()).
+    """
+    return get_active_names('vo_name', start_t_epoch, end_t_epoch)
+
+def get_active_names(column, start_t_epoch=None, end_t_epoch=None):
+    """ returns list of the known values of the key column ('global_user_name', 
+        'vo_name', 'machine_name' or 'status') from the dimension catalog.
+        If start_t_epoch and end_t_epoch are set, only the values whose 
+        seen range (first_seen - last_seen, i.e. the time range of their
+        aggregates at the base resolution) overlaps the interval.
+    """
+    table = ag_schema.DIMENSION_TABLES[column]
+    where = None
+    if start_t_epoch is not None and end_t_epoch is not None:
+        where = and_(table.c.first_seen <= end_t_epoch, table.c.last_seen >= start_t_epoch)
+    return [row.name for row in sgascache_session.Session.execute(select([table.c.name],
+        where).order_by(table.c.name))]
 
-    return vos
 
 
+def _get_batched_acrecords(db_obj, column, names, start_t_epoch, end_t_epoch, resolution, **criteria):
+    """ returns dictionary {name: list of aggregates ordered by t_epoch} of
+        the aggregates of db_obj, whose key 'column' is any of names (every
+        name is included, even without aggregates), or None. The names are 
+        queried by IN (...), at most IN_CHUNK_SIZE names per query.
+        criteria: further key values, e.g. machine_name='ce1'
+    """
+    if resolution == 0:
+        log.warn("Got 0 resolution, can't fulfill request.")
+        return None
 
-def get_sampling_interval(start_t_epoch, end_t_epoch, resolution):
+    s_start, s_end = get_sampling_interval(start_t_epoch, end_t_epoch, resolution)
+
+    names = list(set(names))
+    records = dict([(name, []) for name in names])
+    # the database may return values, which differ from the requested names
+    # but are equal by its collation (e.g. case-insensitive in MySQL)
+    folded = dict()
+    for name in names:
+        folded.setdefault(_fold(name), []).append(name)
+    for i in range(0, len(names), IN_CHUNK_SIZE):
+        query = sgascache_session.Session.query(db_obj).filter(and_(
+            db_obj.t_epoch >= s_start,
+            db_obj.t_epoch <= s_end,
+            getattr(db_obj, column).in_(names[i:i + IN_CHUNK_SIZE]),
+            db_obj.resolution == resolution,
+            *[getattr(db_obj, c) == v for c, v in criteria.items()]))
+        for arec in query.order_by(db_obj.t_epoch):
+            value = getattr(arec, column)
+            if records.has_key(value):
+                records[value].append(arec)
+                continue
+            for name in folded.get(_fold(value), [value]):
+                records.setdefault(name, []).append(arec)
+    return records
+
+def _fold(name):
+    """ returns name case-folded and without trailing spaces """
+    if name is None:
+        return None
+    return name.lower().rstrip(' ')
+
+def get_users_acrecords(DNs, start_t_epoch, end_t_epoch, resolution):
+    """ batched get_user_acrecords(), returns dictionary {DN: list of
+        aggregates} or None.
+        DNs: list of user's certificate DNs
+    """
+    return _get_batched_acrecords(ag_schema.User, 'global_user_name', DNs,
+        start_t_epoch, end_t_epoch, resolution)
+
+def get_cluster_users_acrecords(hostname, DNs, start_t_epoch, end_t_epoch, resolution):
+    """ batched get_cluster_user_acrecords(), returns dictionary {DN: list 
+        of aggregates} or None.
+        DNs: list of user's certificate DNs
+    """
+    return _get_batched_acrecords(ag_schema.UserMachine, 'global_user_name', DNs,
+        start_t_epoch, end_t_epoch, resolution, machine_name=hostname)
+
+def get_clusters_acrecords(hostnames, start_t_epoch, end_t_epoch, resolution):
+    """ batched get_cluster_acrecords(), returns dictionary {hostname: list
+        of aggregates} or None.
+        hostnames: list of hostnames of the cluster frontends
+    """
+    return _get_batched_acrecords(ag_schema.Machine, 'machine_name', hostnames,
+        start_t_epoch, end_t_epoch, resolution)
+
+def get_vos_acrecords(vo_names, start_t_epoch, end_t_epoch, resolution):
+    """ batched get_vo_acrecords(), returns dictionary {VO name: list of
+        aggregates} or None.
+        vo_names: list of VO names
+    """
+    return _get_batched_acrecords(ag_schema.Vo, 'vo_name', vo_names,
+        start_t_epoch, end_t_epoch, resolution)
+
+def get_cluster_vos_acrecords(cluster_name, vo_names, start_t_epoch, end_t_epoch, resolution):
+    """ batched get_cluster_vo_acrecords(), returns dictionary {VO name: list
+        of aggregates} or None.
+        vo_names: list of VO names
+    """
+    return _get_batched_acrecords(ag_schema.VoMachine, 'vo_name', vo_names,
+        start_t_epoch, end_t_epoch, resolution, machine_name=cluster_name)
+
+def get_vo_users_acrecords(vo_name, DNs, start_t_epoch, end_t_epoch, resolution):
+    """ returns dictionary {DN: list of aggregates} of the users within the 
+        VO, or None.
+        DNs: list of user's certificate DNs
+    """
+    return _get_batched_acrecords(ag_schema.UserVo, 'global_user_name', DNs,
+        start_t_epoch, end_t_epoch, resolution, vo_name=vo_name)
+
+
+def get_series(db_obj, start_t_epoch, end_t_epoch, resolution, **criteria):
+    """ returns dense (zero-filled) time series of the aggregates of db_obj
+        within the sampling interval of [start_t_epoch, end_t_epoch], or None.
+        The series is a dictionary of contiguous int64 arrays (NumPy arrays,
+        or array('l') if NumPy is not available; float64 for non-integer
+        columns) of equal length:
+        't_epoch': t_epoch of every bucket of the interval (ascending)
+        'n_jobs', 'cpu_duration', ...: aggregated values per bucket, summed 
+                                       up over all matching keys
+        db_obj: aggregate class, e.g. ag_schema.Vo
+        criteria: key values, e.g. vo_name='smscg'
+    """
+    if resolution == 0:
+        log.warn("Got 0 resolution, can't fulfill request.")
+        return None
+
+    s_start, s_end = get_sampling_interval(start_t_epoch, end_t_epoch, resolution)
+
+    table = class_mapper(db_obj).mapped_table
+    rows = sgascache_session.Session.execute(select([table.c.t_epoch] + \
+        [func.sum(table.c[k]) for k in ag_schema.VALUE_COLUMNS], and_(
+            table.c.t_epoch >= s_start,
+            table.c.t_epoch <= s_end,
+            table.c.resolution == resolution,
+            *[table.c[c] == v for c, v in criteria.items()]),
+        group_by=[table.c.t_epoch])).fetchall()
+
+    return _fill_series(table, rows, s_start, s_end, resolution)
+
+def _fill_series(table, rows, s_start, s_end, resolution):
+    """ returns the dense series (see get_series()) of the rows (t_epoch,
+        sums of the VALUE_COLUMNS of table). The sums are converted by the
+        type of their column, as SUM() may return Decimal (e.g. MySQL) or
+        None.
+    """
+    n = (s_end - s_start + 1) / resolution
+    integer = [isinstance(table.c[k].type, Integer) for k in ag_schema.VALUE_COLUMNS]
+    sums = [[_convert(v, integer[i]) for i, v in enumerate(row[1:])] for row in rows]
+
+    np = vectorized.np
+    if np is not None:
+        series = dict(t_epoch=np.arange(s_start + resolution - 1, s_end + 1, resolution,
+            dtype=np.int64))
+        idx = np.array([(int(row[0]) - s_start) / resolution for row in rows], dtype=np.int64)
+        for i, k in enumerate(ag_schema.VALUE_COLUMNS):
+            values = np.zeros(n, dtype=integer[i] and np.int64 or np.float64)
+            values[idx] = [row[i] for row in sums]
+            series[k] = values
+        return series
+
+    series = dict(t_epoch=array('l', xrange(s_start + resolution - 1, s_end + 1, resolution)))
+    for i, k in enumerate(ag_schema.VALUE_COLUMNS):
+        series[k] = array(integer[i] and 'l' or 'd', [0]) * n
+    for row, values in zip(rows, sums):
+        j = (int(row[0]) - s_start) / resolution
+        for i, k in enumerate(ag_schema.VALUE_COLUMNS):
+            series[k][j] = values[i]
+    return series
+
+def _convert(value, integer):
+    """ returns the sum value as int (integer column) or float, 0 if None """
+    if value is None:
+        return 0
+    if integer:
+        return int(value)
+    return float(value)
+
+
+def get_resolutions(db_obj):
+    """ returns the resolutions of the aggregates of db_obj (e.g.
+        ag_schema.Vo) in ascending order, the configured ones if set (see
+        set_resolutions()).
+    """
+    if configured_resolutions is not None:
+        return list(configured_resolutions)
+    return _stored_resolutions(db_obj)
+
+@_cached(records=False)
+def _stored_resolutions(db_obj):
+    """ returns the distinct resolutions stored in the table of db_obj """
+    return sorted([arec.resolution for arec in \
+        sgascache_session.Session.query(db_obj.resolution).distinct()])
+
+def plan_intervals(start_t_epoch, end_t_epoch, resolutions):
+    """ returns list of (resolution, s_start, s_end) in ascending time order,
+        whose sampling intervals cover the one of the finest resolution for
+        [start_t_epoch, end_t_epoch] without overlaps. The interior of the
+        interval is covered by the coarsest aligned buckets, the edges by
+        finer ones. Resolutions which aren't a multiple of the finer ones
+        can't be combined and are ignored.
+    """
+    nested = list()
+    for resolution in sorted(set(resolutions)):
+        if nested and resolution % nested[-1]:
+            log.warn("Resolution %d is no multiple of %d, ignoring it." % \
+                (resolution, nested[-1]))
+            continue
+        nested.append(resolution)
+    if not nested:
+        return []
+
+    s_start, s_end = get_sampling_interval(start_t_epoch, end_t_epoch, nested[0])
+
+    def plan(t_start, t_end, resolutions):
+        """ plans [t_start, t_end), aligned to the finest resolution """
+        if t_start >= t_end:
+            return []
+        resolution = resolutions[-1]
+        if len(resolutions) == 1:
+            return [(resolution, t_start, t_end - 1)]
+        i_start, i_end = get_sampling_interval(t_start, t_end, resolution, inner=True)
+        if i_start > i_end:  # no bucket fits within
+            return plan(t_start, t_end, resolutions[:-1])
+        return plan(t_start, i_start, resolutions[:-1]) + [(resolution, i_start, i_end)] + \
+            plan(i_end + 1, t_end, resolutions[:-1])
+
+    return plan(s_start, s_end + 1, nested)
+
+def _planned_filter(db_obj, start_t_epoch, end_t_epoch, resolutions, criteria):
+    """ returns filter on the aggregates of db_obj of the planned intervals,
+        None if there are none.
+        criteria: dictionary {column: value} of further (equality) filters
+    """
+    if resolutions is None:
+        resolutions = get_resolutions(db_obj)
+    intervals = plan_intervals(start_t_epoch, end_t_epoch, resolutions)
+    if not intervals:
+        log.warn("No resolution to fulfill request.")
+        return None
+    log.debug("Planned intervals: %r" % intervals)
+
+    return and_(or_(*[and_(db_obj.resolution == resolution,
+            db_obj.t_epoch >= s_start,
+            db_obj.t_epoch <= s_end) for resolution, s_start, s_end in intervals]),
+        *[getattr(db_obj, column) == value for column, value in criteria.items()])
+
+def get_planned_acrecords(db_obj, start_t_epoch, end_t_epoch, resolutions=None, **criteria):
+    """ returns a query object of the aggregates (of mixed resolutions) or
+        None, which cover [start_t_epoch, end_t_epoch] (see plan_intervals()).
+        db_obj: aggregate class, e.g. ag_schema.Vo
+        resolutions: resolutions to combine (default all, see get_resolutions())
+        criteria: key values, e.g. vo_name='smscg'
+    """
+    where = _planned_filter(db_obj, start_t_epoch, end_t_epoch, resolutions, criteria)
+    if where is None:
+        return None
+    return sgascache_session.Session.query(db_obj).filter(where).order_by(db_obj.t_epoch)
+
+def get_planned_totals(db_obj, start_t_epoch, end_t_epoch, resolutions=None, **criteria):
+    """ returns dictionary with the totals of the aggregated values (n_jobs,
+        cpu_duration, ...) within [start_t_epoch, end_t_epoch], summed up by
+        a single query over the planned intervals (see plan_intervals()).
+        Arguments like get_planned_acrecords().
+    """
+    where = _planned_filter(db_obj, start_t_epoch, end_t_epoch, resolutions, criteria)
+    if where is None:
+        return None
+    row = sgascache_session.Session.query(*[func.coalesce(func.sum(getattr(db_obj, k)), 0) \
+        for k in ag_schema.VALUE_COLUMNS]).filter(where).one()
+    return dict(zip(ag_schema.VALUE_COLUMNS, [int(v) for v in row]))
+
+def get_top(db_obj, column, measure, n, start_t_epoch, end_t_epoch, resolutions=None, **criteria):
+    """ returns list of the top n (value of column, total of measure) within
+        [start_t_epoch, end_t_epoch], ordered by the total (descending), or 
+        None. The totals are summed up, ordered and limited by a single 
+        query over the planned intervals (see plan_intervals()), i.e. using
+        the coarsest resolutions fitting within the interval.
+        db_obj: aggregate class, e.g. ag_schema.UserMachine
+        column: key column to rank, e.g. 'global_user_name'
+        measure: aggregated value, e.g. 'cpu_duration'
+        resolutions: resolutions to combine (default all, see get_resolutions())
+        criteria: key values, e.g. machine_name='ce1'
+
+        E.g. top 20 users by cpu_duration on cluster X:
+            get_top(ag_schema.UserMachine, 'global_user_name', 'cpu_duration', 20,
+                start_t_epoch, end_t_epoch, machine_name=X)
+    """
+    if measure not in ag_schema.VALUE_COLUMNS:
+        log.warn("Unknown measure '%s', can't fulfill request." % measure)
+        return None
+    if not hasattr(db_obj, column):
+        log.warn("No column '%s' in %s, can't fulfill request." % (column, db_obj.__name__))
+        return None
+
+    where = _planned_filter(db_obj, start_t_epoch, end_t_epoch, resolutions, criteria)
+    if where is None:
+        return None
+    total = func.sum(getattr(db_obj, measure))
+    query = sgascache_session.Session.query(getattr(db_obj, column), total).filter(where).\
+        group_by(getattr(db_obj, column)).order_by(total.desc(), getattr(db_obj, column)).limit(n)
+    return [(row[0], int(row[1] or 0)) for row in query]
+
+def get_total(db_obj, start_t_epoch, end_t_epoch, resolution, **criteria):
+    """ returns dictionary with the totals of the aggregated values (n_jobs,
+        cpu_duration, ...) of a series within the sampling interval of 
+        [start_t_epoch, end_t_epoch], or None. The totals are the difference
+        of the running totals (see cumulative) at the end and before the 
+        start of the interval, i.e. two lookups. Requires the aggregator to 
+        maintain the running totals ('cumulative' option).
+        db_obj: aggregate class, e.g. ag_schema.UserMachine
+        criteria: values of all key columns, e.g. global_user_name=DN, 
+                  machine_name='ce1'
+    """
+    if resolution == 0:
+        log.warn("Got 0 resolution, can't fulfill request.")
+        return None
+
+    cum = ag_schema.CUMULATIVE_TABLES[class_mapper(db_obj).mapped_table.name]
+    keys = [c.name for c in cum.columns if c.primary_key and c.name not in ('resolution', 't_epoch')]
+    if sorted(criteria.keys()) != sorted(keys):
+        log.warn("Series not fully specified (%s required), can't fulfill request." % \
+            ', '.join(keys))
+        return None
+
+    s_start, s_end = get_sampling_interval(start_t_epoch, end_t_epoch, resolution)
+
+    def running_totals(t_epoch):
+        """ returns running totals of the last bucket up to t_epoch """
+        row = sgascache_session.Session.execute(select([cum.c[k] for k in ag_schema.VALUE_COLUMNS],
+            and_(cum.c.resolution == resolution,
+                cum.c.t_epoch <= t_epoch,
+                *[cum.c[c] == v for c, v in criteria.items()])).\
+            order_by(cum.c.t_epoch.desc()).limit(1)).fetchone()
+        if not row:
+            return [0] * len(ag_schema.VALUE_COLUMNS)
+        return [int(v or 0) for v in row]
+
+    totals = [e - s for e, s in zip(running_totals(s_end), running_totals(s_start - 1))]
+    return dict(zip(ag_schema.VALUE_COLUMNS, totals))
+
+
+def get_sampling_interval(start_t_epoch, end_t_epoch, resolution, inner=False):
     """ The time interval of a *continuous* query must be adapted, so 
         it matches the *discrete* time boundaries (or sampling time 
         boundaries) of the aggregates.
@@ -190,9 +624,18 @@ def get_sampling_interval(start_t_epoch, end_t_epoch, resolution):
         Input:  start_t_epoch: starting time (continuous), in epoch time
                 end_t_epoch:   end time (continuous), in epoch time
                 resolution: resolution, aka sampling size/rate 
+                inner: if set, the sampling interval of the buckets lying 
+                       completely within [start_t_epoch, end_t_epoch) is
+                       returned instead (i.e. start is rounded up and end 
+                       rounded down). It's empty if start > end.
 
         Returns: sampling_start_t, sampling_end_t
     """
+    if inner:
+        samp_start_t = start_t_epoch + (-start_t_epoch % resolution)
+        samp_end_t = end_t_epoch - (end_t_epoch % resolution) - 1
+        return samp_start_t, samp_end_t
+
     samp_start_t = start_t_epoch - (start_t_epoch % resolution) 
     samp_end_t=  end_t_epoch - (end_t_epoch % resolution) + resolution - 1
 
@@ -0,0 +1,113 @@
+"""
+Vectorized (NumPy based) aggregation kernel.
+
+The aggregator keeps its in-memory aggregates as dictionaries, which map the
+key (the values of the key columns followed by t_epoch) to the list of the
+aggregated values (see UrAggregator._rollup()). Summing such rows up to
+several coarser keys row by row costs a lot of Python work per row and key.
+
+Here the rows are held column-wise: the key columns get dictionary-encoded
+into integer codes (by np.unique), which are combined into one group id per
+row. The values are summed up per group id into int64 arrays (sorted by group
+id, then np.add.reduceat). Only the resulting (aggregated) rows are converted
+back into a dictionary.
+
+Converting the rows from and back to dictionaries costs about as much as
+summing them up in Python once. Hence, the kernel only pays off if the same
+(encoded) rows are rolled up several times, i.e. for deriving all keys from
+the key_0 rows (see UrAggregator._rollup_lattice()). Single rollups stay in
+Python.
+
+NumPy is an optional dependency; use available() before using the kernel.
+"""
+
+from itertools import izip
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# upper bound of combined group ids (to avoid int64 overflows)
+MAX_GROUP_ID = 2 ** 62
+
+
+def available():
+    """ returns True if the vectorized kernel can be used (i.e. NumPy is installed) """
+    return np is not None
+
+
+def encode(column):
+    """ dictionary-encodes a sequence of values.
+        returns (codes, values), codes (int64 array) index into values
+        (object array of the distinct values)
+    """
+    values, codes = np.unique(np.array(column, dtype=object), return_inverse=True)
+    return codes.astype(np.int64), values
+
+
+class Rows(object):
+    """
+    Column-wise, dictionary-encoded representation of in-memory rows.
+
+    dims: list of encoded key columns (see encode())
+    t_epoch: int64 array of t_epoch per row
+    values: int64 array (rows x aggregated values)
+    """
+
+    def __init__(self, dims, t_epoch, values):
+        self.dims = dims
+        self.t_epoch = t_epoch
+        self.values = values
+        self.n_rows = len(t_epoch)
+
+    def rollup(self, idx=None, resolution=None):
+        """ Sums up the rows by the key columns at positions idx (all key columns
+            if not set) and t_epoch. If resolution is set, t_epoch is mapped to the
+            end of the corresponding bucket of that resolution.
+            returns dictionary {key: [values]}
+        """
+        if not self.n_rows:
+            return dict()
+
+        if idx is None:
+            idx = range(len(self.dims))
+
+        t_epoch = self.t_epoch
+        if resolution:
+            t_epoch = t_epoch - (t_epoch % resolution) + resolution - 1
+
+        t_uniq, group = np.unique(t_epoch, return_inverse=True)
+        group = group.astype(np.int64)
+        n_groups = len(t_uniq)
+
+        for i in idx:
+            codes, dim_values = self.dims[i]
+            if n_groups * len(dim_values) > MAX_GROUP_ID:  # compact ids first
+                uniq, group = np.unique(group, return_inverse=True)
+                group = group.astype(np.int64)
+                n_groups = len(uniq)
+            group = group * len(dim_values) + codes
+            n_groups *= len(dim_values)
+
+        order = np.argsort(group, kind='mergesort')
+        group = group[order]
+        starts = np.flatnonzero(np.concatenate(([True], group[1:] != group[:-1])))
+        sums = np.add.reduceat(self.values[order], starts, axis=0)
+        first = order[starts]
+
+        columns = [self.dims[i][1][self.dims[i][0][first]].tolist() for i in idx]
+        columns.append(t_epoch[first].tolist())
+        return dict(izip(izip(*columns), sums.tolist()))
+
+
+def from_dict(rows, n_dims):
+    """ returns Rows object of the in-memory rows (dictionary) """
+    if not rows:
+        return Rows([], np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=np.int64))
+
+    keys = rows.keys()
+    columns = zip(*keys)
+    return Rows([encode(columns[i]) for i in range(n_dims)],
+        np.array(columns[n_dims], dtype=np.int64),
+        np.array([rows[key] for key in keys], dtype=np.int64))
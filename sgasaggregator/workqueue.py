@@ -0,0 +1,315 @@
+"""
+Work queue of aggregation tasks, shared by cooperating aggregator daemons.
+
+The tasks are kept in the 'work_queue' table of the SGAS cache database. Each
+task belongs to a batch (one batch per planned aggregation) and has a step.
+A task can only be claimed once all tasks of the same batch with a smaller
+step are done, e.g. the aggregation of a key waits for the one of its parent
+key (see UrAggregator.plan()). Besides, a task waits for the queued and
+running tasks of earlier batches, whose time range overlaps its own, so
+the aggregates of a time range are written in the order of the batches.
+
+Daemons claim tasks by a lease, which is prolonged by a heartbeat as long as
+the task is running. A claim selects a claimable task and takes it over by
+a conditional UPDATE, which fails if another daemon was faster (the claim is
+retried then). With PostgreSQL >= 9.5 and MySQL >= 8.0, the task is selected
+by SELECT ... FOR UPDATE SKIP LOCKED, i.e. concurrent claims don't even pick
+the same task. Tasks with an
+expired lease (e.g. of a dead daemon) can be claimed by other daemons. Failed
+tasks are re-queued until they have been attempted 'max_attempts' times.
+A daemon keeps polling for claimable tasks as long as tasks of other daemons
+are running, as these may unblock further tasks.
+
+A task, which fails for good, cancels the queued tasks of the later steps of
+its batch, so they don't block later batches. The records of such a batch
+are not aggregated until its tasks get re-queued (see requeue_failed(), e.g.
+by 'sgas_aggregator requeue').
+
+Task states: queued -> running -> done (or failed, the later steps of the
+batch: cancelled)
+"""
+
+import os
+import time
+import socket
+import logging
+import threading
+
+from sqlalchemy import and_ as AND
+from sqlalchemy import or_ as OR
+from sqlalchemy import select, case, func, text
+
+from sgasaggregator.sgascache import ag_schema
+
+LEASE = 600  # default lease of claimed tasks [secs]
+MAX_ATTEMPTS = 3
+KEEP_DONE = 86400  # default time [secs] done batches are kept
+POLL = 5  # interval [secs] of polling for tasks waiting on other daemons
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+TASK_COLUMNS = ['stage', 'key_name', 'resolution', 'factor', 't_start', 't_end']
+
+
+class WorkQueue(object):
+    """ Queue of aggregation tasks in the SGAS cache database. """
+
+    def __init__(self, engine, owner=None, lease=LEASE, max_attempts=MAX_ATTEMPTS,
+            keep_done=KEEP_DONE, poll=POLL):
+        """
+        engine: engine of the SGAS cache database
+        owner: name of this daemon (default <hostname>:<pid>)
+        lease: lease of claimed tasks [secs], prolonged by heartbeats
+        max_attempts: max. number of attempts to run a task
+        keep_done: time [secs] done batches are kept (see purge_done())
+        poll: interval [secs] of polling for claimable tasks (see run())
+        """
+        self.log = logging.getLogger(__name__)
+        self.engine = engine
+        self.owner = owner or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.keep_done = keep_done
+        self.poll = poll
+        self.table = ag_schema.t_work_queue
+        self.skip_locked = None  # whether the database supports SKIP LOCKED, see claim()
+
+    def next_batch(self, session):
+        """ returns number of a new batch """
+        batch = session.execute(select([func.max(self.table.c.batch)])).scalar()
+        return (batch or 0) + 1
+
+    def enqueue(self, session, batch, tasks):
+        """ queues the tasks (list of dictionaries with 'step' and the
+            TASK_COLUMNS) as batch, within the transaction of session.
+        """
+        if not tasks:
+            return
+        now = int(time.time())
+        rows = list()
+        for task in tasks:
+            row = dict([(c, task.get(c)) for c in TASK_COLUMNS])
+            row.update(dict(batch=batch, step=task['step'], state=QUEUED, attempts=0,
+                updated=now))
+            rows.append(row)
+        session.execute(self.table.insert(), rows)
+        self.log.info("Queued %d tasks (batch %d)" % (len(rows), batch))
+
+    def _claimable(self, now):
+        """ returns filter of the tasks, which can be claimed at time now """
+        wq = self.table.c
+        return OR(wq.state == QUEUED, AND(wq.state == RUNNING, wq.lease_until < now))
+
+    def _supports_skip_locked(self, conn):
+        """ returns True if the database supports SELECT ... FOR UPDATE SKIP
+            LOCKED (PostgreSQL >= 9.5, MySQL >= 8.0, MariaDB >= 10.6)
+        """
+        dialect = conn.dialect
+        version = dialect.server_version_info
+        if dialect.name == 'postgresql':
+            return version >= (9, 5)
+        if dialect.name == 'mysql':
+            if 'mariadb' in conn.execute(text("SELECT VERSION()")).scalar().lower():
+                return version >= (10, 6)
+            return version >= (8, 0)
+        return False
+
+    def claim(self):
+        """ claims the next claimable task. returns the task (dictionary of
+            the work_queue columns) or None if there is none.
+        """
+        preparer = self.engine.dialect.identifier_preparer
+        name = preparer.format_table(self.table)
+
+        conn = self.engine.connect()
+        try:
+            if self.skip_locked is None:
+                self.skip_locked = self._supports_skip_locked(conn)
+                if not self.skip_locked:
+                    self.log.info("No SKIP LOCKED support, claiming tasks by conditional updates")
+
+            sql = "SELECT w.id FROM %s w WHERE (w.state = :queued OR " \
+                "(w.state = :running AND w.lease_until < :now)) AND NOT EXISTS " \
+                "(SELECT 1 FROM %s d WHERE d.batch = w.batch AND d.step < w.step " \
+                "AND d.state <> :done) AND NOT EXISTS " \
+                "(SELECT 1 FROM %s e WHERE e.batch < w.batch AND e.state IN (:queued, :running) " \
+                "AND e.t_start < w.t_end AND w.t_start < e.t_end) " \
+                "ORDER BY w.batch, w.step, w.id LIMIT 1" % (name, name, name)
+            if self.skip_locked:
+                sql += " FOR UPDATE SKIP LOCKED"
+
+            while True:
+                now = int(time.time())
+                trans = conn.begin()
+                try:
+                    row = conn.execute(text(sql), queued=QUEUED, running=RUNNING, now=now,
+                        done=DONE).fetchone()
+                    claimed = 0
+                    if row:  # fails, if another daemon claimed it meanwhile
+                        claimed = conn.execute(self.table.update(AND(self.table.c.id == row[0],
+                            self._claimable(now))).values(state=RUNNING, owner=self.owner,
+                            lease_until=now + self.lease, attempts=self.table.c.attempts + 1,
+                            updated=now)).rowcount
+                    trans.commit()
+                except:
+                    trans.rollback()
+                    raise
+
+                if not row:
+                    return None
+                if claimed:
+                    break
+                self.log.debug("Task %d got claimed by another daemon, retrying" % row[0])
+
+            task = dict(conn.execute(self.table.select(self.table.c.id == row[0])).fetchone().items())
+        finally:
+            conn.close()
+
+        self.log.debug("Claimed task %d: %s" % (task['id'], self.describe(task)))
+        return task
+
+    def running(self):
+        """ returns number of tasks being run (with a valid lease). Unless
+            there are claimable tasks, only these may unblock queued tasks.
+        """
+        wq = self.table.c
+        return self.engine.execute(select([func.count(wq.id)],
+            AND(wq.state == RUNNING, wq.lease_until >= int(time.time())))).scalar()
+
+    def describe(self, task):
+        """ returns readable description of task """
+        return ', '.join(['%s=%s' % (c, task[c]) for c in TASK_COLUMNS if task[c] is not None])
+
+    def _update(self, task, **values):
+        """ updates task (if still owned by us). returns True on success """
+        values['updated'] = int(time.time())
+        n = self.engine.execute(self.table.update(AND(self.table.c.id == task['id'],
+            self.table.c.owner == self.owner, self.table.c.state == RUNNING)), **values).rowcount
+        return n == 1
+
+    def heartbeat(self, task):
+        """ prolongs the lease of task. returns False if we lost it """
+        if not self._update(task, lease_until=int(time.time()) + self.lease):
+            self.log.warn("Lost lease of task %d" % task['id'])
+            return False
+        return True
+
+    def complete(self, task):
+        """ marks task as done """
+        if not self._update(task, state=DONE, message=None):
+            self.log.warn("Task %d finished after losing its lease" % task['id'])
+
+    def fail(self, task, message):
+        """ re-queues the failed task, or marks it as failed if it has been
+            attempted max_attempts times. In the latter case, the queued
+            tasks of the later steps of its batch get cancelled.
+        """
+        if task['attempts'] < self.max_attempts:
+            self._update(task, state=QUEUED, owner=None, lease_until=None, message=message[:1000])
+            return
+
+        self.log.error("Task %d (%s) failed %d times, giving up" % (task['id'],
+            self.describe(task), task['attempts']))
+        if not self._update(task, state=FAILED, owner=None, lease_until=None,
+                message=message[:1000]):
+            return
+        wq = self.table.c
+        n = self.engine.execute(self.table.update(AND(wq.batch == task['batch'],
+            wq.step > task['step'], wq.state == QUEUED)), state=CANCELLED,
+            message='step %d failed' % task['step'], updated=int(time.time())).rowcount
+        if n:
+            self.log.error("Cancelled %d tasks of batch %d depending on task %d" % \
+                (n, task['batch'], task['id']))
+
+    def requeue_failed(self):
+        """ re-queues all failed and cancelled tasks. returns their number """
+        n = self.engine.execute(self.table.update(self.table.c.state.in_([FAILED, CANCELLED])),
+            state=QUEUED, attempts=0, owner=None, lease_until=None,
+            updated=int(time.time())).rowcount
+        self.log.info("Re-queued %d failed or cancelled tasks" % n)
+        return n
+
+    def report(self):
+        """ logs an error for the tasks, which are left over (i.e. failed,
+            cancelled or queued, while none can be claimed). returns their
+            number.
+        """
+        wq = self.table.c
+        counts = dict([(row[0], row[1]) for row in self.engine.execute(select([wq.state,
+            func.count(wq.id)], wq.state.in_([QUEUED, FAILED, CANCELLED]),
+            group_by=[wq.state]))])
+        if counts.get(QUEUED):
+            self.log.error("%d tasks are queued, but none of them can be claimed" % \
+                counts[QUEUED])
+        failed = counts.get(FAILED, 0) + counts.get(CANCELLED, 0)
+        if failed:
+            batches = [row[0] for row in self.engine.execute(select([wq.batch],
+                wq.state == FAILED, group_by=[wq.batch], order_by=[wq.batch]))]
+            self.log.error("%d tasks of batches %s failed or got cancelled, their records " \
+                "are not aggregated. Re-queue them by 'sgas_aggregator requeue'" % \
+                (failed, ', '.join([str(b) for b in batches])))
+        return sum(counts.values())
+
+    def purge_done(self, age=None):
+        """ removes the batches, whose tasks have all been done since more
+            than age [secs] (default keep_done). returns number of removed tasks.
+        """
+        if age is None:
+            age = self.keep_done
+        wq = self.table.c
+        batches = [row[0] for row in self.engine.execute(select([wq.batch],
+            group_by=[wq.batch], having=AND(func.max(wq.updated) < int(time.time()) - age,
+            func.sum(case([(wq.state != DONE, 1)], else_=0)) == 0)))]
+        if not batches:
+            return 0
+        return self.engine.execute(self.table.delete(wq.batch.in_(batches))).rowcount
+
+    def _heartbeats(self, task, stop):
+        while True:
+            stop.wait(self.lease / 3)
+            if stop.isSet():
+                break
+            try:
+                self.heartbeat(task)
+            except Exception, e:
+                self.log.warn("Heartbeat of task %d failed: %r" % (task['id'], e))
+
+    def run(self, execute):
+        """ claims and runs tasks by execute(task), until no task is left
+            to claim. Tasks waiting on tasks run by other daemons are polled
+            for. returns number of run tasks.
+        """
+        n = 0
+        while True:
+            task = self.claim()
+            if not task:
+                if not self.running():
+                    break
+                time.sleep(self.poll)
+                continue
+
+            stop = threading.Event()
+            heartbeats = threading.Thread(target=self._heartbeats, args=(task, stop))
+            heartbeats.setDaemon(True)
+            heartbeats.start()
+            try:
+                try:
+                    execute(task)
+                except Exception, e:
+                    self.log.exception(e)
+                    self.fail(task, repr(e))
+                else:
+                    self.complete(task)
+            finally:
+                stop.set()
+                heartbeats.join()
+            n += 1
+
+        if n:
+            self.log.info("Ran %d tasks" % n)
+        self.report()
+        return n
@@ -0,0 +1,147 @@
+"""
+Base of the tests, which need an SGAS cache database.
+
+Every test gets a fresh sqlite database file as SGAS cache, which is bound to
+sgascache.session (see dbinit.init_model()) and removed after the test.
+
+The tests of the aggregation (AggregationTestCase) need an SGAS database,
+whose schema is PostgreSQL only. They run on the (scratch!) databases of the
+environment variables SGAS_TEST_SGAS_URL and SGAS_TEST_CACHE_URL, e.g.
+
+    SGAS_TEST_SGAS_URL=postgresql:///sgas_test
+    SGAS_TEST_CACHE_URL=postgresql:///sgascache_test
+
+and are skipped if they are not set. All their records and aggregates get
+deleted.
+"""
+
+import os
+import time
+import random
+import tempfile
+import unittest
+from datetime import datetime
+
+from sqlalchemy import create_engine, select
+
+from sgasaggregator import dbinit
+from sgasaggregator import uraggregator
+from sgasaggregator.sgas import sgas_schema
+from sgasaggregator.sgas import session as sgas_session
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import session as sgascache_session
+
+SGAS_URL = os.environ.get('SGAS_TEST_SGAS_URL')
+CACHE_URL = os.environ.get('SGAS_TEST_CACHE_URL')
+
+DAY = 86400
+FACTORS = [7, 28]  # further resolutions of the aggregation tests
+DAYS_BACK = 40  # refresh_days_back of the aggregation tests
+
+USERS = ['/CN=alice', '/CN=bob', '/CN=carol']
+VOS = [('voms', 'smscg'), ('voms', 'atlas'), ('grid-vo-map', 'life.ch'), (None, ''),
+    ('x', 'novo')]
+MACHINES = ['ce1', 'ce2', 'ce3']
+STATUS = ['completed', 'failed', 'killed']
+
+
+def _sqlite_file():
+    """ returns path of a new (empty) sqlite database file """
+    fd, path = tempfile.mkstemp(prefix='sgas_test_', suffix='.db')
+    os.close(fd)
+    return path
+
+
+class CacheTestCase(unittest.TestCase):
+    """ TestCase with an SGAS cache database """
+
+    def setUp(self):
+        self.cache_path = _sqlite_file()
+        dbinit.init_model(sgascache_session, create_engine('sqlite:///%s' % self.cache_path))
+
+    def tearDown(self):
+        sgascache_session.Session.remove()
+        sgascache_session.engine.dispose()
+        os.remove(self.cache_path)
+
+
+class AggregationTestCase(unittest.TestCase):
+    """ TestCase with an (empty) SGAS database and SGAS cache (see above) """
+
+    def setUp(self):
+        if not SGAS_URL or not CACHE_URL:
+            self.skipTest("SGAS_TEST_SGAS_URL and SGAS_TEST_CACHE_URL not set")
+        dbinit.init_model(sgas_session, create_engine(SGAS_URL))
+        dbinit.init_model(sgascache_session, create_engine(CACHE_URL))
+        sgas_session.engine.execute(sgas_schema.t_usagerecords.delete())
+        self.reset_cache()
+        self.n_records = 0
+
+    def tearDown(self):
+        sgas_session.Session.remove()
+        sgas_session.engine.dispose()
+        sgascache_session.Session.remove()
+        sgascache_session.engine.dispose()
+
+    def reset_cache(self):
+        """ recreates all tables of the SGAS cache """
+        sgascache_session.Session.remove()
+        sgascache_session.metadata.drop_all(bind=sgascache_session.engine)
+        sgascache_session.metadata.create_all(bind=sgascache_session.engine)
+
+    def add_records(self, n, days_back, seed, insert_time=None, min_days_back=0):
+        """ adds n random SGAS records, which ended within the last days_back
+            (but not within the last min_days_back) days and got inserted at
+            insert_time (default: 10 minutes ago, i.e. before the safety lag)
+        """
+        rnd = random.Random(seed)
+        now = int(time.time())
+        if insert_time is None:
+            insert_time = datetime.utcfromtimestamp(now - 600)
+        records = list()
+        for i in range(n):
+            self.n_records += 1
+            vo_type, vo_name = rnd.choice(VOS)
+            records.append(dict(record_id='rec-%d-%d' % (seed, self.n_records),
+                create_time=insert_time, global_user_name=rnd.choice(USERS),
+                vo_type=vo_type, vo_name=vo_name, machine_name=rnd.choice(MACHINES),
+                status=rnd.choice(STATUS),
+                end_time=datetime.utcfromtimestamp(now - rnd.randint(min_days_back * DAY,
+                    days_back * DAY)),
+                cpu_duration=rnd.choice([None, rnd.randint(0, 5000)]),
+                wall_duration=rnd.randint(0, 5000), user_time=rnd.randint(0, 100),
+                kernel_time=rnd.choice([None, 3]), major_page_faults=rnd.randint(0, 10),
+                insert_identity='test', insert_time=insert_time))
+        sgas_session.engine.execute(sgas_schema.t_usagerecords.insert(), records)
+
+    def snapshot(self, tables=ag_schema.AGGREGATE_TABLES):
+        """ returns {table name: {primary key: values}} of the aggregates """
+        snapshot = dict()
+        for table in tables:
+            keys = list(table.primary_key.columns)
+            values = [table.c[k] for k in ag_schema.VALUE_COLUMNS]
+            snapshot[table.name] = dict([(tuple(row[:len(keys)]),
+                tuple([v or 0 for v in row[len(keys):]])) for row in \
+                sgascache_session.engine.execute(select(keys + values))])
+        return snapshot
+
+    def rebuilt(self):
+        """ returns the snapshot of the aggregates of all SGAS records,
+            rebuilt from scratch (by the 'orm' ingest and key by key). The
+            SGAS cache gets recreated before and after.
+        """
+        self.reset_cache()
+        aggregator = uraggregator.UrAggregator(DAYS_BACK)
+        aggregator.rebuild_aggregation(aggregator.last_aggregation_time_epoch, DAY, FACTORS)
+        snapshot = self.snapshot()
+        self.reset_cache()
+        return snapshot
+
+    def assertSnapshot(self, expected, actual=None):
+        """ compares the aggregates (default: current ones) table by table """
+        if actual is None:
+            actual = self.snapshot()
+        self.assertTrue(expected[ag_schema.t_user_vo_machine_status.name], "no aggregates")
+        for name in sorted(expected.keys()):
+            self.assertEqual(sorted(expected[name].items()), sorted(actual[name].items()),
+                "aggregates of %s differ" % name)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Checks that the ResultCache drops its entries once the generation counter
+of the SGAS cache changes, and that it respects its bounds.
+"""
+
+import unittest
+
+from sgasaggregator.sgascache import session as sgascache_session
+from sgasaggregator.utils import cache
+
+import dbtest
+
+
+class ResultCacheTest(dbtest.CacheTestCase):
+
+    def _bump(self):
+        session = sgascache_session.Session()
+        cache.bump_generation(session)
+        session.commit()
+
+    def test_generation(self):
+        self.assertEqual(cache.current_generation(sgascache_session.engine), 0)
+        self._bump()
+        self._bump()
+        self.assertEqual(cache.current_generation(sgascache_session.engine), 2)
+
+    def test_invalidation(self):
+        rc = cache.ResultCache(check_interval=0)
+        self.assertEqual(rc.get('a'), (False, None))
+        rc.put('a', [1, 2], 2, rc.generation)
+        self.assertEqual(rc.get('a'), (True, [1, 2]))
+
+        self._bump()
+        self.assertEqual(rc.get('a'), (False, None))
+        self.assertEqual(rc.rows, 0)
+        self.assertEqual(rc.generation, 1)
+
+    def test_check_interval(self):
+        rc = cache.ResultCache(check_interval=3600)
+        rc.get('a')
+        rc.put('a', 1)
+        self._bump()  # not noticed before the next check
+        self.assertEqual(rc.get('a'), (True, 1))
+        rc.checked = 0
+        self.assertEqual(rc.get('a'), (False, None))
+
+    def test_stale_put(self):
+        rc = cache.ResultCache(check_interval=0)
+        rc.get('a')
+        generation = rc.generation
+        self._bump()
+        rc.get('b')  # notices the new generation
+        rc.put('a', 1, 1, generation)  # queried before the change
+        self.assertEqual(rc.get('a'), (False, None))
+
+    def test_ttl(self):
+        rc = cache.ResultCache(ttl=-1, check_interval=0)
+        rc.get('a')
+        rc.put('a', 1)
+        self.assertEqual(rc.get('a'), (False, None))
+
+    def test_bounds(self):
+        rc = cache.ResultCache(max_entries=2, max_rows=10, check_interval=3600)
+        rc.get('a')  # reads the generation
+        rc.put('a', 1)
+        rc.put('b', 2)
+        rc.get('a')
+        rc.put('c', 3)  # evicts b, the least recently used
+        self.assertEqual(sorted(rc.entries.keys()), ['a', 'c'])
+        rc.put('d', range(9), 9)
+        self.assertTrue(rc.rows <= 10)
+        self.assertEqual(rc.get('d'), (True, range(9)))
+        rc.put('e', range(11), 11)  # too large
+        self.assertEqual(rc.get('e'), (False, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
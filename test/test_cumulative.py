@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Checks that the interval totals from the running totals (see cumulative)
+equal the sums over the rebuilt aggregates, also after late records.
+"""
+
+import random
+import time
+import unittest
+from datetime import datetime
+
+from sqlalchemy.orm import class_mapper
+
+from sgasaggregator import cumulative
+from sgasaggregator import uraggregator
+from sgasaggregator.sgas import sgas_schema
+from sgasaggregator.sgas import session as sgas_session
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import session as sgascache_session
+from sgasaggregator.utils import helpers
+
+import dbtest
+from dbtest import DAY, FACTORS, DAYS_BACK
+
+SERIES = [(ag_schema.Vo, dict(vo_name='smscg')),
+    (ag_schema.UserMachine, dict(global_user_name='/CN=bob', machine_name='ce1'))]
+
+
+class CumulativeTest(dbtest.AggregationTestCase):
+
+    def _expected(self, db_obj, resolution, start_t_epoch, end_t_epoch, criteria):
+        """ returns the totals of the series, summed up over the rebuilt
+            aggregates
+        """
+        table = class_mapper(db_obj).mapped_table
+        s_start, s_end = helpers.get_sampling_interval(start_t_epoch, end_t_epoch, resolution)
+        names = [c.name for c in table.primary_key.columns]
+        totals = [0] * len(ag_schema.VALUE_COLUMNS)
+        for key, values in self.expected[table.name].items():
+            key = dict(zip(names, key))
+            if key['resolution'] != resolution or not s_start <= key['t_epoch'] <= s_end:
+                continue
+            if [c for c, v in criteria.items() if key[c] != v]:
+                continue
+            for i, v in enumerate(values):
+                totals[i] += v
+        return dict(zip(ag_schema.VALUE_COLUMNS, totals))
+
+    def _run(self, aggregation_mode):
+        self.add_records(300, 30, seed=1)
+        # late records, inserted after the first run (i.e. within the safety lag)
+        self.add_records(30, 30, seed=2, insert_time=datetime.utcfromtimestamp(time.time()))
+        self.expected = self.rebuilt()
+
+        aggregator = uraggregator.UrAggregator(DAYS_BACK, aggregation_mode=aggregation_mode)
+        aggregator.cumulative = cumulative.CumulativeTotals(aggregator.writer)
+        aggregator.main(DAY, FACTORS)
+        UR = sgas_schema.t_usagerecords
+        sgas_session.engine.execute(UR.update(UR.c.record_id.like('rec-2-%'),
+            values=dict(insert_time=datetime.utcfromtimestamp(time.time() - 400))))
+        aggregator.main(DAY, FACTORS)
+
+        rnd = random.Random(3)
+        now = int(time.time())
+        for i in range(20):
+            start = now - rnd.randint(0, 40 * DAY)
+            end = start + rnd.randint(0, 30 * DAY)
+            for resolution in (DAY, 7 * DAY):
+                for db_obj, criteria in SERIES:
+                    self.assertEqual(helpers.get_total(db_obj, start, end, resolution,
+                        **criteria), self._expected(db_obj, resolution, start, end, criteria))
+
+    def test_rebuild(self):
+        self._run('rebuild')
+
+    def test_incremental(self):
+        if not uraggregator.upsert_supported(sgascache_session.engine):
+            self.skipTest("No upserts in the SGAS cache database")
+        self._run('incremental')
+
+
+if __name__ == '__main__':
+    unittest.main()
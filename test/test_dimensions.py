@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Checks that the DimensionCache writes the dimension catalog within the
+session of the caller, i.e. that rolled back values and seen ranges are
+neither stored nor cached. After an aggregation, the catalog must hold the
+values and seen ranges of the rebuilt aggregates.
+"""
+
+import unittest
+
+from sqlalchemy import create_engine, select
+
+from sgasaggregator import uraggregator
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import dimensions
+from sgasaggregator.sgascache import session as sgascache_session
+from sgasaggregator.utils import helpers
+
+import dbtest
+from dbtest import FACTORS, DAYS_BACK
+
+DAY = 86400
+
+# key column -> aggregate table of the column alone
+KEY_TABLES = {
+    'global_user_name': ag_schema.t_user,
+    'vo_name': ag_schema.t_vo,
+    'machine_name': ag_schema.t_machine,
+    'status': ag_schema.t_status
+}
+
+
+def _row(vo_name, day):
+    return dict(vo_name=vo_name, resolution=DAY, t_epoch=(day + 1) * DAY - 1)
+
+
+class DimensionCacheTest(dbtest.CacheTestCase):
+
+    def setUp(self):
+        dbtest.CacheTestCase.setUp(self)
+        self.dims = dimensions.DimensionCache()
+        self.session = sgascache_session.Session()
+
+    def _catalog(self):
+        """ returns the committed rows of dim_vo (by a connection of its own) """
+        t = ag_schema.t_dim_vo
+        engine = create_engine('sqlite:///%s' % self.cache_path)
+        try:
+            return [tuple(row) for row in engine.execute(select(
+                [t.c.name, t.c.first_seen, t.c.last_seen], order_by=t.c.name))]
+        finally:
+            engine.dispose()
+
+    def test_commit(self):
+        self.dims.register(self.session, [_row('atlas', 1), _row('atlas', 2), _row('cms', 1)])
+        self.assertEqual(self._catalog(), [])  # not committed yet
+        self.session.commit()
+        self.assertEqual(self._catalog(), [('atlas', DAY, 3 * DAY - 1),
+            ('cms', DAY, 2 * DAY - 1)])
+
+        self.dims.register(self.session, [_row('atlas', 0), _row('cms', 1)])
+        self.session.commit()
+        self.assertEqual(self._catalog(), [('atlas', 0, 3 * DAY - 1),
+            ('cms', DAY, 2 * DAY - 1)])
+
+    def test_rollback(self):
+        self.dims.register(self.session, [_row('atlas', 1)])
+        self.session.commit()
+        self.dims.register(self.session, [_row('atlas', 5), _row('cms', 1)])
+        self.session.rollback()
+        self.assertEqual(self._catalog(), [('atlas', DAY, 2 * DAY - 1)])
+
+        self.dims.register(self.session, [_row('atlas', 5), _row('cms', 1)])
+        self.session.commit()
+        self.assertEqual(self._catalog(), [('atlas', DAY, 6 * DAY - 1),
+            ('cms', DAY, 2 * DAY - 1)])
+
+    def test_concurrent(self):
+        self.dims.register(self.session, [_row('cms', 1)])
+        self.session.commit()
+        self.dims.register(self.session, [_row('cms', 1)])  # loads the catalog
+        other = dimensions.DimensionCache()
+        other.register(self.session, [_row('atlas', 1)])
+        self.session.commit()
+        self.dims.register(self.session, [_row('atlas', 1), _row(None, 1)])  # stale cache
+        self.session.commit()
+        self.assertEqual(self._catalog(), [('atlas', DAY, 2 * DAY - 1),
+            ('cms', DAY, 2 * DAY - 1)])
+
+
+class CatalogAggregationTest(dbtest.AggregationTestCase):
+
+    def _expected(self, snapshot, column):
+        """ returns the values of column in the key_0 aggregates and their
+            seen ranges {name: (first, last)} at the base resolution
+        """
+        table = ag_schema.t_user_vo_machine_status
+        i = [c.name for c in table.primary_key.columns].index(column)
+        names = set([key[i] for key in snapshot[table.name]]) - set([None])
+        ranges = dict()
+        for key in snapshot[KEY_TABLES[column].name]:
+            name, resolution, t_epoch = key
+            if name is None or resolution != DAY:
+                continue
+            first, last = ranges.get(name, (t_epoch - DAY + 1, t_epoch))
+            ranges[name] = (min(first, t_epoch - DAY + 1), max(last, t_epoch))
+        return sorted(names), ranges
+
+    def assertCatalog(self, expected):
+        for column, table in ag_schema.DIMENSION_TABLES.items():
+            names, ranges = self._expected(expected, column)
+            self.assertEqual(helpers.get_active_names(column), names)
+            self.assertEqual(dict([(row.name, (row.first_seen, row.last_seen)) for row in \
+                sgascache_session.engine.execute(select([table]))]), ranges,
+                "seen ranges of %s differ" % column)
+        sgascache_session.Session.remove()
+
+    def test_main(self):
+        self.add_records(300, 30, seed=1)
+        expected = self.rebuilt()
+        aggregator = uraggregator.UrAggregator(DAYS_BACK)
+        aggregator.main(DAY, FACTORS)
+        self.assertCatalog(expected)
+
+        # late records, extending the seen ranges back
+        self.add_records(30, DAYS_BACK - 1, seed=2, min_days_back=30)
+        aggregator.main(DAY, FACTORS)
+        snapshot = self.snapshot()
+        self.assertCatalog(snapshot)
+        self.assertSnapshot(self.rebuilt(), snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Checks that late records (with old end times) only mark their buckets as
+dirty, and that recomputing these buckets yields the aggregates of a
+rebuild.
+"""
+
+import calendar
+import unittest
+
+from sqlalchemy import select
+
+from sgasaggregator import uraggregator
+from sgasaggregator.sgas import sgas_schema
+from sgasaggregator.sgas import session as sgas_session
+from sgasaggregator.sgascache import session as sgascache_session
+
+import dbtest
+from dbtest import DAY, FACTORS, DAYS_BACK
+
+
+class DirtyBucketsTest(dbtest.AggregationTestCase):
+
+    def test_late_records(self):
+        self.add_records(300, 30, seed=1)
+        uraggregator.UrAggregator(DAYS_BACK).main(DAY, FACTORS)
+
+        self.add_records(20, 12, seed=2, min_days_back=8)
+        UR = sgas_schema.t_usagerecords
+        late = set()
+        for row in sgas_session.engine.execute(select([UR.c.end_time],
+                UR.c.record_id.like('rec-2-%'))):
+            t_epoch = calendar.timegm(row.end_time.timetuple())
+            late.add(t_epoch - t_epoch % DAY)
+
+        aggregator = uraggregator.UrAggregator(DAYS_BACK)
+        new_recs = aggregator._new_records_filter(aggregator._load_watermark())
+        self.assertEqual(aggregator._dirty_buckets(new_recs, DAY), sorted(late))
+        sgascache_session.Session.remove()
+
+        aggregator.main(DAY, FACTORS)
+        snapshot = self.snapshot()
+        self.assertSnapshot(self.rebuilt(), snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()
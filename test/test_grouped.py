@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Checks that the 'grouped' ingest (GROUP BY within the SGAS database) yields
+the same aggregates as the rebuild by the 'orm' ingest.
+"""
+
+import unittest
+
+from sgasaggregator import uraggregator
+
+import dbtest
+from dbtest import DAY, FACTORS, DAYS_BACK
+
+
+class GroupedIngestTest(dbtest.AggregationTestCase):
+
+    def setUp(self):
+        dbtest.AggregationTestCase.setUp(self)
+        self.add_records(400, 35, seed=1)
+        self.expected = self.rebuilt()
+
+    def test_rebuild(self):
+        for lattice_engine in ('db', 'memory'):
+            aggregator = uraggregator.UrAggregator(DAYS_BACK, 'grouped',
+                lattice_engine=lattice_engine)
+            aggregator.rebuild_aggregation(aggregator.last_aggregation_time_epoch, DAY,
+                FACTORS)
+            self.assertSnapshot(self.expected)
+            self.reset_cache()
+
+    def test_main(self):
+        uraggregator.UrAggregator(DAYS_BACK, 'grouped').main(DAY, FACTORS)
+        self.assertSnapshot(self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Checks that the totals over the planned intervals of mixed resolutions (see
+helpers.plan_intervals()) equal the ones of a flat query over the aggregates
+of the finest resolution, and that the batched queries map the aggregates to
+the requested names. The series get filled from Decimal sums (as returned
+by MySQL).
+"""
+
+import random
+import unittest
+from decimal import Decimal
+
+from sqlalchemy import select, func
+from sqlalchemy.schema import CreateTable
+from sqlalchemy import and_ as AND
+
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import session as sgascache_session
+from sgasaggregator.utils import helpers
+from sgasaggregator.utils import vectorized
+
+import dbtest
+
+DAY = 86400
+RESOLUTIONS = [DAY, 7 * DAY, 28 * DAY]
+VOS = ['smscg', 'atlas']
+
+
+def _bucket(t_epoch, resolution):
+    return t_epoch - (t_epoch % resolution) + resolution - 1
+
+
+class PlannedTotalsTest(dbtest.CacheTestCase):
+
+    def setUp(self):
+        dbtest.CacheTestCase.setUp(self)
+
+        rnd = random.Random(1)
+        rows = dict()
+        for day in range(200):
+            for vo in VOS:
+                if rnd.random() < 0.2:
+                    continue
+                values = [rnd.randint(0, 1000) for v in ag_schema.VALUE_COLUMNS]
+                for resolution in RESOLUTIONS:
+                    key = (vo, resolution, _bucket(day * DAY, resolution))
+                    sums = rows.setdefault(key, [0] * len(values))
+                    for i, v in enumerate(values):
+                        sums[i] += v
+
+        params = list()
+        for (vo, resolution, t_epoch), values in rows.items():
+            row = dict(zip(ag_schema.VALUE_COLUMNS, values))
+            row.update(vo_name=vo, resolution=resolution, t_epoch=t_epoch)
+            params.append(row)
+        sgascache_session.engine.execute(ag_schema.t_vo.insert(), params)
+
+    def tearDown(self):
+        helpers.configured_resolutions = None
+        dbtest.CacheTestCase.tearDown(self)
+
+    def _flat_totals(self, start_t_epoch, end_t_epoch, vo):
+        t = ag_schema.t_vo
+        s_start, s_end = helpers.get_sampling_interval(start_t_epoch, end_t_epoch, DAY)
+        row = sgascache_session.engine.execute(select(
+            [func.coalesce(func.sum(t.c[k]), 0) for k in ag_schema.VALUE_COLUMNS],
+            AND(t.c.vo_name == vo, t.c.resolution == DAY, t.c.t_epoch >= s_start,
+                t.c.t_epoch <= s_end))).fetchone()
+        return dict(zip(ag_schema.VALUE_COLUMNS, [int(v) for v in row]))
+
+    def _intervals(self):
+        rnd = random.Random(2)
+        intervals = [(0, 200 * DAY), (5 * DAY + 17, 5 * DAY + 17), (3 * DAY, 150 * DAY - 1)]
+        for i in range(30):
+            start = rnd.randint(0, 200 * DAY)
+            intervals.append((start, start + rnd.randint(0, 100 * DAY)))
+        return intervals
+
+    def test_plan_covers_interval(self):
+        for start, end in self._intervals():
+            s_start, s_end = helpers.get_sampling_interval(start, end, DAY)
+            t = s_start
+            for resolution, p_start, p_end in helpers.plan_intervals(start, end, RESOLUTIONS):
+                self.assertEqual(p_start, t)
+                self.assertEqual(p_start % resolution, 0)
+                self.assertEqual((p_end + 1) % resolution, 0)
+                t = p_end + 1
+            self.assertEqual(t, s_end + 1)
+
+    def test_planned_totals(self):
+        for start, end in self._intervals():
+            for vo in VOS:
+                self.assertEqual(helpers.get_planned_totals(ag_schema.Vo, start, end,
+                    vo_name=vo), self._flat_totals(start, end, vo))
+
+    def test_configured_resolutions(self):
+        self.assertEqual(helpers.get_resolutions(ag_schema.Vo), RESOLUTIONS)
+        helpers.set_resolutions(DAY, [28, 7])
+        self.assertEqual(helpers.get_resolutions(ag_schema.Vo), RESOLUTIONS)
+        for start, end in self._intervals():
+            self.assertEqual(helpers.get_planned_totals(ag_schema.Vo, start, end,
+                vo_name='smscg'), self._flat_totals(start, end, 'smscg'))
+
+
+class BatchedRecordsTest(dbtest.CacheTestCase):
+
+    def setUp(self):
+        dbtest.CacheTestCase.setUp(self)
+        # case-insensitive vo_name, like the default collation of MySQL
+        t = ag_schema.t_vo
+        ddl = str(CreateTable(t).compile(sgascache_session.engine))
+        t.drop(sgascache_session.engine)
+        sgascache_session.engine.execute(ddl.replace('vo_name VARCHAR(50)',
+            'vo_name VARCHAR(50) COLLATE NOCASE'))
+
+        params = list()
+        for vo, day in [('atlas', 0), ('atlas', 1), ('smscg', 1)]:
+            row = dict([(k, 1) for k in ag_schema.VALUE_COLUMNS])
+            row.update(vo_name=vo, resolution=DAY, t_epoch=_bucket(day * DAY, DAY))
+            params.append(row)
+        sgascache_session.engine.execute(t.insert(), params)
+
+    def test_collation(self):
+        records = helpers.get_vos_acrecords(['ATLAS', 'smscg', 'cms'], 0, 2 * DAY, DAY)
+        self.assertEqual(dict([(k, len(v)) for k, v in records.items()]),
+            dict(ATLAS=2, smscg=1, cms=0))
+
+
+class SeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.np = vectorized.np
+
+    def tearDown(self):
+        vectorized.np = self.np
+
+    def _check(self):
+        big = 3 * 2 ** 40
+        rows = [(Decimal(2 * DAY - 1),) + (Decimal(big),) * len(ag_schema.VALUE_COLUMNS),
+            (4 * DAY - 1,) + (None,) * len(ag_schema.VALUE_COLUMNS)]
+        series = helpers._fill_series(ag_schema.t_vo, rows, 0, 4 * DAY - 1, DAY)
+        self.assertEqual(list(series['t_epoch']), [DAY - 1, 2 * DAY - 1, 3 * DAY - 1,
+            4 * DAY - 1])
+        for k in ag_schema.VALUE_COLUMNS:
+            self.assertEqual(list(series[k]), [0, big, 0, 0])
+            self.assertEqual([type(v) for v in series[k]][1], type(series['t_epoch'][0]))
+
+    def test_decimal(self):
+        self._check()
+
+    def test_decimal_array(self):
+        vectorized.np = None
+        self._check()
+
+
+if __name__ == '__main__':
+    unittest.main()
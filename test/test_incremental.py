@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Checks that the incremental aggregation mode (upserts of the increments)
+yields the aggregates of a rebuild, and that the reconciliation corrects
+drifted aggregates.
+"""
+
+import time
+import unittest
+
+from sgasaggregator import uraggregator
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import session as sgascache_session
+
+import dbtest
+from dbtest import DAY, FACTORS, DAYS_BACK
+
+
+class IncrementalTest(dbtest.AggregationTestCase):
+
+    def _aggregator(self, **kwargs):
+        if not uraggregator.upsert_supported(sgascache_session.engine):
+            self.skipTest("No upserts in the SGAS cache database")
+        return uraggregator.UrAggregator(DAYS_BACK, aggregation_mode='incremental', **kwargs)
+
+    def test_increments(self):
+        self.add_records(300, 30, seed=1)
+        aggregator = self._aggregator()
+        aggregator.main(DAY, FACTORS)
+
+        self.add_records(30, 30, seed=2)
+        aggregator.main(DAY, FACTORS)
+        self.add_records(30, 30, seed=3)
+        self._aggregator().main(DAY, FACTORS)  # after a restart
+        snapshot = self.snapshot()
+        self.assertSnapshot(self.rebuilt(), snapshot)
+
+    def test_reconcile(self):
+        self.add_records(300, 20, seed=1)
+        aggregator = self._aggregator(reconcile_interval=3600, reconcile_days_back=28)
+        aggregator.main(DAY, FACTORS)
+
+        t = ag_schema.t_vo
+        sgascache_session.engine.execute(t.update(t.c.t_epoch > time.time() - 5 * DAY,
+            values=dict(n_jobs=t.c.n_jobs + 1)))  # drift
+        aggregator.last_reconcile_time_epoch = 0
+        aggregator.main(DAY, FACTORS)
+        snapshot = self.snapshot()
+        self.assertSnapshot(self.rebuilt(), snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()
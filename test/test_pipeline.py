@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Checks that the Pipeline consumes the items in order and propagates errors
+of the reader to the caller.
+"""
+
+import threading
+import unittest
+
+from sgasaggregator import pipeline
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cleanups = list()
+
+    def cleanup(self):
+        self.cleanups.append(threading.currentThread().getName())
+
+    def test_order(self):
+        consumed = list()
+        n = pipeline.Pipeline(3).run(lambda item: item * 2, range(100),
+            lambda item, result: consumed.append((item, result)), self.cleanup)
+        self.assertEqual(n, 100)
+        self.assertEqual(consumed, [(i, i * 2) for i in range(100)])
+        self.assertEqual(len(self.cleanups), 1)
+        self.assertNotEqual(self.cleanups[0], threading.currentThread().getName())
+
+    def test_reader_error(self):
+        consumed = list()
+
+        def read(item):
+            if item == 5:
+                raise ValueError('read %d failed' % item)
+            return item
+
+        self.assertRaises(ValueError, pipeline.Pipeline(2).run, read, range(10),
+            lambda item, result: consumed.append(item), self.cleanup)
+        self.assertEqual(consumed, range(5))
+        self.assertEqual(len(self.cleanups), 1)
+
+    def test_consumer_error(self):
+        read = list()
+
+        def items():
+            i = 0
+            while True:  # the reader must be stopped
+                yield i
+                i += 1
+
+        def consume(item, result):
+            if item == 3:
+                raise ValueError('consume %d failed' % item)
+
+        self.assertRaises(ValueError, pipeline.Pipeline(2).run, lambda item: read.append(item),
+            items(), consume, self.cleanup)
+        self.assertTrue(len(read) <= 3 + 2 + 2)
+        self.assertEqual(len(self.cleanups), 1)
+
+    def test_empty(self):
+        self.assertEqual(pipeline.Pipeline().run(lambda item: item, [],
+            lambda item, result: None, self.cleanup), 0)
+        self.assertEqual(len(self.cleanups), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
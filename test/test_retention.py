@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Checks that the RetentionPolicy purges only the aggregates covered by the
+coarsest resolution (missing values counting as 0), truncating whole
+partitions before the horizon. Purging must not change the coarse
+aggregates, neither when late records get aggregated after the purge.
+"""
+
+import time
+import unittest
+
+from sqlalchemy import select, func, and_
+
+from sgasaggregator import retention
+from sgasaggregator import uraggregator
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import partitions
+from sgasaggregator.sgascache import session as sgascache_session
+from sgasaggregator.sgascache import writer
+
+import dbtest
+from dbtest import FACTORS, DAYS_BACK
+
+DAY = 86400
+WEEK = 7 * DAY
+
+
+class FakePartitions(partitions.PartitionManager):
+    """ partition manager of given bounds, which deletes the rows of the
+        truncated partitions
+    """
+
+    def __init__(self, bounds):
+        partitions.PartitionManager.__init__(self, sgascache_session.engine)
+        self.bounds = dict(vo=bounds)
+        self.truncated = list()
+
+    def truncate(self, session, table, names):
+        lower = None
+        for name, r, bound in self.bounds[table.name]:
+            if name in names:
+                session.execute(table.delete(and_(table.c.resolution == r,
+                    table.c.t_epoch >= lower, table.c.t_epoch < bound)))
+            lower = bound
+        self.truncated += names
+
+
+def _row(resolution, t_start_epoch, value):
+    row = dict([(v, value) for v in ag_schema.VALUE_COLUMNS])
+    row.update(vo_name='vo', resolution=resolution, t_epoch=t_start_epoch + resolution - 1)
+    return row
+
+
+class RetentionPolicyTest(dbtest.CacheTestCase):
+
+    def setUp(self):
+        dbtest.CacheTestCase.setUp(self)
+        self.writer = writer.BulkWriter()
+        self.writer.partitions = FakePartitions([('p0', DAY, 10 * DAY),
+            ('p1', DAY, 24 * DAY), ('p2', DAY, 38 * DAY), ('p3', DAY, 63 * DAY),
+            ('p_max', DAY, None), ('pmax', None, None)])
+        self.policy = retention.RetentionPolicy({}, self.writer, chunk_days=28)
+        # horizon (aligned to weeks) after 56 days
+        self.days = int(time.time()) / DAY - 60
+
+    def _populate(self):
+        session = sgascache_session.Session()
+        self.writer.write(session, ag_schema.t_vo, [_row(DAY, d * DAY, 1) for d in range(70)])
+        self.writer.write(session, ag_schema.t_vo,
+            [_row(WEEK, w * WEEK, 7) for w in range(10)])
+        session.commit()
+
+    def _days(self):
+        t = ag_schema.t_vo
+        return sgascache_session.Session.execute(select([func.min(t.c.t_epoch),
+            func.count()], t.c.resolution == DAY)).fetchone()
+
+    def test_purge(self):
+        self._populate()
+        self.assertEqual(self.writer.partitions.expired(ag_schema.t_vo, DAY, 56 * DAY),
+            [('p1', 10 * DAY, 24 * DAY), ('p2', 24 * DAY, 38 * DAY)])
+
+        self.assertEqual(self.policy.purge_table(ag_schema.t_vo, DAY, WEEK, self.days), 56)
+        self.assertEqual(self.writer.partitions.truncated, ['p1', 'p2'])
+        self.assertEqual(tuple(self._days()), (57 * DAY - 1, 14))
+
+    def test_not_covered(self):
+        self._populate()
+        session = sgascache_session.Session()
+        t = ag_schema.t_vo
+        session.execute(t.update(and_(t.c.resolution == WEEK, t.c.t_epoch == 5 * WEEK - 1),
+            values=dict(n_jobs=6)))
+        session.commit()
+
+        self.assertEqual(self.policy.purge_table(ag_schema.t_vo, DAY, WEEK, self.days), 28)
+        self.assertEqual(self.writer.partitions.truncated, ['p1'])
+        self.assertEqual(tuple(self._days()), (29 * DAY - 1, 42))
+
+    def test_missing_values(self):
+        self._populate()
+        session = sgascache_session.Session()
+        t = ag_schema.t_vo
+        session.execute(t.update(t.c.t_epoch < 14 * DAY, values=dict(user_time=None)))
+        session.commit()
+        self.assertTrue(self.policy.covered(t, DAY, WEEK, 0, 2 * WEEK))
+
+        session.execute(t.update(and_(t.c.resolution == DAY, t.c.t_epoch >= 14 * DAY),
+            values=dict(kernel_time=None)))
+        session.commit()
+        self.assertTrue(self.policy.covered(t, DAY, WEEK, 2 * WEEK, 4 * WEEK))
+        session.execute(t.update(and_(t.c.resolution == WEEK, t.c.t_epoch == 3 * WEEK - 1),
+            values=dict(user_time=None)))
+        session.commit()
+        self.assertFalse(self.policy.covered(t, DAY, WEEK, 2 * WEEK, 4 * WEEK))
+
+
+def _select(snapshot, resolution, t_start_epoch=None, t_end_epoch=None):
+    """ returns the aggregates of resolution (within [t_start_epoch,
+        t_end_epoch) if set) of the snapshot (see AggregationTestCase)
+    """
+    selected = dict()
+    for name, aggregates in snapshot.items():
+        selected[name] = dict([(key, values) for key, values in aggregates.items() \
+            if key[-2] == resolution and (t_start_epoch is None or key[-1] >= t_start_epoch) \
+            and (t_end_epoch is None or key[-1] < t_end_epoch)])
+    return selected
+
+
+class RetentionAggregationTest(dbtest.AggregationTestCase):
+
+    def test_purge(self):
+        coarse = FACTORS[-1] * DAY
+        self.add_records(400, DAYS_BACK - 1, seed=1)
+        expected = self.rebuilt()
+
+        aggregator = uraggregator.UrAggregator(DAYS_BACK)
+        aggregator.retention = retention.RetentionPolicy({(None, DAY): 10}, aggregator.writer)
+        aggregator.main(DAY, FACTORS)
+        aggregator.retention.purge(DAY, FACTORS)
+        horizon = aggregator.retention.purged_before(DAY)
+        horizon -= horizon % coarse
+        self.assertNotEqual(_select(expected, DAY, None, horizon)[ag_schema.t_vo.name], {})
+
+        snapshot = self.snapshot()
+        self.assertSnapshot(_select(expected, coarse), _select(snapshot, coarse))
+        self.assertSnapshot(_select(expected, DAY, horizon), _select(snapshot, DAY))
+
+        # late records before the horizon
+        self.add_records(30, 30, seed=2, min_days_back=12)
+        aggregator.main(DAY, FACTORS)
+        snapshot = self.snapshot()
+        expected = self.rebuilt()
+        self.assertSnapshot(_select(expected, coarse), _select(snapshot, coarse))
+        self.assertSnapshot(_select(expected, DAY, horizon), _select(snapshot, DAY, horizon))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Checks that the DagScheduler runs every task after the one producing its
+parent, and skips the tasks depending on a failed one.
+"""
+
+import threading
+import unittest
+
+from sgasaggregator import scheduler
+from sgasaggregator import uraggregator
+
+
+class DagSchedulerTest(unittest.TestCase):
+
+    def _run(self, edges, root, workers=4):
+        """ runs the edges, returns list of the run edges (in order) """
+        lock = threading.Lock()
+        done = list()
+
+        def task(parent, child):
+            lock.acquire()
+            try:
+                done.append((parent, child))
+            finally:
+                lock.release()
+
+        scheduler.DagScheduler(edges, workers).run(task, root)
+        return done
+
+    def test_order(self):
+        for workers in (1, 4):
+            done = self._run(uraggregator.KEY_LATTICE, 'key_0', workers=workers)
+            self.assertEqual(sorted(done), sorted(uraggregator.KEY_LATTICE))
+            produced = set(['key_0'])
+            for parent, child in done:
+                self.assertTrue(parent in produced, "%s run before %s" % (child, parent))
+                produced.add(child)
+
+    def test_subtree(self):
+        edges = [('a', 'b'), ('a', 'c'), ('b', 'd'), ('c', 'e')]
+        self.assertEqual(sorted(self._run(edges, 'b')), [('b', 'd')])
+        self.assertEqual(self._run(edges, 'd'), [])
+
+    def test_failure(self):
+        edges = [('a', 'b'), ('a', 'c'), ('b', 'd'), ('d', 'f'), ('c', 'e')]
+        done = list()
+
+        def task(parent, child):
+            if child == 'b':
+                raise ValueError('b failed')
+            done.append((parent, child))
+
+        self.assertRaises(ValueError, scheduler.DagScheduler(edges, 2).run, task, 'a')
+        self.assertEqual(sorted(done), [('a', 'c'), ('c', 'e')])
+
+
+if __name__ == '__main__':
+    unittest.main()
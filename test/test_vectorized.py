@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Checks that the vectorized kernel (see utils.vectorized) sums up in-memory
+rows exactly as the Python rollups of the aggregator do.
+"""
+
+import random
+import unittest
+
+from sgasaggregator import uraggregator
+from sgasaggregator.utils import vectorized
+
+USERS = ['/CN=alice', '/CN=bob', '/CN=carol', None]
+VOS = ['smscg', 'atlas', 'life', '']
+MACHINES = ['ce1.example.org', 'ce2.example.org', None]
+STATUS = ['completed', 'failed', 'killed']
+
+
+def _key0_rows(n, seed=1):
+    rnd = random.Random(seed)
+    rows = dict()
+    for i in range(n):
+        t_epoch = 1262304000 + 86400 * rnd.randint(0, 120) - 1
+        key = (rnd.choice(USERS), rnd.choice(VOS), rnd.choice(MACHINES),
+            rnd.choice(STATUS), t_epoch)
+        rows[key] = [rnd.randint(0, 2 ** 40) for v in uraggregator.AGGREGATE_KEYS]
+    return rows
+
+
+class VectorizedTest(unittest.TestCase):
+
+    def setUp(self):
+        if not vectorized.available():
+            self.skipTest("NumPy is not installed")
+        self.aggregator = uraggregator.UrAggregator(0)
+        self.rows = _key0_rows(2000)
+        self.n = len(uraggregator.KEY_MAPS['key_0'])
+
+    def test_rollup_parity(self):
+        encoded = vectorized.from_dict(self.rows, self.n)
+        for key in uraggregator.KEY_ORDER:
+            idx = [uraggregator.KEY_MAPS['key_0'].index(k) for k in uraggregator.KEY_MAPS[key]]
+            for resolution in (None, 7 * 86400, 28 * 86400):
+                expected = self.aggregator._rollup(self.rows, 'key_0', key, resolution)
+                self.assertEqual(encoded.rollup(idx, resolution), expected)
+
+    def test_lattice_parity(self):
+        expected = self.aggregator._rollup_lattice(self.rows)
+        self.aggregator.aggregation_backend = 'numpy'
+        self.assertEqual(self.aggregator._rollup_lattice(self.rows), expected)
+
+    def test_empty(self):
+        self.assertEqual(vectorized.from_dict(dict(), self.n).rollup(), dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Checks that the ingest watermark leaves the records inserted within the
+safety lag for the next run, and that records are aggregated exactly once
+across restarts of the aggregator.
+"""
+
+import time
+import unittest
+from datetime import datetime
+
+from sgasaggregator import uraggregator
+from sgasaggregator.sgas import sgas_schema
+from sgasaggregator.sgas import session as sgas_session
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import session as sgascache_session
+
+import dbtest
+from dbtest import DAY, FACTORS, DAYS_BACK
+
+
+class WatermarkTest(dbtest.AggregationTestCase):
+
+    def _watermark(self):
+        return sgascache_session.Session.query(ag_schema.IngestWatermark).get(
+            uraggregator.WATERMARK_SOURCE)
+
+    def test_safety_lag(self):
+        self.add_records(300, 30, seed=1, min_days_back=3)
+        expected = self.rebuilt()
+
+        # inserted just now, i.e. within the safety lag (and ended in other
+        # buckets, which don't get rebuilt)
+        self.add_records(50, 1, seed=2, insert_time=datetime.utcfromtimestamp(time.time()))
+        uraggregator.UrAggregator(DAYS_BACK).main(DAY, FACTORS)
+        self.assertSnapshot(expected)
+        wm = self._watermark()
+        self.assertTrue(wm.insert_time < datetime.utcfromtimestamp(time.time() - 300))
+        sgascache_session.Session.remove()
+
+        # past the safety lag, aggregated by the next run (after a restart)
+        UR = sgas_schema.t_usagerecords
+        sgas_session.engine.execute(UR.update(UR.c.record_id.like('rec-2-%'),
+            values=dict(insert_time=datetime.utcfromtimestamp(time.time() - 400))))
+        uraggregator.UrAggregator(DAYS_BACK).main(DAY, FACTORS)
+        snapshot = self.snapshot()
+        self.assertSnapshot(self.rebuilt(), snapshot)
+
+    def test_restart(self):
+        self.add_records(300, 30, seed=1)
+        aggregator = uraggregator.UrAggregator(DAYS_BACK)
+        aggregator.main(DAY, FACTORS)
+        aggregator.main(DAY, FACTORS)  # nothing new
+
+        self.add_records(50, 30, seed=2)
+        uraggregator.UrAggregator(DAYS_BACK).main(DAY, FACTORS)
+        snapshot = self.snapshot()
+        self.assertSnapshot(self.rebuilt(), snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Checks claiming, failing and lease expiry of the tasks of the WorkQueue, on
+a sqlite database (i.e. claims by conditional updates).
+"""
+
+import unittest
+
+from sqlalchemy import select
+
+from sgasaggregator import workqueue
+from sgasaggregator.sgascache import session as sgascache_session
+
+import dbtest
+
+DAY = 86400
+
+
+def _task(step, t_start=0, t_end=DAY, key_name='key_0'):
+    return dict(step=step, stage='ingest', key_name=key_name, resolution=DAY,
+        t_start=t_start, t_end=t_end)
+
+
+class WorkQueueTest(dbtest.CacheTestCase):
+
+    def setUp(self):
+        dbtest.CacheTestCase.setUp(self)
+        self.wq = workqueue.WorkQueue(sgascache_session.engine, owner='a')
+
+    def _enqueue(self, tasks, wq=None):
+        wq = wq or self.wq
+        session = sgascache_session.Session()
+        batch = wq.next_batch(session)
+        wq.enqueue(session, batch, tasks)
+        session.commit()
+        return batch
+
+    def _state(self, task):
+        t = self.wq.table
+        return sgascache_session.engine.execute(t.select(t.c.id == task['id'])).fetchone()
+
+    def test_steps(self):
+        self._enqueue([_task(0), _task(1, key_name='key_01'), _task(1, key_name='key_02')])
+        first = self.wq.claim()
+        self.assertEqual((first['step'], first['state'], first['owner']), (0, 'running', 'a'))
+        self.assertEqual(first['attempts'], 1)
+        self.assertEqual(self.wq.claim(), None)  # waits for step 0
+        self.assertEqual(self.wq.running(), 1)
+
+        self.wq.complete(first)
+        self.assertEqual(self._state(first).state, 'done')
+        second, third = self.wq.claim(), self.wq.claim()
+        self.assertEqual((second['step'], third['step']), (1, 1))
+        self.assertNotEqual(second['id'], third['id'])
+        self.assertEqual(self.wq.claim(), None)
+
+    def test_batch_overlap(self):
+        self._enqueue([_task(0, 0, DAY)])
+        self._enqueue([_task(0, DAY / 2, 2 * DAY), _task(0, DAY, 2 * DAY)])
+        first = self.wq.claim()
+        disjoint = self.wq.claim()
+        self.assertEqual((first['batch'], disjoint['batch']), (1, 2))
+        self.assertEqual(disjoint['t_start'], DAY)
+        self.assertEqual(self.wq.claim(), None)  # overlaps the running task
+
+        self.wq.complete(first)
+        overlapping = self.wq.claim()
+        self.assertEqual((overlapping['batch'], overlapping['t_start']), (2, DAY / 2))
+
+    def test_fail(self):
+        wq = workqueue.WorkQueue(sgascache_session.engine, owner='a', max_attempts=2)
+        self._enqueue([_task(0)], wq)
+        task = wq.claim()
+        wq.fail(task, 'first')
+        row = self._state(task)
+        self.assertEqual((row.state, row.owner, row.message), ('queued', None, 'first'))
+
+        task = wq.claim()
+        self.assertEqual(task['attempts'], 2)
+        wq.fail(task, 'second')
+        self.assertEqual(self._state(task).state, 'failed')
+        self.assertEqual(wq.claim(), None)
+
+        self.assertEqual(wq.requeue_failed(), 1)
+        task = wq.claim()
+        self.assertEqual(task['attempts'], 1)
+
+    def test_failed_for_good(self):
+        wq = workqueue.WorkQueue(sgascache_session.engine, owner='a', max_attempts=1)
+        self._enqueue([_task(0), _task(1, key_name='key_01')], wq)
+        self._enqueue([_task(0), _task(1, key_name='key_01')], wq)
+
+        def execute(task):
+            if task['batch'] == 1 and task['step'] == 0:
+                raise ValueError('failed for good')
+
+        self.assertEqual(wq.run(execute), 3)  # later batch is not blocked
+        t = wq.table
+        states = sgascache_session.engine.execute(select([t.c.batch, t.c.step, t.c.state],
+            order_by=[t.c.batch, t.c.step])).fetchall()
+        self.assertEqual([tuple(row) for row in states], [(1, 0, 'failed'),
+            (1, 1, 'cancelled'), (2, 0, 'done'), (2, 1, 'done')])
+        self.assertEqual(wq.report(), 2)
+        self.assertEqual(wq.purge_done(-1), 2)
+
+        self.assertEqual(wq.requeue_failed(), 2)
+        self.assertEqual(wq.run(lambda task: None), 2)
+        self.assertEqual(wq.report(), 0)
+        self.assertEqual(wq.purge_done(-1), 2)
+
+    def test_lease_expiry(self):
+        dead = workqueue.WorkQueue(sgascache_session.engine, owner='dead', lease=-1)
+        alive = workqueue.WorkQueue(sgascache_session.engine, owner='alive')
+        self._enqueue([_task(0)])
+
+        task = dead.claim()
+        self.assertEqual(alive.running(), 0)  # lease expired already
+        reclaimed = alive.claim()
+        self.assertEqual((reclaimed['id'], reclaimed['owner']), (task['id'], 'alive'))
+        self.assertEqual(reclaimed['attempts'], 2)
+
+        self.assertFalse(dead.heartbeat(task))
+        dead.complete(task)  # lost, must not change the task
+        self.assertEqual(self._state(task).state, 'running')
+        self.assertTrue(alive.heartbeat(reclaimed))
+        alive.complete(reclaimed)
+        self.assertEqual(self._state(task).state, 'done')
+
+    def test_run(self):
+        self._enqueue([_task(0), _task(1, key_name='key_01')])
+        executed = list()
+
+        def execute(task):
+            executed.append(task['key_name'])
+            if len(executed) == 1:
+                raise ValueError('failed once')
+
+        self.assertEqual(self.wq.run(execute), 3)
+        self.assertEqual(executed, ['key_0', 'key_0', 'key_01'])
+        self.assertEqual(self.wq.purge_done(-1), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
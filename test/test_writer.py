@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Checks that the BulkWriter writes the rows in batches, and that partitions
+only get truncated if the caller asks for it.
+"""
+
+import unittest
+
+from sqlalchemy import select, func
+
+from sgasaggregator.sgascache import ag_schema
+from sgasaggregator.sgascache import session as sgascache_session
+from sgasaggregator.sgascache import writer
+
+import dbtest
+
+
+class CountingSession(object):
+    """ session, which counts the executed statements and their rows """
+
+    def __init__(self, session):
+        self.session = session
+        self.bind = session.bind
+        self.batches = list()
+
+    def execute(self, statement, params=None):
+        if isinstance(params, list):
+            self.batches.append(len(params))
+        else:
+            self.batches.append(1)
+        return self.session.execute(statement, params)
+
+
+class FakePartitions(object):
+    """ partition manager, which records the truncated partitions """
+
+    def __init__(self):
+        self.truncated = list()
+
+    def covered(self, table, resolution, t_start_epoch, t_end_epoch):
+        return ['p0']
+
+    def truncate(self, session, table, names):
+        self.truncated.append((table.name, names))
+
+
+def _rows(n, resolution=86400):
+    rows = list()
+    for i in range(n):
+        row = dict([(v, i) for v in ag_schema.VALUE_COLUMNS])
+        row.update(vo_name='vo%d' % (i % 7), resolution=resolution,
+            t_epoch=(i / 7 + 1) * resolution - 1)
+        rows.append(row)
+    return rows
+
+
+class BulkWriterTest(dbtest.CacheTestCase):
+
+    def setUp(self):
+        dbtest.CacheTestCase.setUp(self)
+        self.session = CountingSession(sgascache_session.Session())
+
+    def _count(self):
+        return self.session.session.execute(select([func.count()],
+            from_obj=[ag_schema.t_vo])).scalar()
+
+    def test_executemany_batches(self):
+        w = writer.BulkWriter('executemany', 100)
+        self.assertEqual(w.write(self.session, ag_schema.t_vo, _rows(250)), 250)
+        self.assertEqual(self.session.batches, [100, 100, 50])
+        self.assertEqual(self._count(), 250)
+
+    def test_multirow_batches(self):
+        w = writer.BulkWriter('multirow', 10)
+        self.assertEqual(w.write(self.session, ag_schema.t_vo, _rows(25)), 25)
+        self.assertEqual(len(self.session.batches), 3)
+        self.assertEqual(self._count(), 25)
+
+    def test_native_fallback(self):
+        w = writer.BulkWriter('native', 100)
+        w.write(self.session, ag_schema.t_vo, _rows(150))
+        self.assertEqual(self.session.batches, [100, 50])
+        self.assertEqual(self._count(), 150)
+
+    def test_empty(self):
+        self.assertEqual(writer.BulkWriter().write(self.session, ag_schema.t_vo, []), 0)
+        self.assertEqual(self.session.batches, [])
+
+    def test_replace_range(self):
+        w = writer.BulkWriter('executemany', 100)
+        w.write(self.session, ag_schema.t_vo, _rows(70))
+        self.assertEqual(w.replace_range(self.session, ag_schema.t_vo, 86400, 0,
+            2 * 86400, _rows(3)), 14)
+        self.assertEqual(self._count(), 70 - 14 + 3)
+
+    def test_truncate(self):
+        w = writer.BulkWriter()
+        w.partitions = FakePartitions()
+        w.write(self.session, ag_schema.t_vo, _rows(70))
+        w.replace_range(self.session, ag_schema.t_vo, 86400, 0, 86400, [])
+        w.delete_range(self.session, ag_schema.t_vo, 86400, 0, 86400)
+        self.assertEqual(w.partitions.truncated, [])
+        self.assertEqual(w.delete_range(self.session, ag_schema.t_vo, 86400, 0, truncate=True),
+            63)
+        self.assertEqual(w.partitions.truncated, [('vo', ['p0'])])
+
+
+if __name__ == '__main__':
+    unittest.main()